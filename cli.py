@@ -6,10 +6,19 @@
 
 import argparse
 import os
+import sys
 from kaldi_active_grammar import Compiler, disable_donation_message
 import tacspeak
 from tacspeak.__main__ import main as tacspeak_main
-from tacspeak.test_model import test_model, test_model_dictation, transcribe_wav, transcribe_wav_dictation
+from tacspeak.test_model import (test_model, test_model_dictation, transcribe_wav, transcribe_wav_dictation,
+                                 transcribe_batch, write_test_model_output, classify_transcripts, load_text_engine_grammars,
+                                 RECOGNITION_TIMEOUT_S)
+from tacspeak.grammar_lint import lint_grammars
+from tacspeak.grammar_bundle import build_bundle, BUNDLE_DIR
+from tacspeak.corpus import pack_corpus, audio_exists, is_batch_input
+from tacspeak import daemon
+from tacspeak.longform import transcribe_long
+from tacspeak.benchmark import rtf
 from dragonfly import get_engine
 import logging
 from multiprocessing import freeze_support
@@ -29,18 +38,101 @@ def main():
                                 + ' useful for setting `audio_input_device` in ./tacspeak/user_settings.py'))
     parser.add_argument('--test_model', dest='test_model', action='store',
                         metavar=('tsv_file', 'model_dir', 'lexicon_file', 'num_threads'), nargs=4,
-                        help=('test model + active grammar recognition using test audio specified in .tsv file.'
+                        help=('test model + active grammar recognition using test audio specified in .tsv file, or a corpus file from --pack_corpus.'
                                 + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4"))
     parser.add_argument('--test_dictation', action='store_true',
                         help=('only used together with --test_model. tests model using raw dictation graph, irrespective of grammar modules.'
                               + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --test_dictation"))
+    parser.add_argument('--test_journal', dest='test_journal', action='store',
+                        metavar='journal_file', nargs='?', const='test_model_journal.jsonl',
+                        help=('only used together with --test_model. appends each scored utterance to `journal_file` (default is test_model_journal.jsonl)'
+                              + ' as it completes. re-running the same test resumes from the journal, skipping wav files already in it.'
+                              + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --test_journal"))
+    parser.add_argument('--no_cache', dest='no_cache', action='store_true',
+                        help=('only used together with --test_model. ignores and does not update the recognition result cache in ./.tacspeak_cache/.'
+                              + ' results are cached per wav file + transcript, and invalidated when the model, grammar modules or engine settings change.'
+                              + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --no_cache"))
+    parser.add_argument('--warm_pool', action='store_true',
+                        help=('only used together with --test_model or a batch --transcribe_wav, Linux only. loads the model and grammar modules once, then forks the'
+                              + ' worker processes from it, sharing the loaded model instead of each worker loading its own copy.'
+                              + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --warm_pool"))
+    parser.add_argument('--test_phrase_index', action='store_true',
+                        help=('only used together with --test_model. parses the transcripts with a phrase index of the grammar modules\' rules,'
+                              + ' instead of engine.mimic() for each unique transcript.'
+                              + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --test_phrase_index"))
+    parser.add_argument('--classify_transcripts', dest='classify_transcripts', action='store',
+                        metavar=('tsv_file', 'out_file'), nargs=2,
+                        help=('write the rule and options each transcript in .tsv file (or corpus file) would be recognised as to out_file,'
+                              + ' using a phrase index of the grammar modules\' rules, without loading a model.'
+                              + " Example: --classify_transcripts './retain/retain.tsv' './retain/retain_rules.tsv'"))
+    parser.add_argument('--lint_grammar', dest='lint_grammar', action='store', metavar='out_file', nargs='?', const='',
+                        help=('lint the grammar modules\' rules without loading a model: the size of their compiled graphs, redundant optionals,'
+                              + ' ambiguous alternatives, and smaller specs matching the same phrases. optionally also writes the report to out_file.'
+                              + " Example: --lint_grammar './grammar_lint.txt'"))
+    parser.add_argument('--build_grammar_bundle', dest='build_grammar_bundle', action='store', metavar='model_dir',
+                        nargs='?', const='kaldi_model/',
+                        help=(f'compile the grammar modules against the model in `model_dir` (default is kaldi_model/) into {BUNDLE_DIR},'
+                              + ' which is shipped with the build, so they needn\'t be compiled when Tacspeak first starts. run by setup.py.'
+                              + " Example: --build_grammar_bundle './kaldi_model/'"))
+    parser.add_argument('--daemon', dest='daemon', action='store', metavar='model_dir',
+                        help=('start a daemon (Linux only) which keeps the engine and grammar modules for model_dir loaded. while it is running,'
+                              + ' --test_model and --transcribe_wav run in the daemon instead of starting up from scratch.'
+                              + " Example: --daemon './kaldi_model/'"))
+    parser.add_argument('--daemon_reload', action='store_true',
+                        help='reload the grammar modules of a running daemon, e.g. after editing them. Example: --daemon_reload')
+    parser.add_argument('--daemon_stop', action='store_true',
+                        help='stop a running daemon. Example: --daemon_stop')
+    parser.add_argument('--no_daemon', action='store_true',
+                        help=('only used together with --test_model or --transcribe_wav. runs in this process, even if a daemon is running.'
+                              + " Example: --transcribe_wav 'audio.wav' 'audio.txt' './kaldi_model/' --no_daemon"))
+    parser.add_argument('--pack_corpus', dest='pack_corpus', action='store',
+                        metavar=('tsv_file', 'corpus_file'), nargs=2,
+                        help=('pack the wav files and transcripts in .tsv file into a single corpus file, which can be used in place of'
+                              + ' the .tsv file for --test_model, or the wav file for --transcribe_wav (to transcribe every clip in it).'
+                              + " Example: --pack_corpus './retain/retain.tsv' './retain/retain.tspk'"))
     parser.add_argument('--transcribe_wav', dest='transcribe_wav', action='store',
                         metavar=('wav_path', 'out_txt_path', 'model_dir'), nargs=3,
-                        help=('transcribe a wav file using active grammar modules, output to txt file.'
+                        help=('transcribe a wav file (or corpus clip as `corpus_file::wav_path`) using active grammar modules, output to txt file.'
+                              + ' wav_path can also be a directory, glob (quoted), list file (one wav path per line) or corpus file, to transcribe'
+                              + ' every file in it, streaming a line per file to out_txt_path (tab separated, or json if it ends with .jsonl).'
                                 + " Example: --transcribe_wav 'audio.wav' 'audio.txt' './kaldi_model/'"))
     parser.add_argument('--transcribe_dictation', action='store_true',
                         help=('only used together with --transcribe_wav. transcribes using raw dictation graph, irrespective of grammar modules.'
                               + " Example: --transcribe_wav 'audio.wav' 'audio.txt' './kaldi_model/' --transcribe_dictation"))
+    parser.add_argument('--transcribe_long', dest='transcribe_long', action='store',
+                        metavar=('wav_path', 'out_txt_path', 'model_dir'), nargs=3,
+                        help=('transcribe a long wav file (e.g. a whole session) using the raw dictation graph, split into utterances by VAD.'
+                              + ' utterances are decoded by --transcribe_threads workers and streamed to out_txt_path with their start and end'
+                              + ' times (tab separated, or json if it ends with .jsonl).'
+                              + " Example: --transcribe_long 'session.wav' 'session.txt' './kaldi_model/' --transcribe_threads 4"))
+    parser.add_argument('--transcribe_threads', dest='transcribe_threads', action='store', type=int, metavar='num_threads', default=1,
+                        help=('only used together with --transcribe_long, or --transcribe_wav for a directory, glob, list file or corpus file. number of worker processes.'
+                              + " Example: --transcribe_wav './retain/*.wav' 'transcripts.jsonl' './kaldi_model/' --transcribe_threads 4"))
+    parser.add_argument('--recognition_timeout', dest='recognition_timeout', action='store', type=float,
+                        metavar='seconds', default=RECOGNITION_TIMEOUT_S,
+                        help=('only used together with --test_model or --transcribe_wav. max seconds to wait for each utterance to be recognised'
+                              + f' (default is {RECOGNITION_TIMEOUT_S}), timeouts are reported in the output.'
+                              + " Example: --test_model './retain/retain.tsv' './kaldi_model/' './kaldi_model/lexicon.txt' 4 --recognition_timeout 5"))
+    parser.add_argument('--benchmark', dest='benchmark', action='store',
+                        metavar=('tsv_file', 'model_dir'), nargs=2,
+                        help=('benchmark decoding speed of the audio in .tsv (or corpus) file, with active grammar modules and the raw dictation graph.'
+                              + ' reports wall time, cpu time, real-time factor and peak memory per worker count, and compares them to a stored'
+                              + ' baseline (created by the first run), exiting with an error if any cpu real-time factor has regressed.'
+                              + " Example: --benchmark './retain/retain.tsv' './kaldi_model/' --benchmark_workers 1,4"))
+    parser.add_argument('--benchmark_workers', dest='benchmark_workers', action='store', metavar='worker_counts', default="1",
+                        help=("only used together with --benchmark. comma separated numbers of worker processes to benchmark (default is 1)."
+                              + " Example: --benchmark './retain/retain.tsv' './kaldi_model/' --benchmark_workers 1,2,4"))
+    parser.add_argument('--benchmark_baseline', dest='benchmark_baseline', action='store', metavar='json_path',
+                        default=rtf.DEFAULT_BASELINE_PATH,
+                        help=(f"only used together with --benchmark. baseline file to compare against (default is {rtf.DEFAULT_BASELINE_PATH})."
+                              + " Example: --benchmark './retain/retain.tsv' './kaldi_model/' --benchmark_baseline './baseline_4core.json'"))
+    parser.add_argument('--benchmark_threshold', dest='benchmark_threshold', action='store', type=float, metavar='fraction',
+                        default=rtf.DEFAULT_THRESHOLD,
+                        help=(f"only used together with --benchmark. fail if cpu real-time factor is this fraction slower than baseline (default is {rtf.DEFAULT_THRESHOLD})."
+                              + " Example: --benchmark './retain/retain.tsv' './kaldi_model/' --benchmark_threshold 0.05"))
+    parser.add_argument('--benchmark_update', action='store_true',
+                        help=("only used together with --benchmark. replace the baseline with this run's results."
+                              + " Example: --benchmark './retain/retain.tsv' './kaldi_model/' --benchmark_update"))
     args = parser.parse_args()
     if args.model_dir is not None and os.path.isdir(args.model_dir):
         _log = logging.getLogger('kaldi')
@@ -49,10 +141,36 @@ def main():
         print("Compiling dictation graph (approx. 30 minutes)...")
         compiler.compile_agf_dictation_fst()
         return
+    if args.daemon:
+        daemon.serve(args.daemon)
+        return
+    if args.daemon_reload or args.daemon_stop:
+        response = daemon.submit('reload' if args.daemon_reload else 'stop')
+        print("No daemon is running" if response is None else f"{response}")
+        return
+    if args.pack_corpus:
+        pack_corpus(args.pack_corpus[0], args.pack_corpus[1])
+        return
     if args.print_mic_list:
         get_engine('kaldi').print_mic_list()
         input("Press enter key to exit.")
         return
+    if args.classify_transcripts:
+        classify_transcripts(args.classify_transcripts[0], args.classify_transcripts[1])
+        return
+    if args.build_grammar_bundle:
+        build_bundle(args.build_grammar_bundle)
+        return
+    if args.lint_grammar is not None:
+        lint_grammars(load_text_engine_grammars(), args.lint_grammar or None)
+        return
+    if args.benchmark:
+        tsv_file, model_dir = args.benchmark
+        ok = rtf.benchmark(tsv_file, model_dir, rtf.parse_workers(args.benchmark_workers), args.benchmark_baseline,
+                           args.benchmark_threshold, args.benchmark_update, warm_pool=args.warm_pool)
+        if not ok:
+            sys.exit(1)
+        return
     if args.test_model:
         if args.test_model[0] is not None and os.path.isfile(args.test_model[0]) and args.test_model[1] is not None and os.path.isdir(args.test_model[1]):
             tsv_file = args.test_model[0]
@@ -72,32 +190,47 @@ def main():
                 print(f"{e}")
                 num_threads = 1
             print(f"{tsv_file},{model_dir},{lexicon_file},{num_threads}")
+            kwargs = {'tsv_file': tsv_file, 'model_dir': model_dir, 'lexicon_file': lexicon_file, 'num_threads': num_threads,
+                      'journal_path': args.test_journal, 'use_cache': not args.no_cache}
+            if not args.test_dictation:
+                kwargs['timeout'] = args.recognition_timeout
+                kwargs['use_phrase_index'] = args.test_phrase_index
+            result = run_in_daemon(args, 'test_model_dictation' if args.test_dictation else 'test_model', kwargs)
+            if result is daemon.INTERRUPTED:
+                return
+            if result is not None:
+                overall_string, cmd_overall_stats = result
+                print(f"{overall_string}")
+                return overall_string, cmd_overall_stats
             if args.test_dictation:
-                calculator, cmd_overall_stats = test_model_dictation(tsv_file, model_dir, lexicon_file, num_threads)
-                outfile_path = 'test_model_output_dictation_tokens.txt'
+                test_result = test_model_dictation(tsv_file, model_dir, lexicon_file, num_threads, 
+                                                   journal_path=args.test_journal, use_cache=not args.no_cache,
+                                                   warm_pool=args.warm_pool)
             else:
-                calculator, cmd_overall_stats = test_model(tsv_file, model_dir, lexicon_file, num_threads)
-                outfile_path = 'test_model_output_tokens.txt'
-
-            with open(outfile_path, 'w', encoding='utf-8') as outfile:
-                outfile.write(f"\n{calculator.overall_string()}\n")
-                for item in calculator.data.items():
-                    outfile.write(f"\n{str(item)}")
-                outfile.write("\n")
-                for entry in calculator.ranked_worst_to_best_list():
-                    outfile.write(f"\n{str(entry)}")
-            
-            overall_entry_1 = (model_dir, tsv_file, "Dictation" if args.test_dictation else "Command", "WER", calculator.overall_string())
-            overall_entry_2 = (model_dir, tsv_file, "Dictation" if args.test_dictation else "Command", "CMDERR", cmd_overall_stats)
-            with open('test_model_output_overall.txt', 'a', encoding='utf-8') as outfile:
-                outfile.write(f"{overall_entry_1}\n")
-                if not args.test_dictation:
-                    outfile.write(f"{overall_entry_2}\n")
-
-            return calculator.overall_string(), cmd_overall_stats
+                test_result = test_model(tsv_file, model_dir, lexicon_file, num_threads, 
+                                         timeout=args.recognition_timeout, journal_path=args.test_journal,
+                                         use_cache=not args.no_cache, warm_pool=args.warm_pool,
+                                         use_phrase_index=args.test_phrase_index)
+            if test_result is None:
+                # interrupted
+                return
+            calculator, cmd_overall_stats = test_result
+            return write_test_model_output(calculator, cmd_overall_stats, tsv_file, model_dir, dictation=args.test_dictation)
+        return
+    if args.transcribe_long:
+        wav_path, out_txt_path, model_dir = args.transcribe_long
+        transcribe_long(wav_path, out_txt_path, model_dir, num_threads=max(1, args.transcribe_threads), warm_pool=args.warm_pool)
         return
     if args.transcribe_wav:
-        if args.transcribe_wav[0] is not None and os.path.isfile(args.transcribe_wav[0]):
+        if args.transcribe_wav[0] is not None and is_batch_input(args.transcribe_wav[0]):
+            kwargs = {'input_path': args.transcribe_wav[0], 'out_path': args.transcribe_wav[1], 'model_dir': args.transcribe_wav[2],
+                      'num_threads': max(1, args.transcribe_threads), 'dictation': args.transcribe_dictation}
+            if not args.transcribe_dictation:
+                kwargs['timeout'] = args.recognition_timeout
+            if run_in_daemon(args, 'transcribe_batch', kwargs) is None:
+                transcribe_batch(warm_pool=args.warm_pool, **kwargs)
+            return
+        if args.transcribe_wav[0] is not None and audio_exists(args.transcribe_wav[0]):
             wav_path = args.transcribe_wav[0]
             try:
                 out_txt_path = args.transcribe_wav[1]
@@ -107,14 +240,40 @@ def main():
                 model_dir = args.transcribe_wav[2]
             except Exception:
                 model_dir = "./kaldi_model/"
+            kwargs = {'wav_path': wav_path, 'out_txt_path': out_txt_path, 'model_dir': model_dir}
+            if not args.transcribe_dictation:
+                kwargs['timeout'] = args.recognition_timeout
+            entry = run_in_daemon(args, 'transcribe_wav_dictation' if args.transcribe_dictation else 'transcribe_wav', kwargs)
+            if entry is not None:
+                print(f"{entry}")
+                return
             if args.transcribe_dictation:
                 entry = transcribe_wav_dictation(wav_path, out_txt_path, model_dir)
             else:
-                entry = transcribe_wav(wav_path, out_txt_path, model_dir)
+                entry = transcribe_wav(wav_path, out_txt_path, model_dir, timeout=args.recognition_timeout)
             print(f"{entry}")
         return
     tacspeak_main()
 
+def run_in_daemon(args, job, kwargs):
+    """
+    Returns the result of `job` run by a running daemon, daemon.INTERRUPTED if it was interrupted there,
+    or None if it should be run in this process instead.
+    """
+    if args.no_daemon:
+        return None
+    response = daemon.submit(job, kwargs)
+    if response is None:
+        return None
+    if response.get('interrupted'):
+        print(f"Daemon was interrupted running {job}")
+        return daemon.INTERRUPTED
+    if not response['ok']:
+        print(f"Daemon failed {job}, running it here instead: {response['error']}")
+        return None
+    print(f"Ran {job} in daemon")
+    return response['result']
+
 def print_notices():
     text = """
     Tacspeak - speech recognition for gaming
@@ -7,6 +7,7 @@
 import os
 import sys
 import re
+import subprocess
 from pkg_resources import get_distribution
 from cx_Freeze import setup, Executable
 
@@ -61,6 +62,16 @@ def grammar_modules():
         src_dst_dirs.append(src_dst)
     return src_dst_dirs
 
+def build_grammar_bundle():
+    """
+    Compiles the grammar modules against kaldi_model/ into grammar_bundle/, see tacspeak/grammar_bundle.py.
+    Runs in its own process, as it loads the engine and grammar modules.
+    """
+    subprocess.run([sys.executable, "cli.py", "--build_grammar_bundle", "kaldi_model/"], check=True)
+
+if any(arg.startswith(("build", "bdist")) for arg in sys.argv[1:]):
+    build_grammar_bundle()
+
 include_files = []
 include_files.extend(collect_dist_info("webrtcvad_wheels"))
 include_files.extend(grammar_modules())
@@ -73,6 +84,7 @@ include_files.append(("licenses/portaudio_license.txt", "licenses/portaudio_lice
 include_files.append("kaldi_model/")
 include_files.append(("kaldi_model/README.md", "kaldi_model/README.md"))
 include_files.append(("kaldi_model/user_lexicon.txt", "kaldi_model/user_lexicon.txt"))
+include_files.append("grammar_bundle/")
 include_files.append(("scripts/download_extract_model.ps1", "scripts/download_extract_model.ps1"))
 include_files.append(("scripts/move_extracted_model.ps1", "scripts/move_extracted_model.ps1"))
 include_files.append(("scripts/compile_dictation_graph.ps1", "scripts/compile_dictation_graph.ps1"))
@@ -9,6 +9,8 @@ Command-module loader for Tacspeak.
 
 It scans the ``./tacspeak/grammar/`` folder and loads any ``_*.py``.
 It also loads ``./tacspeak/user_settings.py`` for engine settings.
+With HOT_RELOAD, it reloads them when they change, see ``tacspeak/hot_reload.py``.
+With LAZY_LOAD, it loads them when their game is in the foreground, see ``tacspeak/lazy_loader.py``.
 """
 
 from __future__ import print_function
@@ -21,6 +23,12 @@ from dragonfly import get_engine
 from dragonfly.loader import CommandModuleDirectory, CommandModule
 from dragonfly.log import default_levels
 
+from tacspeak.latency import LatencyRecorder, DEFAULT_DUMP_PATH, DEFAULT_DUMP_INTERVAL_S
+from tacspeak.action_executor import get_executor, stop_executor
+from tacspeak.hot_reload import HotReloader, DEFAULT_INTERVAL_S
+from tacspeak.lazy_loader import LazyLoader
+from tacspeak.grammar_bundle import install_bundle, report_bundle
+
 # --------------------------------------------------------------------------
 # Main event driving loop.
 
@@ -38,6 +46,31 @@ def main():
     except Exception:
         print("Failed to load `tacspeak/user_settings.py` DEBUG_HEAVY_DUMP_GRAMMAR. Using default settings as fallback.")
         DEBUG_HEAVY_DUMP_GRAMMAR = False
+    try:
+        LATENCY_INSTRUMENTATION = (sys.modules["user_settings"]).LATENCY_INSTRUMENTATION
+        LATENCY_DUMP_PATH = getattr(sys.modules["user_settings"], "LATENCY_DUMP_PATH", DEFAULT_DUMP_PATH)
+        LATENCY_DUMP_INTERVAL_S = getattr(sys.modules["user_settings"], "LATENCY_DUMP_INTERVAL_S", DEFAULT_DUMP_INTERVAL_S)
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` LATENCY_INSTRUMENTATION. Using default settings as fallback.")
+        LATENCY_INSTRUMENTATION = False
+    try:
+        ASYNC_ACTIONS = (sys.modules["user_settings"]).ASYNC_ACTIONS
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` ASYNC_ACTIONS. Using default settings as fallback.")
+        ASYNC_ACTIONS = False
+    try:
+        HOT_RELOAD = (sys.modules["user_settings"]).HOT_RELOAD
+        HOT_RELOAD_INTERVAL_S = getattr(sys.modules["user_settings"], "HOT_RELOAD_INTERVAL_S", DEFAULT_INTERVAL_S)
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` HOT_RELOAD. Using default settings as fallback.")
+        HOT_RELOAD = False
+    try:
+        LAZY_LOAD = (sys.modules["user_settings"]).LAZY_LOAD
+        LAZY_UNLOAD_AFTER_S = getattr(sys.modules["user_settings"], "LAZY_UNLOAD_AFTER_S", None)
+        LAZY_LOAD_INTERVAL_S = getattr(sys.modules["user_settings"], "LAZY_LOAD_INTERVAL_S", DEFAULT_INTERVAL_S)
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` LAZY_LOAD. Using default settings as fallback.")
+        LAZY_LOAD = False
     try:
         KALDI_ENGINE_SETTINGS = (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS
     except Exception:
@@ -107,6 +140,9 @@ def main():
     else:
         setup_loggers()
 
+    # Copy rules compiled when Tacspeak was built into the engine's tmp dir, so they aren't compiled again.
+    bundle_manifest = install_bundle(KALDI_ENGINE_SETTINGS)
+
     # Set any configuration options here as keyword arguments.
     # See Kaldi engine documentation for all available options and more info.
     engine = get_engine('kaldi',**KALDI_ENGINE_SETTINGS)
@@ -116,8 +152,19 @@ def main():
 
     # Load grammars.
     grammar_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/grammar/"))
-    directory = CommandModuleDirectory(grammar_path)
-    directory.load()
+    hot_reloader = None
+    lazy_loader = None
+    if LAZY_LOAD and (HOT_RELOAD or DEBUG_MODE):
+        # DEBUG_MODE grammars are active in any window, and HOT_RELOAD loads every module itself
+        print("LAZY_LOAD is ignored with DEBUG_MODE or HOT_RELOAD, loading every grammar module")
+    if HOT_RELOAD:
+        hot_reloader = HotReloader(engine, grammar_path, user_settings_path, HOT_RELOAD_INTERVAL_S).load()
+        print(f"Hot reload on, checking for changes to grammar modules and user_settings every {HOT_RELOAD_INTERVAL_S}s")
+    elif LAZY_LOAD and not DEBUG_MODE:
+        lazy_loader = LazyLoader(engine, grammar_path, LAZY_UNLOAD_AFTER_S, LAZY_LOAD_INTERVAL_S).load()
+    else:
+        directory = CommandModuleDirectory(grammar_path)
+        directory.load()
 
     handlers = log_handlers()
     log_recognition = logging.getLogger('on_recognition')
@@ -125,9 +172,20 @@ def main():
     log_recognition.addHandler(handlers[1])
     log_recognition.setLevel(20)
 
+    latency_recorder = None
+    if LATENCY_INSTRUMENTATION:
+        latency_recorder = LatencyRecorder(LATENCY_DUMP_PATH, LATENCY_DUMP_INTERVAL_S).install(engine)
+        if ASYNC_ACTIONS:
+            # grammar modules started it on load
+            latency_recorder.executor = get_executor()
+        print(f"Latency instrumentation on, writing to {LATENCY_DUMP_PATH}")
+
     # Define recognition callback functions.
     def on_begin():
-        pass
+        if hot_reloader:
+            hot_reloader.on_begin()
+        if lazy_loader:
+            lazy_loader.on_begin()
 
     def on_recognition(words, results):
         message = f"{results.kaldi_rule} | {' '.join(words)}"
@@ -137,16 +195,30 @@ def main():
         pass
 
     def on_end():
-        pass
+        if hot_reloader:
+            hot_reloader.on_end()
+        if lazy_loader:
+            lazy_loader.on_end()
 
     # Start the engine's main recognition loop
     engine.prepare_for_recognition()
+    if bundle_manifest:
+        report_bundle(bundle_manifest, engine.grammars)
     try:
         print("Ready to listen...")
         engine.do_recognition(on_begin, on_recognition, on_failure, on_end)
     except KeyboardInterrupt:
         pass
 
+    if hot_reloader:
+        hot_reloader.stop()
+    if lazy_loader:
+        lazy_loader.stop()
+    # let queued actions finish
+    stop_executor(timeout=5.0)
+    if latency_recorder:
+        latency_recorder.dump()
+
     # Disconnect from the engine, freeing its resources.
     engine.disconnect()
 
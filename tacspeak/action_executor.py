@@ -0,0 +1,160 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Executes action chains on a dedicated thread, enabled with ``ASYNC_ACTIONS = True`` in
+``tacspeak/user_settings.py``.
+
+A key press like ``Key('f5:down/3.3, f5:up')`` sleeps for a few frames so the game registers it,
+so a command of several keys executed within ``_process_recognition`` blocks the engine's thread,
+and the next utterance, for 100+ ms. Instead, grammar modules ``submit()`` the chain and return.
+
+Chains are executed one at a time in the order they were submitted, except:
+
+    coalesce  a chain submitted with a ``key`` replaces any queued chain with the same key,
+              e.g. a newer order to the same team
+    preempt   a chain submitted with ``preempt=True`` drops every queued chain
+    expire    a chain that has waited more than ``max_wait_s`` is dropped, as it's stale
+
+The chain being executed is never interrupted. Queue wait and execution times are kept per key.
+"""
+
+import collections
+import threading
+import time
+
+from tacspeak.latency import LatencyHistogram, PERCENTILES
+
+DEFAULT_MAX_WAIT_S = 2.0
+
+QueuedAction = collections.namedtuple("QueuedAction", ["action", "data", "key", "submit_time"])
+
+
+class ActionExecutor:
+    """
+    Executes submitted action chains in order on its own thread, see module docstring.
+    """
+    def __init__(self, max_wait_s=DEFAULT_MAX_WAIT_S):
+        self.max_wait_s = max_wait_s
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.running = None
+        self.stopped = False
+        self.histograms = {}
+        self.n_executed = 0
+        self.n_coalesced = 0
+        self.n_preempted = 0
+        self.n_expired = 0
+        self.n_failed = 0
+        self.thread = threading.Thread(target=self.run, name="tacspeak-actions", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, action, key=None, preempt=False, data=None):
+        """
+        Queues `action` to be executed, returning immediately. See module docstring for `key` and `preempt`.
+        """
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("ActionExecutor has been stopped")
+            if preempt:
+                self.n_preempted += len(self.queue)
+                self.queue.clear()
+            elif key is not None and self.queue:
+                n_queued = len(self.queue)
+                self.queue = collections.deque(queued for queued in self.queue if queued.key != key)
+                self.n_coalesced += n_queued - len(self.queue)
+            self.queue.append(QueuedAction(action, data, key, time.perf_counter()))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                queued = self.running = self.queue.popleft()
+            start_time = time.perf_counter()
+            wait_s = start_time - queued.submit_time
+            if self.max_wait_s is not None and wait_s > self.max_wait_s:
+                print(f"Dropped {queued.action}, it waited {wait_s:.2f}s to execute")
+                self.n_expired += 1
+            else:
+                try:
+                    if queued.action.execute(queued.data) is False:
+                        self.n_failed += 1
+                except Exception as e:
+                    print(f"Failed to execute {queued.action}: {e}")
+                    self.n_failed += 1
+                self.n_executed += 1
+                self.add(queued.key, "wait", wait_s)
+                self.add(queued.key, "execute", time.perf_counter() - start_time)
+            with self.condition:
+                self.running = None
+                self.condition.notify_all()
+
+    def add(self, key, stage, seconds):
+        key = "(no key)" if key is None else str(key)
+        histogram = self.histograms.get((key, stage))
+        if histogram is None:
+            histogram = self.histograms.setdefault((key, stage), LatencyHistogram())
+        histogram.add(seconds * 1000.0)
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until every queued chain has been executed, returning False if `timeout` seconds passed first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and self.running is None, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread once the queued chains have been executed.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def summary_lines(self):
+        lines = [f"actions executed={self.n_executed} coalesced={self.n_coalesced} preempted={self.n_preempted}"
+                 + f" expired={self.n_expired} failed={self.n_failed}"]
+        header = f"{'key':<40} {'stage':<8} {'count':>7} {'mean':>9}"
+        header += "".join(f" {'p' + str(p):>9}" for p in PERCENTILES) + f" {'max':>9}"
+        lines.append(header)
+        for (key, stage), histogram in sorted(self.histograms.items()):
+            line = f"{key:<40} {stage:<8} {histogram.count:>7} {histogram.mean():>9.2f}"
+            line += "".join(f" {histogram.percentile(p):>9.2f}" for p in PERCENTILES) + f" {histogram.max_ms:>9.2f}"
+            lines.append(line)
+        return lines
+
+# --------------------------------------------------------------------------
+# The executor shared by grammar modules
+
+_executor = None
+
+def get_executor(max_wait_s=DEFAULT_MAX_WAIT_S):
+    """
+    Returns the shared ActionExecutor, starting it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ActionExecutor(max_wait_s).start()
+    return _executor
+
+def stop_executor(timeout=None):
+    """
+    Stops the shared ActionExecutor (if started), returning it.
+    """
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.stop(timeout)
+    return executor
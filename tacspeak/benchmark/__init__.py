@@ -0,0 +1,11 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Benchmarks for Tacspeak.
+
+Each module can be run on its own, e.g. ``python -m tacspeak.benchmark.calculator``
+"""
@@ -0,0 +1,90 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Benchmark ``ArrayCalculator`` against the reference ``Calculator``.
+
+Checks that both produce the same ``result`` dicts and ``data`` token stats 
+over a synthetic corpus, then times both.
+
+Usage: ``python -m tacspeak.benchmark.calculator [n_utterances] [seed]``
+"""
+
+import random
+import sys
+import time
+
+from tacspeak.calculator import Calculator, ArrayCalculator
+
+
+# --------------------------------------------------------------------------
+# Functions
+
+COMMAND_WORDS = ["blue", "red", "gold", "team", "on", "my", "command", "stack", "up", "split",
+                 "breach", "and", "clear", "use", "flash", "bang", "the", "door", "kick", "it", 
+                 "down", "c", "two", "wedge", "mirror", "under", "fall", "in", "search", "room"]
+
+def make_corpus(n_utterances, min_words, max_words, seed=0):
+    """
+    Returns a list of (ref, hyp) word lists, where hyp is ref with random 
+    substitutions, deletions and insertions.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(n_utterances):
+        ref = [rng.choice(COMMAND_WORDS) for _ in range(rng.randint(min_words, max_words))]
+        hyp = []
+        for word in ref:
+            roll = rng.random()
+            if roll < 0.05:
+                continue
+            elif roll < 0.10:
+                hyp.append(rng.choice(COMMAND_WORDS))
+            elif roll < 0.15:
+                hyp.append(word)
+                hyp.append(rng.choice(COMMAND_WORDS))
+            else:
+                hyp.append(word)
+        corpus.append((ref, hyp))
+    return corpus
+
+def run_calculator(calculator, corpus):
+    results = []
+    start = time.perf_counter()
+    for ref, hyp in corpus:
+        results.append(calculator.calculate(list(ref), list(hyp)))
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+def compare(name, corpus):
+    reference = Calculator()
+    candidate = ArrayCalculator()
+    ref_results, ref_time = run_calculator(reference, corpus)
+    new_results, new_time = run_calculator(candidate, corpus)
+    if ref_results != new_results:
+        raise AssertionError(f"{name}: ArrayCalculator result dicts differ from Calculator")
+    if list(reference.data.items()) != list(candidate.data.items()):
+        raise AssertionError(f"{name}: ArrayCalculator data token stats differ from Calculator")
+    if reference.overall_string() != candidate.overall_string():
+        raise AssertionError(f"{name}: ArrayCalculator overall differs from Calculator")
+    n = max(1, len(corpus))
+    print(f"{name}: n={len(corpus)}"
+          + f" | Calculator {ref_time:.3f}s ({ref_time / n * 1e6:.1f}us/utt)"
+          + f" | ArrayCalculator {new_time:.3f}s ({new_time / n * 1e6:.1f}us/utt)"
+          + f" | speedup x{ref_time / max(new_time, 1e-9):.2f}")
+    return ref_time, new_time
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    n_utterances = int(argv[0]) if len(argv) > 0 else 20000
+    seed = int(argv[1]) if len(argv) > 1 else 0
+    compare("commands (2-12 words)", make_corpus(n_utterances, 2, 12, seed))
+    compare("dictation (20-60 words)", make_corpus(max(1, n_utterances // 20), 20, 60, seed))
+    compare("long dictation (200-400 words)", make_corpus(max(1, n_utterances // 1000), 200, 400, seed))
+
+
+if __name__ == "__main__":
+    main()
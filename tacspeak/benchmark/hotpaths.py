@@ -0,0 +1,247 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Microbenchmarks of Tacspeak's pure-Python hot paths, runnable anywhere (e.g. Linux) as
+dragonfly and kaldi_active_grammar are replaced with ``tacspeak.benchmark.stubs``:
+
+    calculator   ``Calculator``/``ArrayCalculator.calculate``, ``overall`` and ``ranked_worst_to_best_list``
+    readyornot   compiling ``tacspeak/grammar/_readyornot.py``'s key sequences into its action table (as on
+                 load), ``lookup_actions`` of every command and combination of its options, and
+                 ``invert_squash_map`` over its ``map_*`` dicts
+    recognition  ``extract_recognition()``, the extras extraction of ``recognize()``, for each rule
+
+Each case is timed in rounds over its list of calls until ``--time`` seconds have passed, reporting
+the min and median time per call. Allocations are then measured in a separate pass with tracemalloc:
+the blocks and bytes still held per call (e.g. by the returned action chain), and the peak bytes of a call.
+Reports can be written with ``--out`` and compared with a later run with ``--compare``.
+
+Usage: ``python -m tacspeak.benchmark.hotpaths [--filter name] [--time 0.5] [--out report.json] [--compare report.json]``
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+from tacspeak.benchmark import stubs
+from tacspeak.benchmark.calculator import make_corpus
+from tacspeak.calculator import Calculator, ArrayCalculator
+from tacspeak.key_sequences import compile_key_sequences
+
+REPORT_VERSION = 1
+MIN_ROUNDS = 5
+READYORNOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "grammar", "_readyornot.py")
+
+
+# --------------------------------------------------------------------------
+# Cases, each a (name, call, args_list)
+
+def calculator_cases(n_utterances=2000, seed=0):
+    corpus = make_corpus(n_utterances, 2, 12, seed)
+    dictation_corpus = make_corpus(max(1, n_utterances // 20), 20, 60, seed)
+    cases = []
+    for calculator_class in (Calculator, ArrayCalculator):
+        name = calculator_class.__name__
+        # calculate() pads its inputs, so each call gets a copy
+        calculator = calculator_class()
+        cases.append((f"{name}.calculate (commands)",
+                      lambda ref, hyp, calculator=calculator: calculator.calculate(list(ref), list(hyp)), corpus))
+        calculator = calculator_class()
+        cases.append((f"{name}.calculate (dictation)",
+                      lambda ref, hyp, calculator=calculator: calculator.calculate(list(ref), list(hyp)), dictation_corpus))
+    calculator = Calculator()
+    for ref, hyp in corpus:
+        calculator.calculate(list(ref), list(hyp))
+    cases.append(("Calculator.overall", calculator.overall, [()] * 100))
+    cases.append(("Calculator.ranked_worst_to_best_list", calculator.ranked_worst_to_best_list, [()] * 100))
+    return cases
+
+def load_readyornot():
+    """
+    Returns the _readyornot grammar module, loaded with stubbed dragonfly (see stubs.install()).
+    """
+    spec = importlib.util.spec_from_file_location("_readyornot", READYORNOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # it prints its key bindings on load
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+def readyornot_cases(module):
+    compile_actions = lambda: compile_key_sequences(module.key_sequences_spec, module.ingame_key_bindings).build(module.make_actions)
+    cases = [("compile_key_sequences", compile_actions, [()])]
+    maps = [(value,) for name, value in vars(module).items() if name.startswith("map_") and isinstance(value, dict)
+            and name != "map_ingame_key_bindings"]
+    cases.append(("invert_squash_map", module.invert_squash_map, maps))
+    cases.append(("lookup_actions", module.lookup_actions, list(module.action_table)))
+    return cases
+
+class StubNode:
+    """
+    Stands in for a recognition's node, with a child node per spoken extra.
+    """
+    def __init__(self, values):
+        self.children = {name: StubNode.Child(value) for name, value in values.items()}
+
+    def get_child_by_name(self, name, shallow=False):
+        return self.children.get(name)
+
+    class Child:
+        def __init__(self, value):
+            self._value = value
+
+        def value(self):
+            return self._value
+
+def first_value(element):
+    choices = getattr(getattr(element, "_child", element), "_choices", None)
+    if isinstance(choices, dict):
+        key, value = next(iter(choices.items()))
+        return key if value is None else value
+    if choices:
+        return choices[0]
+    return "words"
+
+def recognition_cases(module, test_model):
+    """
+    Returns a case of extract_recognition() for each of `module`'s rules, recognised with all of its
+    extras spoken, and with none (so they fall back to defaults).
+    """
+    from tacspeak.shared_rules import expand_rules
+    recog_buffers = []
+    for rule in expand_rules(module.grammar.rules + module.grammar_priority.rules):
+        extras = getattr(rule, "_extras", {})
+        spoken = {name: first_value(element) for name, element in extras.items()}
+        for values in (spoken, {}):
+            recog_buffers.append((["words"] * 6, None, rule, StubNode(values)))
+    return [("extract_recognition", test_model.extract_recognition, [(recog_buffer,) for recog_buffer in recog_buffers])]
+
+def build_cases():
+    stubs.install()
+    import tacspeak.test_model as test_model
+    readyornot = load_readyornot()
+    return calculator_cases() + readyornot_cases(readyornot) + recognition_cases(readyornot, test_model)
+
+# --------------------------------------------------------------------------
+# Measuring
+
+def time_calls(call, args_list, min_time_s):
+    """
+    Returns the ns per call of each round of calling `call(*args)` for each of `args_list`.
+    """
+    rounds = []
+    start = time.perf_counter()
+    while len(rounds) < MIN_ROUNDS or time.perf_counter() - start < min_time_s:
+        round_start = time.perf_counter_ns()
+        for args in args_list:
+            call(*args)
+        rounds.append((time.perf_counter_ns() - round_start) / len(args_list))
+    return rounds
+
+def measure_allocations(call, args_list):
+    """
+    Returns the blocks and bytes allocated and still held per call (results are kept), and
+    the peak bytes of any one call.
+    """
+    results = [None] * len(args_list)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        peak_bytes = 0
+        for i, args in enumerate(args_list):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            results[i] = call(*args)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - current)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename')
+    n = len(args_list)
+    return {
+        'alloc_blocks': sum(stat.count_diff for stat in stats) / n,
+        'alloc_bytes': sum(stat.size_diff for stat in stats) / n,
+        'peak_bytes': peak_bytes,
+    }
+
+def run(cases, min_time_s=0.5, name_filter=None):
+    results = {}
+    for name, call, args_list in cases:
+        if name_filter and name_filter not in name:
+            continue
+        # warm up
+        for args in args_list:
+            call(*args)
+        rounds = time_calls(call, args_list, min_time_s)
+        # the first traced pass also counts one-off allocations, e.g. of interned strings
+        measure_allocations(call, args_list)
+        results[name] = {'calls': len(args_list), 'rounds': len(rounds),
+                         'min_ns': min(rounds), 'median_ns': statistics.median(rounds),
+                         **measure_allocations(call, args_list)}
+        print(format_result(name, results[name]))
+    return {
+        'version': REPORT_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+def header():
+    return (f"{'case':<44} {'calls':>6} {'min us':>10} {'median us':>10}"
+            + f" {'blocks':>8} {'bytes':>10} {'peak bytes':>11}")
+
+def format_result(name, result):
+    return (f"{name:<44} {result['calls']:>6} {result['min_ns'] / 1000:>10.2f} {result['median_ns'] / 1000:>10.2f}"
+            + f" {result['alloc_blocks']:>8.1f} {result['alloc_bytes']:>10.0f} {result['peak_bytes']:>11}")
+
+def compare(report, previous):
+    """
+    Prints the change in median time and held bytes per call of each case from the `previous` report.
+    """
+    print(f"\nCompared to {previous['created']} (python {previous['python']})")
+    for name, result in report['results'].items():
+        old = previous['results'].get(name)
+        if old is None:
+            print(f"{name:<44} not in previous report")
+            continue
+        time_change = result['median_ns'] / max(old['median_ns'], 1e-9) - 1.0
+        print(f"{name:<44} median {old['median_ns'] / 1000:.2f} -> {result['median_ns'] / 1000:.2f}us ({time_change:+.1%})"
+              + f" bytes {old['alloc_bytes']:.0f} -> {result['alloc_bytes']:.0f}"
+              + f" blocks {old['alloc_blocks']:.1f} -> {result['alloc_blocks']:.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmark Tacspeak's pure-Python hot paths.")
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this')
+    parser.add_argument('--time', type=float, default=0.5, help='min seconds to time each case for')
+    parser.add_argument('--out', default=None, help='write the report to this json file')
+    parser.add_argument('--compare', default=None, help='compare to a report written by --out')
+    args = parser.parse_args(argv)
+
+    print(header())
+    report = run(build_cases(), args.time, args.filter)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous.get('version') != REPORT_VERSION:
+            print(f"Can't compare to {args.compare}, it is version {previous.get('version')} not {REPORT_VERSION}")
+        else:
+            compare(report, previous)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+End-to-end latency benchmark of the live recognition path, the latency counterpart to ``--test_model``.
+
+Replays test audio (a retain.tsv or corpus file) through ``engine.do_recognition()`` in real time,
+one clip at a time, with the active grammar modules loaded. The end of each clip stands in for
+releasing the listen key, and is timed to the recognition callback and to the first action
+being executed (actions only print, as ``initialize_kaldi`` sets DEBUG_MODE). The engine's VAD
+still runs, so a phrase can end on silence before its clip does. Such clips, recognised before
+their audio ended, aren't timed, and are counted as ended early. Percentiles are
+reported per rule, with each rule of a ``SharedPrefixRule`` reported on its own, followed by the
+per-stage breakdown from ``tacspeak.latency``.
+
+Usage: ``python -m tacspeak.benchmark.replay tsv_file model_dir [lexicon_file] [--limit N] [--out report.json]``
+"""
+
+import argparse
+import json
+import time
+
+import tacspeak.test_model as tm
+from tacspeak.latency import LatencyHistogram, LatencyRecorder, PERCENTILES
+
+
+# --------------------------------------------------------------------------
+# Functions
+
+def timed_blocks(wav_path, recorder):
+    """
+    Yields the audio blocks of `wav_path` in real time, marking "audio_end" on `recorder`
+    when the last block has been consumed, i.e. when the listen key would be released.
+    """
+    for block in tm.read_audio_blocks(wav_path, realtime=True):
+        if block is None:
+            recorder.mark("audio_end")
+        yield block
+
+class ReplayStats:
+    """
+    Latency histograms per rule (and overall) from the end of audio to recognition and to action dispatch.
+    """
+    MEASURES = (("recognition", "recognized"), ("dispatch", "execute_start"))
+
+    def __init__(self):
+        self.histograms = {}
+        self.n_timed_out = 0
+        self.n_unrecognized = 0
+        self.n_ended_early = 0
+
+    def add(self, rule_key, marks):
+        audio_end = marks.get("audio_end")
+        # if VAD ended the phrase, it may be recognised before the clip ends, or the clip's end never read
+        if audio_end is None or any(marks[mark] < audio_end for _, mark in self.MEASURES if mark in marks):
+            self.n_ended_early += 1
+            return
+        for name, mark in self.MEASURES:
+            if mark not in marks:
+                continue
+            ms = (marks[mark] - audio_end) * 1000.0
+            for key in (rule_key, "(all rules)"):
+                self.histograms.setdefault((key, name), LatencyHistogram()).add(ms)
+
+    def summary_lines(self):
+        header = f"{'rule':<40} {'to':<12} {'count':>7} {'mean':>9}"
+        header += "".join(f" {'p' + str(p):>9}" for p in PERCENTILES) + f" {'max':>9}"
+        lines = [header]
+        for (rule, name), histogram in sorted(self.histograms.items()):
+            line = f"{rule:<40} {name:<12} {histogram.count:>7} {histogram.mean():>9.2f}"
+            line += "".join(f" {histogram.percentile(p):>9.2f}" for p in PERCENTILES) + f" {histogram.max_ms:>9.2f}"
+            lines.append(line)
+        return lines
+
+    def to_dict(self):
+        return {
+            'timed_out': self.n_timed_out,
+            'unrecognized': self.n_unrecognized,
+            'ended_early': self.n_ended_early,
+            'latency_ms': {f"{rule} | {name}": {'count': h.count, 'mean': h.mean(), 'max': h.max_ms,
+                                                **{f"p{p}": h.percentile(p) for p in PERCENTILES}}
+                           for (rule, name), h in sorted(self.histograms.items())},
+        }
+
+def replay(tsv_file, model_dir, lexicon_file=None, limit=None, timeout=tm.RECOGNITION_TIMEOUT_S):
+    """
+    Replays the audio in `tsv_file` (see module docstring), returning (ReplayStats, LatencyRecorder).
+    """
+    submissions = tm.read_test_submissions(tsv_file, lexicon_file)
+    if limit:
+        submissions = submissions[:limit]
+    engine = tm.initialize_kaldi(model_dir, audio_input_device=False)
+    recorder = LatencyRecorder(dump_interval_s=float("inf")).install(engine)
+    waiter = tm.get_recognition_waiter()
+    stats = ReplayStats()
+
+    start_time = time.perf_counter()
+    for i, (wav_path, text) in enumerate(submissions):
+        waiter.reset()
+        engine.do_recognition(audio_iter=timed_blocks(wav_path, recorder))
+        if not waiter.wait(timeout):
+            print(f"Timed out after {timeout}s waiting for recognition of {wav_path}")
+            stats.n_timed_out += 1
+            continue
+        if recorder.rule_key is None:
+            stats.n_unrecognized += 1
+            continue
+        # the recorder keys a SharedPrefixRule's recognitions by the rule spoken, e.g. ReadyOrNot/StackUp
+        stats.add("/".join(recorder.rule_key), recorder.marks)
+        if (i + 1) % 100 == 0:
+            print(f"Replayed {i + 1}/{len(submissions)} clips in {time.perf_counter() - start_time:.0f}s")
+    tm.release_kaldi(engine)
+    return stats, recorder
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay test audio through the live recognition path, and report latency.')
+    parser.add_argument('tsv_file')
+    parser.add_argument('model_dir')
+    parser.add_argument('lexicon_file', nargs='?', default=None)
+    parser.add_argument('--limit', type=int, default=None, help='replay at most this many clips')
+    parser.add_argument('--timeout', type=float, default=tm.RECOGNITION_TIMEOUT_S,
+                        help='max seconds to wait for each recognition after its audio ends')
+    parser.add_argument('--out', default=None, help='also write the report to this json file')
+    args = parser.parse_args(argv)
+
+    stats, recorder = replay(args.tsv_file, args.model_dir, args.lexicon_file, args.limit, args.timeout)
+    print(f"\nLatency (ms) from end of audio, {stats.n_timed_out} timed out, {stats.n_unrecognized} not recognised,"
+          + f" {stats.n_ended_early} ended early by VAD (not timed)")
+    print("\n".join(stats.summary_lines()))
+    print("\nLatency (ms) by stage")
+    print("\n".join(recorder.summary_lines()))
+    if args.out:
+        report = stats.to_dict()
+        report['tsv_file'] = args.tsv_file
+        report['model_dir'] = args.model_dir
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
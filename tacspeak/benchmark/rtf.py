@@ -0,0 +1,237 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Decoding speed benchmark, with a stored baseline to catch regressions from a new model,
+``decoder_init_config`` or grammar change.
+
+Decodes a fixed corpus (a retain.tsv or corpus file) with the grammar engine and with
+``PlainDictationRecognizer``, for each worker count, and reports wall time, worker CPU time,
+real-time factor (time per second of audio) and peak RSS of the workers. Results are saved
+to a JSON baseline, which later runs are compared against: a run fails if any CPU real-time
+factor is more than ``threshold`` (a fraction) slower than its baseline.
+
+Usage: ``cli.py --benchmark tsv_file model_dir`` (see ``--benchmark_*`` options), or
+``python -m tacspeak.benchmark.rtf tsv_file model_dir [--workers 1,2,4] [--baseline path] [--threshold 0.1] [--update]``
+"""
+
+import argparse
+import ctypes
+import hashlib
+import json
+import os
+import sys
+import time
+
+import tacspeak
+import tacspeak.test_model as tm
+from tacspeak.corpus import audio_duration_s, read_pcm
+from tacspeak.result_cache import fingerprint_model_dir
+
+BASELINE_VERSION = 1
+DEFAULT_BASELINE_PATH = "./benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_WORKERS = (1,)
+MODES = ("grammar", "dictation")
+
+
+# --------------------------------------------------------------------------
+# Functions
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of this process in MB.
+    """
+    if os.name == 'nt':
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / 2**20
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+def decode_chunk_grammar(audio_paths):
+    return decode_chunk(audio_paths, lambda audio_path: tm.recognize(audio_path, "", reference=tm.NO_REFERENCE))
+
+def decode_chunk_dictation(audio_paths):
+    return decode_chunk(audio_paths, lambda audio_path: tm.call_recognizer(read_pcm(audio_path)))
+
+def decode_chunk(audio_paths, decode):
+    """
+    Decodes each of `audio_paths`, returning this worker's timing.
+    """
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for audio_path in audio_paths:
+        decode(audio_path)
+    return {'pid': os.getpid(), 'n': len(audio_paths), 'cpu_s': time.process_time() - cpu_start,
+            'wall_s': time.perf_counter() - wall_start, 'peak_rss_mb': peak_rss_mb()}
+
+# --------------------------------------------------------------------------
+# Benchmark
+
+def corpus_info(tsv_file, audio_paths):
+    return {
+        'path': tsv_file,
+        'n_clips': len(audio_paths),
+        'audio_s': sum(audio_duration_s(audio_path) for audio_path in audio_paths),
+        'sha1': hashlib.sha1("\n".join(audio_paths).encode('utf-8')).hexdigest(),
+    }
+
+def run_mode(mode, audio_paths, model_dir, num_workers, audio_s, warm_pool=False):
+    """
+    Decodes `audio_paths` with `num_workers` worker processes, each decoding an equal share.
+    Returns the results dict of one benchmark entry.
+    """
+    warm_pool = tm.check_warm_pool(warm_pool)
+    engine = None
+    if mode == "grammar":
+        initializer, worker = tm.initialize_kaldi, decode_chunk_grammar
+        # initialize first, pre-compiling the model and grammars for the workers
+        engine = tm.initialize_kaldi(model_dir, audio_input_device=False if warm_pool else None)
+        if not warm_pool:
+            tm.release_kaldi(engine)
+            engine = None
+    else:
+        initializer, worker = tm.initialize_kaldi_dictation, decode_chunk_dictation
+        tm.initialize_kaldi_dictation(model_dir)
+
+    chunks = [audio_paths[i::num_workers] for i in range(num_workers)]
+    with tm.start_pool(num_workers, initializer, (model_dir,), warm_pool) as pool:
+        # warm up each worker (and the page cache) before timing
+        pool.map(worker, [audio_paths[:1]] * num_workers, chunksize=1)
+        wall_start = time.perf_counter()
+        worker_results = pool.map(worker, chunks, chunksize=1)
+        wall_s = time.perf_counter() - wall_start
+    if engine:
+        tm.release_kaldi(engine)
+
+    cpu_s = sum(result['cpu_s'] for result in worker_results)
+    return {
+        'mode': mode,
+        'workers': num_workers,
+        'wall_s': wall_s,
+        'cpu_s': cpu_s,
+        'rtf_wall': wall_s / max(audio_s, 1e-9),
+        'rtf_cpu': cpu_s / max(audio_s, 1e-9),
+        'peak_rss_mb': max(result['peak_rss_mb'] for result in worker_results),
+    }
+
+def run_benchmark(tsv_file, model_dir, workers=DEFAULT_WORKERS, lexicon_file=None, warm_pool=False):
+    """
+    Returns the benchmark results of decoding `tsv_file` in each mode, for each worker count.
+    """
+    audio_paths = [wav_path for wav_path, text in tm.read_test_submissions(tsv_file, lexicon_file)]
+    corpus = corpus_info(tsv_file, audio_paths)
+    print(f"Benchmarking {corpus['n_clips']} clips ({corpus['audio_s']:.1f}s of audio) with workers {list(workers)}")
+    results = {}
+    for mode in MODES:
+        for num_workers in workers:
+            entry = run_mode(mode, audio_paths, model_dir, num_workers, corpus['audio_s'], warm_pool)
+            results[f"{mode}|{num_workers}"] = entry
+            print(format_entry(entry))
+    return {
+        'version': BASELINE_VERSION,
+        'tacspeak_version': tacspeak.__version__,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'model_dir': model_dir,
+        'model_fingerprint': fingerprint_model_dir(model_dir),
+        'corpus': corpus,
+        'results': results,
+    }
+
+def format_entry(entry):
+    return (f"{entry['mode']:<10} workers={entry['workers']:<3} wall={entry['wall_s']:8.2f}s cpu={entry['cpu_s']:8.2f}s"
+            + f" rtf_wall={entry['rtf_wall']:.4f} rtf_cpu={entry['rtf_cpu']:.4f} peak_rss={entry['peak_rss_mb']:.0f}MB")
+
+# --------------------------------------------------------------------------
+# Baseline
+
+def load_baseline(baseline_path):
+    if not os.path.isfile(baseline_path):
+        return None
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION:
+        print(f"Ignoring baseline {baseline_path}, it is version {baseline.get('version')} not {BASELINE_VERSION}")
+        return None
+    return baseline
+
+def save_baseline(report, baseline_path):
+    with open(baseline_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved baseline to {baseline_path}")
+
+def compare_to_baseline(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Prints the change in real-time factor of each entry from `baseline`, returning the list of
+    regressions, i.e. entries whose rtf_cpu is more than `threshold` slower.
+    """
+    if baseline['corpus']['sha1'] != report['corpus']['sha1']:
+        print("Warning: the baseline was measured on a different corpus, results may not be comparable")
+    regressions = []
+    for key, entry in report['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            print(f"{key:<14} not in baseline")
+            continue
+        change = entry['rtf_cpu'] / max(base['rtf_cpu'], 1e-9) - 1.0
+        wall_change = entry['rtf_wall'] / max(base['rtf_wall'], 1e-9) - 1.0
+        regressed = change > threshold
+        print(f"{key:<14} rtf_cpu {base['rtf_cpu']:.4f} -> {entry['rtf_cpu']:.4f} ({change:+.1%})"
+              + f" rtf_wall {base['rtf_wall']:.4f} -> {entry['rtf_wall']:.4f} ({wall_change:+.1%})"
+              + f" peak_rss {base['peak_rss_mb']:.0f} -> {entry['peak_rss_mb']:.0f}MB"
+              + (" REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+def benchmark(tsv_file, model_dir, workers=DEFAULT_WORKERS, baseline_path=DEFAULT_BASELINE_PATH,
+              threshold=DEFAULT_THRESHOLD, update=False, lexicon_file=None, warm_pool=False):
+    """
+    Runs the benchmark and compares it to the baseline at `baseline_path`, which is created if it
+    doesn't exist, or replaced if `update`. Returns True if there was no regression.
+    """
+    report = run_benchmark(tsv_file, model_dir, workers, lexicon_file, warm_pool)
+    baseline = load_baseline(baseline_path)
+    regressions = []
+    if baseline is not None:
+        print(f"\nCompared to baseline {baseline_path} ({baseline['created']}, threshold {threshold:.0%})")
+        regressions = compare_to_baseline(report, baseline, threshold)
+    if baseline is None or update:
+        save_baseline(report, baseline_path)
+    if regressions:
+        print(f"FAILED: {len(regressions)} regression(s): {', '.join(regressions)}")
+        return False
+    return True
+
+def parse_workers(workers):
+    return tuple(max(1, int(n)) for n in str(workers).split(",") if n.strip())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark decoding speed against a stored baseline.')
+    parser.add_argument('tsv_file')
+    parser.add_argument('model_dir')
+    parser.add_argument('--workers', default="1", help='comma separated worker counts, e.g. 1,2,4')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--update', action='store_true', help='replace the baseline with this run')
+    args = parser.parse_args(argv)
+    ok = benchmark(args.tsv_file, args.model_dir, parse_workers(args.workers), args.baseline, args.threshold, args.update)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
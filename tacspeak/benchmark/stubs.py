@@ -0,0 +1,240 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Stand-in ``dragonfly`` and ``kaldi_active_grammar`` modules, so grammar modules and
+``tacspeak.test_model`` can be imported, and their pure-Python code benchmarked, without
+an engine or a Windows keyboard (e.g. on Linux).
+
+Actions aggregate like dragonfly's: ``a + b`` makes an ``ActionSeries``, and ``+=`` on a
+series appends to it and rebuilds its string, so building action chains costs about the same.
+Executing an action does nothing. Grammars, rules and elements only keep what they're given,
+enough for ``extract_recognition()``.
+
+Call install() before importing anything that imports dragonfly. It's only meant for
+benchmark processes, it replaces the real modules if they're installed.
+"""
+
+import sys
+import types
+
+
+# --------------------------------------------------------------------------
+# Actions
+
+class ActionBase:
+    def __init__(self):
+        self._str = ""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._str})"
+
+    def __add__(self, other):
+        return ActionSeries(self, other)
+
+    def __iadd__(self, other):
+        return ActionSeries(self, other)
+
+    def execute(self, data=None):
+        return True
+
+class ActionSeries(ActionBase):
+    def __init__(self, *actions):
+        ActionBase.__init__(self)
+        self._actions = list(actions)
+        self._set_str()
+
+    def _set_str(self):
+        self._str = ", ".join(str(a) for a in self.flat_action_list())
+
+    def flat_action_list(self):
+        result = []
+        for action in self._actions:
+            if isinstance(action, ActionSeries):
+                result.extend(action.flat_action_list())
+            else:
+                result.append(action)
+        return result
+
+    def append(self, other):
+        self._actions.append(other)
+        self._set_str()
+
+    def __iadd__(self, other):
+        self.append(other)
+        return self
+
+class Key(ActionBase):
+    def __init__(self, spec=None, static=False):
+        ActionBase.__init__(self)
+        self._str = str(spec)
+
+class Mouse(Key):
+    pass
+
+class Text(Key):
+    pass
+
+class Function(ActionBase):
+    def __init__(self, function, remap_data=None, **defaults):
+        ActionBase.__init__(self)
+        self._function = function
+        self._defaults = defaults
+        self._str = getattr(function, "__name__", "")
+
+# --------------------------------------------------------------------------
+# Elements, rules and grammars
+
+class Element:
+    def __init__(self, *args, name=None, default=None, **kwargs):
+        self.name = name
+        self.default = default
+
+    def has_default(self):
+        return self.default is not None
+
+class Choice(Element):
+    def __init__(self, name, choices, extra=None, default=None):
+        Element.__init__(self, name=name, default=default)
+        # as dragonfly does
+        if isinstance(choices, (list, tuple)):
+            choices = {choice: None for choice in choices}
+        self._choices = choices
+
+class Optional(Element):
+    def __init__(self, child, name=None, default=None):
+        Element.__init__(self, name=name, default=default)
+        self._child = child
+
+class Dictation(Element):
+    def __init__(self, name=None, format=True, default=None):
+        Element.__init__(self, name=name, default=default)
+
+class IntegerRef(Element):
+    def __init__(self, name, min, max, default=None):
+        Element.__init__(self, name=name, default=default)
+
+class Rule:
+    def __init__(self, name=None, element=None, context=None, imported=False, exported=True):
+        self.name = name or self.__class__.__name__
+        self.grammar = None
+
+class BasicRule(Rule):
+    pass
+
+class CompoundRule(Rule):
+    spec = None
+    extras = ()
+    defaults = {}
+
+    def __init__(self, name=None, spec=None, extras=None, defaults=None, exported=None, context=None):
+        Rule.__init__(self, name)
+        self.spec = spec or self.spec
+        self._extras = {element.name: element for element in (self.extras if extras is None else extras)}
+        self._defaults = dict(self.defaults if defaults is None else defaults)
+
+class MappingRule(CompoundRule):
+    mapping = {}
+
+class Grammar:
+    def __init__(self, name, description=None, context=None, engine=None):
+        self.name = name
+        self.rules = []
+
+    def add_rule(self, rule):
+        rule.grammar = self
+        self.rules.append(rule)
+
+    def load(self):
+        pass
+
+    def unload(self):
+        pass
+
+class RecognitionObserver:
+    def register(self):
+        pass
+
+    def unregister(self):
+        pass
+
+class AppContext:
+    def __init__(self, *args, **kwargs):
+        pass
+
+class CommandModule:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        pass
+
+    def unload(self):
+        pass
+
+class CommandModuleDirectory(CommandModule):
+    def __init__(self, path, excludes=None):
+        CommandModule.__init__(self, path)
+
+class KaldiRule:
+    pass
+
+class WavAudio:
+    pass
+
+class PlainDictationRecognizer:
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("PlainDictationRecognizer isn't available with stubbed modules")
+
+def get_engine(name=None, **kwargs):
+    raise RuntimeError("There is no engine with stubbed modules")
+
+def do_nothing(*args, **kwargs):
+    pass
+
+# --------------------------------------------------------------------------
+# Installing
+
+def make_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    def __getattr__(attribute):
+        # anything else that's imported is a plain element
+        if attribute.startswith("__"):
+            raise AttributeError(attribute)
+        return Element
+    module.__getattr__ = __getattr__
+    return module
+
+def install():
+    """
+    Installs the stand-in modules in sys.modules.
+    """
+    actions = dict(ActionBase=ActionBase, ActionSeries=ActionSeries, Key=Key, Mouse=Mouse, Text=Text, Function=Function)
+    grammar = dict(Element=Element, Choice=Choice, Optional=Optional, Dictation=Dictation, IntegerRef=IntegerRef,
+                   Rule=Rule, BasicRule=BasicRule, CompoundRule=CompoundRule, MappingRule=MappingRule,
+                   Grammar=Grammar, RecognitionObserver=RecognitionObserver, AppContext=AppContext)
+    callbacks = {f"register_{when}_callback": do_nothing
+                 for when in ("beginning", "recognition", "post_recognition", "failure", "ending")}
+    modules = {
+        "dragonfly": make_module("dragonfly", get_engine=get_engine, **actions, **grammar),
+        "dragonfly.actions": make_module("dragonfly.actions", **actions),
+        "dragonfly.actions.action_base": make_module("dragonfly.actions.action_base", **actions),
+        "dragonfly.grammar": make_module("dragonfly.grammar", **grammar),
+        "dragonfly.grammar.rule_compound": make_module("dragonfly.grammar.rule_compound", CompoundRule=CompoundRule),
+        "dragonfly.grammar.recobs_callbacks": make_module("dragonfly.grammar.recobs_callbacks", **callbacks),
+        "dragonfly.loader": make_module("dragonfly.loader", CommandModule=CommandModule,
+                                        CommandModuleDirectory=CommandModuleDirectory),
+        "dragonfly.log": make_module("dragonfly.log", default_levels={}),
+        "dragonfly.engines": make_module("dragonfly.engines"),
+        "dragonfly.engines.backend_kaldi": make_module("dragonfly.engines.backend_kaldi"),
+        "dragonfly.engines.backend_kaldi.audio": make_module("dragonfly.engines.backend_kaldi.audio", WavAudio=WavAudio),
+        "kaldi_active_grammar": make_module("kaldi_active_grammar", KaldiRule=KaldiRule,
+                                            PlainDictationRecognizer=PlainDictationRecognizer,
+                                            disable_donation_message=do_nothing),
+    }
+    sys.modules.update(modules)
+    return modules
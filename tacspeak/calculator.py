@@ -0,0 +1,352 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Word error rate (WER) scoring for test_model.
+
+``Calculator`` is the reference dict-per-cell implementation. 
+``ArrayCalculator`` is a drop-in replacement which produces the same 
+``result`` dicts and ``data`` token stats, but stores the edit-distance 
+matrix in compact integer arrays and a byte-coded backtrace.
+"""
+
+import sys
+import math
+from array import array
+
+import numpy as np
+
+
+# --------------------------------------------------------------------------
+# Functions
+
+# Adapted from daanzu/kaldi_ag_training, licensed under the AGPL-3.0
+# From wenet-e2e/wenet, licensed under the Apache License 2.0
+class Calculator:
+    def __init__(self) :
+        self.data = {}
+        self.space = []
+        self.cost = {}
+        self.cost['cor'] = 0
+        self.cost['sub'] = 1
+        self.cost['del'] = 1
+        self.cost['ins'] = 1
+    def calculate(self, lab, rec) :
+        # Initialization
+        lab.insert(0, '')
+        rec.insert(0, '')
+        while len(self.space) < len(lab) :
+            self.space.append([])
+        for row in self.space :
+            for element in row :
+                element['dist'] = 0
+                element['error'] = 'non'
+            while len(row) < len(rec) :
+                row.append({'dist' : 0, 'error' : 'non'})
+        for i in range(len(lab)) :
+            self.space[i][0]['dist'] = i
+            self.space[i][0]['error'] = 'del'
+        for j in range(len(rec)) :
+            self.space[0][j]['dist'] = j
+            self.space[0][j]['error'] = 'ins'
+        self.space[0][0]['error'] = 'non'
+        for token in lab :
+            if token not in self.data and len(token) > 0 :
+                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
+        for token in rec :
+            if token not in self.data and len(token) > 0 :
+                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
+        # Computing edit distance
+        for i, lab_token in enumerate(lab) :
+            for j, rec_token in enumerate(rec) :
+                if i == 0 or j == 0 :
+                    continue
+                min_dist = sys.maxsize
+                min_error = 'none'
+                dist = self.space[i-1][j]['dist'] + self.cost['del']
+                error = 'del'
+                if dist < min_dist :
+                    min_dist = dist
+                    min_error = error
+                dist = self.space[i][j-1]['dist'] + self.cost['ins']
+                error = 'ins'
+                if dist < min_dist :
+                    min_dist = dist
+                    min_error = error
+                if lab_token == rec_token :
+                    dist = self.space[i-1][j-1]['dist'] + self.cost['cor']
+                    error = 'cor'
+                else :
+                    dist = self.space[i-1][j-1]['dist'] + self.cost['sub']
+                    error = 'sub'
+                if dist < min_dist :
+                    min_dist = dist
+                    min_error = error
+                self.space[i][j]['dist'] = min_dist
+                self.space[i][j]['error'] = min_error
+        # Tracing back
+        result = {'lab':[], 'rec':[], 'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
+        i = len(lab) - 1
+        j = len(rec) - 1
+        while True :
+            if self.space[i][j]['error'] == 'cor' : # correct
+                if len(lab[i]) > 0 :
+                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
+                    self.data[lab[i]]['cor'] = self.data[lab[i]]['cor'] + 1
+                    result['all'] = result['all'] + 1
+                    result['cor'] = result['cor'] + 1
+                result['lab'].insert(0, lab[i])
+                result['rec'].insert(0, rec[j])
+                i = i - 1
+                j = j - 1
+            elif self.space[i][j]['error'] == 'sub' : # substitution
+                if len(lab[i]) > 0 :
+                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
+                    self.data[lab[i]]['sub'] = self.data[lab[i]]['sub'] + 1
+                    result['all'] = result['all'] + 1
+                    result['sub'] = result['sub'] + 1
+                result['lab'].insert(0, lab[i])
+                result['rec'].insert(0, rec[j])
+                i = i - 1
+                j = j - 1
+            elif self.space[i][j]['error'] == 'del' : # deletion
+                if len(lab[i]) > 0 :
+                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
+                    self.data[lab[i]]['del'] = self.data[lab[i]]['del'] + 1
+                    result['all'] = result['all'] + 1
+                    result['del'] = result['del'] + 1
+                result['lab'].insert(0, lab[i])
+                result['rec'].insert(0, "")
+                i = i - 1
+            elif self.space[i][j]['error'] == 'ins' : # insertion
+                if len(rec[j]) > 0 :
+                    self.data[rec[j]]['ins'] = self.data[rec[j]]['ins'] + 1
+                    result['ins'] = result['ins'] + 1
+                result['lab'].insert(0, "")
+                result['rec'].insert(0, rec[j])
+                j = j - 1
+            elif self.space[i][j]['error'] == 'non' : # starting point
+                break
+            else : # shouldn't reach here
+                print('this should not happen , i = {i} , j = {j} , error = {error}'.format(i = i, j = j, error = self.space[i][j]['error']))
+        return result
+    def overall(self) :
+        result = {'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
+        for token in self.data :
+            result['all'] = result['all'] + self.data[token]['all']
+            result['cor'] = result['cor'] + self.data[token]['cor']
+            result['sub'] = result['sub'] + self.data[token]['sub']
+            result['ins'] = result['ins'] + self.data[token]['ins']
+            result['del'] = result['del'] + self.data[token]['del']
+        return result
+    def overall_string(self):
+        out_string = ''
+        result = self.overall()
+        if result['all'] != 0 :
+            wer = float(result['ins'] + result['sub'] + result['del']) * 100.0 / result['all']
+        else :
+            wer = 0.0
+        out_string += str('Overall -> %4.2f %%' % wer)
+        out_string += str('+/- %4.2f %%' % er_margin_of_error(wer, n=result['all']))
+        out_string += str('N=%d C=%d S=%d D=%d I=%d' % (result['all'], result['cor'], result['sub'], result['del'], result['ins']))
+        return out_string
+
+    def cluster(self, data) :
+        result = {'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
+        for token in data :
+            if token in self.data :
+                result['all'] = result['all'] + self.data[token]['all']
+                result['cor'] = result['cor'] + self.data[token]['cor']
+                result['sub'] = result['sub'] + self.data[token]['sub']
+                result['ins'] = result['ins'] + self.data[token]['ins']
+                result['del'] = result['del'] + self.data[token]['del']
+        return result
+    def keys(self) :
+        return list(self.data.keys())
+    def ranked_worst_to_best_list(self) :
+        ranked_worst_tokens = []
+        for key, value in self.data.items():
+            token = key
+            n_errors = value['sub'] + value['del'] + value['ins']
+            n_correct = value['cor']
+            n_all = value['all']
+            rate_errors = float(n_errors) / float(max(1, n_all))
+            entry = {'token':token, 'rate_errors':rate_errors, 'n_errors':n_errors, 
+                     'n_correct':n_correct, 'n_all':n_all}
+            ranked_worst_tokens.append(entry)
+        ranked_worst_tokens.sort(key=lambda x: x['rate_errors'], reverse=True)
+        return ranked_worst_tokens
+
+
+def er_margin_of_error(error, n, z=1.96):
+    error = max(0, min(error, 100))
+    if n == 0: return float('nan')
+    error = float(error * 0.01)
+    moe = z * math.sqrt(error * (1 - error) / n)
+    return moe * 100
+
+# Backtrace op codes, stored as one byte per cell of the edit-distance matrix
+OP_NON = 0
+OP_COR = 1
+OP_SUB = 2
+OP_DEL = 3
+OP_INS = 4
+
+# Matrices with fewer cells than this are filled with a scalar loop, because 
+# the per-diagonal overhead of NumPy outweighs the gain below ~90x90 tokens.
+VECTORIZE_MIN_CELLS = 8000
+
+class ArrayCalculator(Calculator):
+    """
+    Drop-in replacement for ``Calculator``, with an array-backed edit-distance engine.
+    - distances are held in integer arrays, the backtrace in a ``bytearray`` of op codes
+    - large matrices (e.g. dictation) are filled one anti-diagonal at a time with NumPy,
+      small matrices (e.g. commands) with a scalar loop over two ``array`` rows
+    - ties are broken in the same order as ``Calculator`` (del, ins, then cor/sub), 
+      so ``result`` and ``data`` are identical
+    """
+    def __init__(self, vectorize_min_cells=VECTORIZE_MIN_CELLS):
+        Calculator.__init__(self)
+        self.vectorize_min_cells = vectorize_min_cells
+    def calculate(self, lab, rec):
+        # Initialization
+        lab = [''] + list(lab)
+        rec = [''] + list(rec)
+        for token in lab :
+            if token not in self.data and len(token) > 0 :
+                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
+        for token in rec :
+            if token not in self.data and len(token) > 0 :
+                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
+        # Computing edit distance
+        if len(lab) * len(rec) >= self.vectorize_min_cells:
+            ops = self._fill_vectorized(lab, rec)
+        else:
+            ops = self._fill_scalar(lab, rec)
+        # Tracing back
+        return self._trace_back(lab, rec, ops)
+    def _fill_scalar(self, lab, rec):
+        """
+        Fills the backtrace row by row, keeping only two rows of distances.
+        """
+        n = len(lab)
+        m = len(rec)
+        c_cor = self.cost['cor']
+        c_sub = self.cost['sub']
+        c_del = self.cost['del']
+        c_ins = self.cost['ins']
+        ops = bytearray(n * m)
+        ops[1:m] = bytes((OP_INS,)) * (m - 1)
+        prev = array('q', range(m))
+        cur = array('q', bytes(8 * m))
+        for i in range(1, n):
+            lab_token = lab[i]
+            base = i * m
+            ops[base] = OP_DEL
+            cur[0] = i
+            for j in range(1, m):
+                min_dist = prev[j] + c_del
+                min_error = OP_DEL
+                dist = cur[j-1] + c_ins
+                if dist < min_dist:
+                    min_dist = dist
+                    min_error = OP_INS
+                if lab_token == rec[j]:
+                    dist = prev[j-1] + c_cor
+                    error = OP_COR
+                else:
+                    dist = prev[j-1] + c_sub
+                    error = OP_SUB
+                if dist < min_dist:
+                    min_dist = dist
+                    min_error = error
+                cur[j] = min_dist
+                ops[base + j] = min_error
+            prev, cur = cur, prev
+        return ops
+    def _fill_vectorized(self, lab, rec):
+        """
+        Fills the backtrace one anti-diagonal (i + j = d) at a time.
+        Cells on an anti-diagonal only depend on the previous two, and in the 
+        flattened (row-major) matrix they are evenly spaced by ``m - 1``, so 
+        each diagonal and its del/ins/diag predecessors are plain strided slices.
+        """
+        n = len(lab)
+        m = len(rec)
+        ops = np.zeros(n * m, dtype=np.uint8)
+        ops[1:m] = OP_INS
+        ops[m::m] = OP_DEL
+        if n == 1 or m == 1:
+            return ops.tobytes()
+        token_ids = {}
+        lab_ids = np.fromiter((token_ids.setdefault(t, len(token_ids)) for t in lab), dtype=np.int64, count=n)
+        rec_ids = np.fromiter((token_ids.setdefault(t, len(token_ids)) for t in rec), dtype=np.int64, count=m)
+        is_cor = (lab_ids[:, None] == rec_ids[None, :]).ravel()
+        diag_cost = np.where(is_cor, self.cost['cor'], self.cost['sub'])
+        dist = np.zeros(n * m, dtype=np.int64)
+        dist[:m] = np.arange(m)
+        dist[::m] = np.arange(n)
+        c_del = self.cost['del']
+        c_ins = self.cost['ins']
+        step = m - 1
+        for d in range(2, n + m - 1):
+            i_lo = max(1, d - step)
+            i_hi = min(n - 1, d - 1)
+            start = i_lo * step + d
+            stop = i_hi * step + d + 1
+            cells = slice(start, stop, step)
+            dist_del = dist[start-m:stop-m:step] + c_del
+            dist_ins = dist[start-1:stop-1:step] + c_ins
+            dist_diag = dist[start-m-1:stop-m-1:step] + diag_cost[cells]
+            min_dist = np.minimum(dist_del, dist_ins)
+            min_error = np.where(dist_ins < dist_del, OP_INS, OP_DEL)
+            take_diag = dist_diag < min_dist
+            dist[cells] = np.where(take_diag, dist_diag, min_dist)
+            ops[cells] = np.where(take_diag, np.where(is_cor[cells], OP_COR, OP_SUB), min_error)
+        return ops.tobytes()
+    def _trace_back(self, lab, rec, ops):
+        m = len(rec)
+        result = {'lab':[], 'rec':[], 'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
+        result_lab = result['lab']
+        result_rec = result['rec']
+        i = len(lab) - 1
+        j = m - 1
+        while True :
+            error = ops[i * m + j]
+            if error == OP_COR or error == OP_SUB : # correct or substitution
+                if len(lab[i]) > 0 :
+                    key = 'cor' if error == OP_COR else 'sub'
+                    token_data = self.data[lab[i]]
+                    token_data['all'] += 1
+                    token_data[key] += 1
+                    result['all'] += 1
+                    result[key] += 1
+                result_lab.append(lab[i])
+                result_rec.append(rec[j])
+                i = i - 1
+                j = j - 1
+            elif error == OP_DEL : # deletion
+                if len(lab[i]) > 0 :
+                    token_data = self.data[lab[i]]
+                    token_data['all'] += 1
+                    token_data['del'] += 1
+                    result['all'] += 1
+                    result['del'] += 1
+                result_lab.append(lab[i])
+                result_rec.append("")
+                i = i - 1
+            elif error == OP_INS : # insertion
+                if len(rec[j]) > 0 :
+                    self.data[rec[j]]['ins'] += 1
+                    result['ins'] += 1
+                result_lab.append("")
+                result_rec.append(rec[j])
+                j = j - 1
+            else : # starting point
+                break
+        result_lab.reverse()
+        result_rec.reverse()
+        return result
@@ -0,0 +1,155 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Process-safe use of Kaldi's compiled-grammar cache, for test_model's worker processes.
+
+Kaldi compiles each rule into an FST in its tmp dir, skipping rules whose FST is already there,
+and keeps hashes of the model files in the model dir's file_cache.json. Neither is written
+atomically, so processes initializing the engine at once, against the same dirs, can compile the
+same rules concurrently, and load (or parse) a file another is part way through writing.
+
+``CompileCache`` wraps initializing an engine. With a lock file in the tmp dir, one process at a
+time initializes, compiling any rules that aren't, while others wait then find them compiled.
+Once it's done, it atomically publishes a stamp of what it compiled for (the model files and
+`input_paths`, e.g. grammar modules and user_settings) and the FSTs it used. A process whose
+stamp is current, with all of its FSTs there, has nothing to compile or write, so it initializes
+without waiting for the lock.
+
+test_model initializes in the main process before starting a pool of workers, pre-compiling for
+them, so they all start without waiting. Each process prints the rules it found compiled (hits),
+those it compiled (misses), and how long it waited for the lock.
+"""
+
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from tacspeak.result_cache import fingerprint_model_dir, hash_file, hash_strings
+
+LOCK_FILENAME = ".tacspeak_compile.lock"
+
+
+def list_fsts(tmp_dir):
+    return [filename for filename in os.listdir(tmp_dir) if filename.endswith(".fst")]
+
+class FileLock:
+    """
+    Exclusive lock across processes, held on the first byte of the file at `path`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, "a+b")
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            return
+        self.file.seek(0)
+        while True:
+            try:
+                # retries for 10s before raising
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def release(self):
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+class CompileCache:
+    """
+    Context manager around initializing an engine (for `mode`, e.g. "grammar" or "dictation")
+    against `model_dir` and `tmp_dir`, see module docstring. Call ``finish()`` once it's initialized.
+    """
+    def __init__(self, mode, model_dir, tmp_dir, input_paths=()):
+        self.mode = mode
+        self.model_dir = model_dir
+        self.tmp_dir = tmp_dir
+        self.input_paths = sorted(input_paths)
+        self.stamp_path = os.path.join(tmp_dir, f".tacspeak_compiled_{mode}.json")
+        self.lock = FileLock(os.path.join(tmp_dir, LOCK_FILENAME))
+        self.locked = False
+        self.compiled = False
+        self.start_time = None
+        self.existing_fsts = set()
+        self.hits = 0
+        self.misses = 0
+        self.wait_s = 0.0
+
+    def inputs_hash(self):
+        # the tmp dir may be within the model dir
+        tmp_dirname = os.path.basename(os.path.normpath(self.tmp_dir))
+        items = [self.mode, fingerprint_model_dir(self.model_dir, exclude_dirs=("cache.tmp", tmp_dirname))]
+        items.extend(f"{os.path.basename(path)}|{hash_file(path)}" for path in self.input_paths)
+        return hash_strings(items)
+
+    def is_current(self):
+        try:
+            with open(self.stamp_path, encoding="utf-8") as file:
+                stamp = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return (stamp.get("inputs") == self.inputs_hash()
+                and all(os.path.isfile(os.path.join(self.tmp_dir, filename)) for filename in stamp["fsts"]))
+
+    def __enter__(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.start_time = time.time()
+        if not self.is_current():
+            wait_start_time = time.perf_counter()
+            self.lock.acquire()
+            self.wait_s = time.perf_counter() - wait_start_time
+            if self.is_current():
+                # compiled by the process we waited for
+                self.lock.release()
+            else:
+                self.locked = True
+        self.existing_fsts = set(list_fsts(self.tmp_dir))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.locked:
+            self.lock.release()
+            self.locked = False
+
+    def finish(self, fst_filenames):
+        """
+        Counts the rules' FSTs `fst_filenames` found compiled, and if this process held the lock,
+        publishes the stamp.
+        """
+        self.hits = len([filename for filename in fst_filenames if filename in self.existing_fsts])
+        self.misses = len(fst_filenames) - self.hits
+        if not self.locked:
+            return
+        # Kaldi touches the FSTs it loads from the cache, so those used (e.g. the top graph too)
+        # are the ones modified since starting, give or take the file system's time resolution
+        used = [filename for filename in list_fsts(self.tmp_dir)
+                if os.path.getmtime(os.path.join(self.tmp_dir, filename)) >= self.start_time - 2]
+        stamp = {"inputs": self.inputs_hash(), "fsts": sorted(set(used) | set(fst_filenames))}
+        tmp_path = f"{self.stamp_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(stamp, file)
+        os.replace(tmp_path, self.stamp_path)
+        self.compiled = True
+
+    def stats_string(self):
+        return (f"Compile cache {self.tmp_dir} ({self.mode}) -> hits={self.hits} misses={self.misses}"
+                + f" waited={self.wait_s:.2f}s {'compiled' if self.compiled else 'reused'}")
@@ -0,0 +1,301 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Packed audio corpus: a single indexed file of raw PCM clips and their transcripts,
+to replace a retain.tsv plus tens of thousands of small wav files when testing.
+
+Layout (little-endian):
+
+    header   MAGIC, VERSION, sample rate, sample width, channels, n_clips, strings_offset, data_offset
+    index    n_clips * (data offset, data bytes, strings offset, name bytes, text bytes, sha1 of data)
+    strings  utf-8 name (the original wav path) + text of each clip
+    data     raw PCM of each clip, aligned to DATA_ALIGN bytes
+
+Clips are read as zero-copy memoryviews over an mmap of the file, so processes
+testing the same corpus share the OS page cache rather than each opening files.
+A clip is referred to by an audio path of the form ``<corpus path>::<clip name>``.
+"""
+
+import glob
+import hashlib
+import mmap
+import os
+import struct
+import time
+import wave
+
+MAGIC = b"TSPKCORP"
+VERSION = 1
+HEADER = struct.Struct("<8sIIHHIQQ")
+INDEX_ENTRY = struct.Struct("<QQQII20s")
+DATA_ALIGN = 16
+CLIP_SEPARATOR = "::"
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+# same block size as dragonfly's WavAudio.read_file(), 10 ms
+BLOCK_SIZE_SAMPLES = SAMPLE_RATE // 100
+
+# --------------------------------------------------------------------------
+# Packing
+
+def read_tsv(tsv_file):
+    """
+    Yields (wav_path, text) from a retain.tsv formatted file.
+    """
+    with open(tsv_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                continue
+            yield fields[0], fields[4]
+
+def read_wav_pcm(wav_path):
+    with wave.open(wav_path, 'rb') as wav_file:
+        if (wav_file.getframerate() != SAMPLE_RATE or wav_file.getsampwidth() != SAMPLE_WIDTH
+                or wav_file.getnchannels() != CHANNELS):
+            raise ValueError(f"{wav_path} should be {SAMPLE_RATE} Hz, {SAMPLE_WIDTH * 8}-bit, {CHANNELS} channel")
+        return wav_file.readframes(wav_file.getnframes())
+
+def pack_corpus(tsv_file, out_path):
+    """
+    Packs the wav files and transcripts listed in `tsv_file` into a corpus file at `out_path`.
+    Missing wav files and duplicate wav paths are skipped. Returns the number of clips packed.
+    """
+    clips = []
+    seen = set()
+    n_skipped = 0
+    for wav_path, text in read_tsv(tsv_file):
+        if wav_path in seen or not os.path.isfile(wav_path):
+            n_skipped += 1
+            continue
+        seen.add(wav_path)
+        clips.append((wav_path, text))
+
+    strings = bytearray()
+    string_entries = []
+    for wav_path, text in clips:
+        name_bytes = wav_path.encode('utf-8')
+        text_bytes = text.encode('utf-8')
+        string_entries.append((len(strings), len(name_bytes), len(text_bytes)))
+        strings += name_bytes + text_bytes
+
+    strings_offset = HEADER.size + INDEX_ENTRY.size * len(clips)
+    data_offset = align(strings_offset + len(strings))
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        # write the data first, then come back for the header and index once offsets and hashes are known
+        f.seek(data_offset)
+        index = []
+        for (wav_path, text), (str_offset, name_len, text_len) in zip(clips, string_entries):
+            pcm = read_wav_pcm(wav_path)
+            offset = f.tell()
+            f.write(pcm)
+            f.write(b"\0" * (align(offset + len(pcm)) - (offset + len(pcm))))
+            index.append(INDEX_ENTRY.pack(offset, len(pcm), str_offset, name_len, text_len, hashlib.sha1(pcm).digest()))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, SAMPLE_RATE, SAMPLE_WIDTH, CHANNELS, len(clips), strings_offset, data_offset))
+        f.writelines(index)
+        f.write(strings)
+    os.replace(tmp_path, out_path)
+    print(f"Packed {len(clips)} clips into {out_path} ({n_skipped} skipped)")
+    return len(clips)
+
+def align(offset):
+    return (offset + DATA_ALIGN - 1) // DATA_ALIGN * DATA_ALIGN
+
+# --------------------------------------------------------------------------
+# Reading
+
+class CorpusArchive:
+    """
+    Read-only view of a packed corpus file, see module docstring.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            self.file.close()
+            raise ValueError(f"{path} is not a corpus file")
+        self.view = memoryview(self.mmap)
+        magic, version, sample_rate, sample_width, channels, n_clips, strings_offset, data_offset = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} corpus file")
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.strings_offset = strings_offset
+        self.index = [INDEX_ENTRY.unpack_from(self.mmap, HEADER.size + i * INDEX_ENTRY.size) for i in range(n_clips)]
+        self.names = {self.name(i): i for i in range(n_clips)}
+
+    def close(self):
+        view = getattr(self, 'view', None)
+        if view is not None:
+            view.release()
+            self.mmap.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def name(self, i):
+        data_offset, data_len, str_offset, name_len, text_len, sha1 = self.index[i]
+        start = self.strings_offset + str_offset
+        return bytes(self.view[start:start + name_len]).decode('utf-8')
+
+    def text(self, i):
+        data_offset, data_len, str_offset, name_len, text_len, sha1 = self.index[i]
+        start = self.strings_offset + str_offset + name_len
+        return bytes(self.view[start:start + text_len]).decode('utf-8')
+
+    def pcm(self, i):
+        """
+        Returns the raw PCM of clip `i` as a memoryview over the mmap (no copy).
+        """
+        data_offset, data_len, str_offset, name_len, text_len, sha1 = self.index[i]
+        return self.view[data_offset:data_offset + data_len]
+
+    def sha1(self, i):
+        return self.index[i][5].hex()
+
+    def audio_path(self, i):
+        return f"{self.path}{CLIP_SEPARATOR}{self.name(i)}"
+
+    def clips(self):
+        """
+        Yields (audio_path, text) of each clip, like read_tsv().
+        """
+        for i in range(len(self.index)):
+            yield self.audio_path(i), self.text(i)
+
+# archives opened by this process, so that each worker maps a corpus file once
+_archives = {}
+
+def get_archive(path):
+    archive = _archives.get(path)
+    if archive is None:
+        archive = CorpusArchive(path)
+        _archives[path] = archive
+    return archive
+
+def is_corpus_file(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def split_audio_path(audio_path):
+    """
+    Returns (CorpusArchive, clip index) if `audio_path` refers to a corpus clip, otherwise None.
+    """
+    if CLIP_SEPARATOR not in audio_path:
+        return None
+    corpus_path, name = audio_path.split(CLIP_SEPARATOR, 1)
+    archive = _archives.get(corpus_path)
+    if archive is None:
+        if not is_corpus_file(corpus_path):
+            return None
+        archive = get_archive(corpus_path)
+    i = archive.names.get(name)
+    if i is None:
+        raise KeyError(f"{name} not in corpus {corpus_path}")
+    return archive, i
+
+def read_pcm(audio_path):
+    """
+    Returns the raw PCM of a wav file or corpus clip, as bytes or a memoryview respectively.
+    """
+    clip = split_audio_path(audio_path)
+    if clip is None:
+        with wave.open(audio_path, 'rb') as wav_file:
+            return wav_file.readframes(wav_file.getnframes())
+    archive, i = clip
+    return archive.pcm(i)
+
+def read_blocks(audio_path, realtime=False):
+    """
+    Yields raw audio blocks from a corpus clip, terminated by a None element,
+    in the same way as dragonfly's WavAudio.read_file() does for a wav file.
+    If `realtime`, blocks are yielded no faster than they would be from a microphone.
+    """
+    archive, i = split_audio_path(audio_path)
+    pcm = archive.pcm(i)
+    block_bytes = BLOCK_SIZE_SAMPLES * archive.sample_width * archive.channels
+    next_time = time.time()
+    for start in range(0, len(pcm), block_bytes):
+        if realtime:
+            time_behind = next_time - time.time()
+            if time_behind > 0:
+                time.sleep(time_behind)
+            next_time += float(BLOCK_SIZE_SAMPLES) / archive.sample_rate
+        yield pcm[start:start + block_bytes]
+    yield None
+
+def hash_audio(audio_path):
+    """
+    Returns a content hash of a corpus clip (stored in the corpus), or None for other paths.
+    """
+    clip = split_audio_path(audio_path)
+    if clip is None:
+        return None
+    archive, i = clip
+    return archive.sha1(i)
+
+def list_audio_paths(path):
+    """
+    Returns the audio paths of every clip if `path` is a corpus file, otherwise [path].
+    """
+    if is_corpus_file(path):
+        return [audio_path for audio_path, text in get_archive(path).clips()]
+    return [path]
+
+def is_batch_input(path):
+    """
+    Returns True if `path` refers to more than one audio file, see expand_audio_inputs().
+    """
+    if glob.has_magic(path) or os.path.isdir(path) or is_corpus_file(path):
+        return True
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() != ".wav"
+
+def expand_audio_inputs(path):
+    """
+    Returns the audio paths referred to by `path`, which may be a directory (of wav files, recursively), 
+    a glob pattern, a corpus file, a list file (one wav path per line, or a .tsv with the wav path 
+    in the first column), or a single wav file or corpus clip.
+    """
+    if glob.has_magic(path):
+        return sorted(p for p in glob.glob(path, recursive=True) if os.path.isfile(p))
+    if os.path.isdir(path):
+        audio_paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            audio_paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(".wav"))
+        return audio_paths
+    if is_corpus_file(path):
+        return list_audio_paths(path)
+    if os.path.isfile(path) and os.path.splitext(path)[1].lower() != ".wav":
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = (line.rstrip('\n').split('\t', 1)[0].strip() for line in f)
+            return [line for line in lines if line and not line.startswith("#")]
+    return [path]
+
+def audio_duration_s(audio_path):
+    clip = split_audio_path(audio_path)
+    if clip is None:
+        with wave.open(audio_path, 'rb') as wav_file:
+            return wav_file.getnframes() / float(wav_file.getframerate())
+    archive, i = clip
+    return len(archive.pcm(i)) / float(archive.sample_rate * archive.sample_width * archive.channels)
+
+def audio_exists(audio_path):
+    return split_audio_path(audio_path) is not None or os.path.isfile(audio_path)
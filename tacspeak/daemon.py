@@ -0,0 +1,195 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Local evaluation daemon, which keeps the engine (with grammar modules loaded)
+and dictation recognizer initialized between ``cli.py`` test and transcribe runs.
+
+The daemon serves one job at a time over a Unix socket. Each request and response
+is a single line of JSON::
+
+    request:  {"job": "test_model", "cwd": "/path/to/tacspeak", "kwargs": {...}}
+    response: {"ok": true, "result": ...}  or  {"ok": false, "error": "..."}
+
+A test job whose worker pool is interrupted (Ctrl-C in the daemon) responds with
+``{"ok": false, "interrupted": true, ...}``, so the client doesn't run it again itself.
+
+Jobs are run in the daemon's working directory, so clients must be run from the
+same directory, where relative paths mean the same thing. Test jobs fork their worker
+pool from the daemon's engine, see ``test_model(..., warm_pool=True)``.
+"""
+
+import json
+import os
+import socket
+import traceback
+
+import tacspeak.test_model as tm
+
+DEFAULT_SOCKET_PATH = "./.tacspeak_daemon.sock"
+CONNECT_TIMEOUT_S = 1.0
+# what cli.py returns for a job which was interrupted in the daemon, rather than its result
+INTERRUPTED = object()
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+def is_supported():
+    return hasattr(socket, "AF_UNIX")
+
+# --------------------------------------------------------------------------
+# Client
+
+def submit(job, kwargs=None, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Submits a job to a running daemon, returning its response dict, or None if no daemon is running.
+    """
+    if not is_supported() or not os.path.exists(socket_path):
+        return None
+    request = {'job': job, 'cwd': os.getcwd(), 'kwargs': kwargs or {}}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT_S)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+        # jobs like test_model can take a long time
+        sock.settimeout(None)
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        return {'ok': False, 'error': "daemon closed the connection"}
+    return json.loads(line)
+
+def is_running(socket_path=DEFAULT_SOCKET_PATH):
+    response = submit('ping', socket_path=socket_path)
+    return response is not None and response.get('ok', False)
+
+# --------------------------------------------------------------------------
+# Server
+
+class EvalDaemon:
+    """
+    Serves test_model jobs from the engine initialized with `model_dir`, see module docstring.
+    """
+    def __init__(self, model_dir, socket_path=DEFAULT_SOCKET_PATH):
+        self.model_dir = model_dir
+        self.socket_path = socket_path
+        self.running = False
+        self.jobs = {
+            'ping': self.ping,
+            'reload': self.reload,
+            'stop': self.stop,
+            'test_model': self.test_model,
+            'test_model_dictation': self.test_model_dictation,
+            'transcribe_wav': self.transcribe_wav,
+            'transcribe_wav_dictation': self.transcribe_wav_dictation,
+            'transcribe_batch': self.transcribe_batch,
+        }
+
+    def serve_forever(self):
+        if is_running(self.socket_path):
+            print(f"A daemon is already running on {self.socket_path}")
+            return
+        if os.path.exists(self.socket_path):
+            # left behind by a daemon which didn't exit cleanly
+            os.remove(self.socket_path)
+
+        tm.keep_engine_connected = True
+        # the engine is forked by test jobs, so it mustn't open a microphone stream
+        tm.initialize_kaldi(self.model_dir, audio_input_device=False)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(1)
+        self.running = True
+        print(f"Tacspeak daemon serving {self.model_dir} on {self.socket_path}")
+        try:
+            while self.running:
+                conn, _ = server.accept()
+                with conn:
+                    self.handle(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+            print("Tacspeak daemon stopped")
+
+    def handle(self, conn):
+        with conn.makefile('r', encoding='utf-8') as f:
+            line = f.readline()
+        try:
+            request = json.loads(line)
+            job = self.jobs.get(request.get('job'))
+            if job is None:
+                raise ValueError(f"unknown job {request.get('job')!r}")
+            if os.path.abspath(request.get('cwd', '')) != os.getcwd():
+                raise ValueError(f"daemon is running in {os.getcwd()}, not {request.get('cwd')}")
+            print(f"Daemon job: {request['job']} {request.get('kwargs')}")
+            response = {'ok': True, 'result': job(**request.get('kwargs', {}))}
+        except JobInterrupted as e:
+            print(f"Daemon job interrupted: {e}")
+            response = {'ok': False, 'interrupted': True, 'error': str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        try:
+            conn.sendall((json.dumps(response, default=str) + "\n").encode('utf-8'))
+        except OSError as e:
+            print(f"Daemon failed to send response: {e}")
+
+    def check_model_dir(self, model_dir):
+        if os.path.abspath(model_dir) != os.path.abspath(self.model_dir):
+            raise ValueError(f"daemon is serving model_dir {self.model_dir}, not {model_dir}")
+
+    def ping(self):
+        return {'pid': os.getpid(), 'model_dir': self.model_dir}
+
+    def reload(self):
+        engine = tm.reload_grammars()
+        return [grammar.name for grammar in engine.grammars]
+
+    def stop(self):
+        self.running = False
+        return True
+
+    def test_model(self, tsv_file, model_dir, lexicon_file=None, num_threads=1, **kwargs):
+        self.check_model_dir(model_dir)
+        test_result = tm.test_model(tsv_file, model_dir, lexicon_file, num_threads, warm_pool=True, **kwargs)
+        if test_result is None:
+            raise JobInterrupted(f"test_model of {tsv_file} was interrupted")
+        return tm.write_test_model_output(*test_result, tsv_file, model_dir)
+
+    def test_model_dictation(self, tsv_file, model_dir, lexicon_file=None, num_threads=1, **kwargs):
+        test_result = tm.test_model_dictation(tsv_file, model_dir, lexicon_file, num_threads, warm_pool=True, **kwargs)
+        if test_result is None:
+            raise JobInterrupted(f"test_model_dictation of {tsv_file} was interrupted")
+        return tm.write_test_model_output(*test_result, tsv_file, model_dir, dictation=True)
+
+    def transcribe_wav(self, wav_path, out_txt_path=None, model_dir=None, **kwargs):
+        self.check_model_dir(model_dir or self.model_dir)
+        return tm.transcribe_wav(wav_path, out_txt_path, model_dir or self.model_dir, **kwargs)
+
+    def transcribe_wav_dictation(self, wav_path, out_txt_path=None, model_dir=None):
+        return tm.transcribe_wav_dictation(wav_path, out_txt_path, model_dir or self.model_dir)
+
+    def transcribe_batch(self, input_path, out_path, model_dir=None, dictation=False, **kwargs):
+        if not dictation:
+            self.check_model_dir(model_dir or self.model_dir)
+        return tm.transcribe_batch(input_path, out_path, model_dir or self.model_dir, dictation=dictation, warm_pool=True, **kwargs)
+
+def serve(model_dir, socket_path=DEFAULT_SOCKET_PATH):
+    if not is_supported():
+        print("The daemon requires Unix socket support (AF_UNIX), which this platform doesn't have")
+        return
+    EvalDaemon(model_dir, socket_path).serve_forever()
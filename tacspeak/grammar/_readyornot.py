@@ -14,6 +14,9 @@ from dragonfly.actions import (Key, Mouse, ActionBase)
 
 from kaldi_active_grammar import KaldiRule
 
+from tacspeak.key_sequences import compile_key_sequences, PRESS
+from tacspeak.shared_rules import SharedPrefixRule, expand_rules
+
 # ---------------------------------------------------------------------------
 # Check DEBUG_MODE (from user_settings)
 
@@ -27,22 +30,42 @@ try:
 except Exception:
     DEBUG_HEAVY_DUMP_GRAMMAR = False
 
+# if set, only dump this many random expansions of each rule with DEBUG_HEAVY_DUMP_GRAMMAR
+try:
+    DEBUG_HEAVY_DUMP_GRAMMAR_SAMPLE = (sys.modules["user_settings"]).DEBUG_HEAVY_DUMP_GRAMMAR_SAMPLE
+except Exception:
+    DEBUG_HEAVY_DUMP_GRAMMAR_SAMPLE = None
+
 # whether or not to load NoiseSink rule to grammar_priority
 try:
     USE_NOISE_SINK = (sys.modules["user_settings"]).USE_NOISE_SINK
 except Exception:
     USE_NOISE_SINK = False
 
+# whether to execute actions on Tacspeak's action executor thread, so they don't block recognition
+try:
+    ASYNC_ACTIONS = (sys.modules["user_settings"]).ASYNC_ACTIONS
+except Exception:
+    ASYNC_ACTIONS = False
+
+try:
+    ASYNC_ACTIONS_MAX_WAIT_S = (sys.modules["user_settings"]).ASYNC_ACTIONS_MAX_WAIT_S
+except Exception:
+    ASYNC_ACTIONS_MAX_WAIT_S = 2.0
+
 # DEBUG_MODE = True # if you want to override
 # DEBUG_HEAVY_DUMP_GRAMMAR = True # if you want to override
 # USE_NOISE_SINK = False # if you want to override
+# ASYNC_ACTIONS = False # if you want to override
 
 # ---------------------------------------------------------------------------
 # Create this module's grammar and the context under which it'll be active.
+# EXECUTABLE is read without importing this module, to load it when the game starts (LAZY_LOAD)
+EXECUTABLE = "ReadyOrNot"
 if DEBUG_MODE:
     grammar_context = AppContext()
 else:
-    grammar_context = AppContext(executable="ReadyOrNot")
+    grammar_context = AppContext(executable=EXECUTABLE)
 grammar = Grammar("ReadyOrNot",
                   context=grammar_context,
                   )
@@ -249,9 +272,167 @@ def invert_squash_map(my_map):
     for k, v in my_map.items():
         inv_map[v] = inv_map.get(v, []) + [k]
     for k, v in inv_map.items():
-        inv_map[k] = '(' + ' | '.join('(' + v + ')') + ')' if len(v) > 1 else ''.join(v)
+        inv_map[k] = '(' + ' | '.join('(' + x + ')' for x in v) + ')' if len(v) > 1 else ''.join(v)
     return inv_map
 
+# ---------------------------------------------------------------------------
+# Key sequences of commands
+# The in-game command menu tree: the ingame_key_bindings pressed for each command, for each of its 
+# options. Compiled on load into a flat key sequence for every combination of options, see 
+# tacspeak/key_sequences.py for the format and checks
+
+def option_values(*maps):
+    """Returns the distinct values of maps, in order"""
+    return list(dict.fromkeys(v for my_map in maps for v in my_map.values()))
+
+colors = option_values(map_colors) + ["current"]
+holds = ["go", "hold"]
+
+select_team = {"color": {"gold": "gold", "blue": "blue", "red": "red", "current": ()}}
+hold_down = {"hold": {"hold": "cmd_hold:down", "go": ()}}
+hold_up = {"hold": {"hold": "cmd_hold:up", "go": ()}}
+
+key_sequences_spec = {
+    "execute_or_cancel_held_order": {
+        "options": {"color": colors, "execute_or_cancel": option_values(map_execute_or_cancels)},
+        "sequence": [select_team, "cmd_menu", {"execute_or_cancel": {"execute": "cmd_1", "cancel": "cmd_2"}}],
+    },
+    "select_team": {
+        "options": {"color": colors},
+        "sequence": [select_team],
+    },
+    "door_options": {
+        "options": {"color": colors, "hold": holds, "door_option": option_values(map_door_options, map_door_scan),
+                    "trapped": option_values(map_door_trapped) + ["not trapped"]},
+        "sequence": [select_team, "cmd_menu", hold_down, {("door_option", "trapped"): {
+            ("slide", "*"): ("cmd_4", "cmd_1"),
+            ("pie", "*"): ("cmd_4", "cmd_2"),
+            ("peek", "*"): ("cmd_4", "cmd_3"),
+            ("mirror", "*"): "cmd_5",
+            ("disarm", "*"): "cmd_6",
+            ("wedge", "not trapped"): "cmd_6",
+            ("wedge", "trapped"): "cmd_7",
+            ("cover", "not trapped"): "cmd_7",
+            ("cover", "trapped"): "cmd_8",
+            ("open", "not trapped"): "cmd_8",
+            ("open", "trapped"): "cmd_9",
+            ("close", "not trapped"): "cmd_8",
+            ("close", "trapped"): "cmd_9",
+        }}, hold_up],
+    },
+    "stack_up": {
+        "options": {"color": colors, "hold": holds, "side": option_values(map_door_stack_sides)},
+        "sequence": [select_team, "cmd_menu", "cmd_1", hold_down, 
+                     {"side": {"split": "cmd_1", "left": "cmd_2", "right": "cmd_3", "auto": "cmd_4"}}, hold_up],
+    },
+    "breach_and_clear": {
+        "options": {"color": colors, "hold": holds, "tool": option_values(map_door_breach_tools),
+                    "grenade": option_values(map_door_grenades) + ["none"]},
+        "sequence": [select_team, "cmd_menu", {"tool": {
+            "open": "cmd_2",
+            "kick": ("cmd_3", "cmd_1"),
+            "shotgun": ("cmd_3", "cmd_2"),
+            "c2": ("cmd_3", "cmd_3"),
+            "ram": ("cmd_3", "cmd_4"),
+            "leader": ("cmd_3", "cmd_5"),
+        }}, hold_down, {"grenade": {
+            "none": "cmd_1",
+            "flashbang": "cmd_2",
+            "stinger": "cmd_3",
+            "gas": "cmd_4",
+            "launcher": "cmd_5",
+            "leader": "cmd_6",
+        }}, hold_up],
+    },
+    "pick_lock": {
+        "options": {"color": colors, "hold": holds},
+        "sequence": [select_team, "cmd_menu", hold_down, "cmd_2", hold_up],
+    },
+    "ground_options": {
+        "options": {"color": colors, "hold": holds, "ground_option": option_values(map_ground_options)},
+        "sequence": [select_team, "cmd_menu", hold_down, {"ground_option": {
+            "move": "cmd_1",
+            "cover": "cmd_3",
+            "halt": "cmd_4",
+            "resume": "cmd_4",
+            "search": "cmd_6",
+        }}, hold_up],
+    },
+    "fallin": {
+        "options": {"color": colors, "hold": holds, "formation": option_values(map_ground_fallin_formations)},
+        "sequence": [select_team, "cmd_menu", hold_down, "cmd_2",
+                     {"formation": {"single": "cmd_1", "double": "cmd_2", "diamond": "cmd_3", "wedge": "cmd_4"}}, 
+                     hold_up],
+    },
+    "use_deployable": {
+        "options": {"color": colors, "hold": holds, "deployable": option_values(map_ground_deployables)},
+        "sequence": [select_team, "cmd_menu", "cmd_5", hold_down, {"deployable": {
+            "flashbang": "cmd_1",
+            "stinger": "cmd_2",
+            "gas": "cmd_3",
+            "chemlight": "cmd_4",
+            "shield": "cmd_5",
+        }}, hold_up],
+    },
+    "npc_player_interact": {
+        "options": {"interaction": option_values(map_npc_player_interacts)},
+        "sequence": ["cmd_menu", {"interaction": {
+            "move here": "cmd_2",
+            "move my position": ("cmd_2", "cmd_2"),
+            "move stop": ("cmd_2", "cmd_3"),
+            "turn around": "cmd_4",
+            "move to exit": "cmd_5",
+        }}],
+    },
+    "npc_team_restrain": {
+        "options": {"color": colors},
+        "sequence": [select_team, "cmd_menu", "cmd_1"],
+    },
+    "npc_team_deploy": {
+        "options": {"color": colors, "deployable": option_values(map_npc_team_deployables)},
+        "sequence": [select_team, "cmd_menu", "cmd_3", {"deployable": {
+            "taser": "cmd_1",
+            "pepperspray": "cmd_2",
+            "pepperball": "cmd_3",
+            "beanbag": "cmd_4",
+            "melee": "cmd_5",
+        }}],
+    },
+    "select_team_member": {
+        "options": {"team_member": option_values(map_team_members)},
+        "sequence": [{"team_member": {"alpha": "alpha", "bravo": "bravo", "charlie": "charlie", "delta": "delta"}}],
+    },
+    "team_member_options": {
+        "options": {"team_member": option_values(map_team_members), "option": option_values(map_team_member_options),
+                    "additional_option": [""] + option_values(map_team_member_move, map_team_member_focus, 
+                                                              map_team_members)},
+        "sequence": [{"team_member": {"alpha": "alpha", "bravo": "bravo", "charlie": "charlie", "delta": "delta"}},
+                     "cmd_menu", {"option": {
+            "move": "cmd_1",
+            "focus": "cmd_2",
+            "unfocus": ("cmd_2", "cmd_5"),
+            "swap": "cmd_3",
+            "search": "cmd_4",
+        }}, {("option", "additional_option"): {
+            ("move", "here"): "cmd_1",
+            ("move", "here then back"): "cmd_2",
+            ("focus", "here"): "cmd_1",
+            ("focus", "my position"): "cmd_2",
+            ("focus", "door"): "cmd_3",
+            ("focus", "target"): "cmd_4",
+            ("focus", "unfocus"): "cmd_5",
+            ("swap", "alpha"): "cmd_1",
+            ("swap", "bravo"): "cmd_2",
+            ("swap", "charlie"): "cmd_3",
+            ("swap", "delta"): "cmd_4",
+            ("*", "*"): (),
+        }}],
+    },
+    "yell": {
+        "sequence": ["yell"],
+    },
+}
+
 # ---------------------------------------------------------------------------
 # Rules which will be added to our grammar
 
@@ -259,31 +440,33 @@ def invert_squash_map(my_map):
 NULL_ACTION = Function(lambda: print("NULL_ACTION")
                        if DEBUG_NOCMD_PRINT_ONLY else None)
 
-def action_hold(direction):
+if ASYNC_ACTIONS:
+    from tacspeak.action_executor import get_executor
+    action_executor = get_executor(ASYNC_ACTIONS_MAX_WAIT_S)
+
+def execute_actions(actions, key=None):
     """
-    press "down" or release "up" the hold command key (on execution)
-    - direction="up"|"down"
+    Execute actions, or queue them on the action executor if ASYNC_ACTIONS
+    - key: if a newer command with the same key is queued before these actions start, 
+      they're dropped, e.g. a newer order to the same team
     """
-    if DEBUG_NOCMD_PRINT_ONLY:
-        device = 'm' if 'mouse_' in ingame_key_bindings["cmd_hold"] else 'kb'
-        return Function(debug_print_key, device=device, key=f'{ingame_key_bindings["cmd_hold"]}:{direction}')
+    if ASYNC_ACTIONS:
+        action_executor.submit(actions, key=key)
     else:
-        return Key(f'{ingame_key_bindings["cmd_hold"]}:{direction}')
+        actions.execute()
+
+def team_key(color):
+    return f"{color} team"
 
 # ------------------------------------------------------------------
+# Extras used by many rules, defined once so their elements are built once, and so rules can share 
+# them in a SharedPrefixRule
 
-def cmd_execute_or_cancel_held_order(color, execute_or_cancel):
-    """
-    Press & release command keys for team to execute held order
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    match execute_or_cancel:
-        case "execute":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "cancel":
-            actions += map_ingame_key_bindings["cmd_2"]
-    return actions
+color_extra = Optional(Choice("color_choice", map_colors), "color", "current")
+hold_extra = Optional(Choice("hold_choice", map_hold), "hold", "go")
+trapped_extra = Optional(Choice("trapped_choice", map_door_trapped), "trapped", "not trapped")
+
+# ------------------------------------------------------------------
 
 class ExecuteOrCancelHeldOrder(CompoundRule):
     """
@@ -291,7 +474,7 @@ class ExecuteOrCancelHeldOrder(CompoundRule):
     """
     spec = "<color> [team] <execute_or_cancel> [([that] [held] order | that [order])]"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
+        color_extra,
         Choice("execute_or_cancel", map_execute_or_cancels),
     ]
     defaults = {
@@ -303,31 +486,24 @@ class ExecuteOrCancelHeldOrder(CompoundRule):
         color = extras["color"]
         execute_or_cancel = extras["execute_or_cancel"]
         print(f"{color} team {execute_or_cancel} held order")
-        cmd_execute_or_cancel_held_order(color, execute_or_cancel).execute()
+        # cancel replaces the team's queued order, but execute mustn't replace the held order it executes
+        execute_actions(lookup_actions("execute_or_cancel_held_order", color, execute_or_cancel),
+                        key=team_key(color) if execute_or_cancel == "cancel" else None)
 
 # ------------------------------------------------------------------
 
-def cmd_select_team(color):
-    """
-    Press & release select color team key (on execution), or return NULL_ACTION
-    """
-    if color != "current":
-        return map_ingame_key_bindings[color]
-    else:
-        return NULL_ACTION
-
 class SelectTeam(CompoundRule):
     """
     Speech recognise select color team
     """
     spec = "<color> team"
-    extras = [Optional(Choice("color_choice", map_colors), "color", "current")]
+    extras = [color_extra]
     defaults = {"color": "current"}
 
     def _process_recognition(self, node, extras):
         color = extras["color"]
         print(f"Select {color}")
-        cmd_select_team(color).execute()
+        execute_actions(lookup_actions("select_team", color))
 
 class SelectColor(CompoundRule):
     """
@@ -339,69 +515,20 @@ class SelectColor(CompoundRule):
     def _process_recognition(self, node, extras):
         color = extras["color"]
         print(f"Select {color}")
-        cmd_select_team(color).execute()
+        execute_actions(lookup_actions("select_team", color))
 
 # ------------------------------------------------------------------
 
-def cmd_door_options(color, hold, door_option, trapped):
-    """
-    Press & release command keys for team to mirror under, wedge, cover, open, 
-    # close the door (on execution)
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    match door_option:
-        case "slide":
-            actions += map_ingame_key_bindings["cmd_4"]
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "pie":
-            actions += map_ingame_key_bindings["cmd_4"]
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "peek":
-            actions += map_ingame_key_bindings["cmd_4"]
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "mirror":
-            actions += map_ingame_key_bindings["cmd_5"]
-        case "disarm":
-            actions += map_ingame_key_bindings["cmd_6"]
-        case "wedge":
-            if trapped == "trapped":
-                actions += map_ingame_key_bindings["cmd_7"]
-            else:
-                actions += map_ingame_key_bindings["cmd_6"]
-        case "cover":
-            if trapped == "trapped":
-                actions += map_ingame_key_bindings["cmd_8"]
-            else:
-                actions += map_ingame_key_bindings["cmd_7"]
-        case "open":
-            if trapped == "trapped":
-                actions += map_ingame_key_bindings["cmd_9"]
-            else:
-                actions += map_ingame_key_bindings["cmd_8"]
-        case "close":
-            if trapped == "trapped":
-                actions += map_ingame_key_bindings["cmd_9"]
-            else:
-                actions += map_ingame_key_bindings["cmd_8"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class DoorOptions(CompoundRule):
     """
     Speech recognise team mirror under, wedge, cover, open, close the door
     """
     spec = "<color> [team] <hold> <door_option> [(the | that)] <trapped> (door [way] | opening | room)"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("door_option", map_door_options | map_door_scan),
-        Optional(Choice("trapped_choice", map_door_trapped), "trapped", "not trapped"),
+        trapped_extra,
     ]
     defaults = {
         "color": "current",
@@ -416,7 +543,7 @@ class DoorOptions(CompoundRule):
         door_option = extras["door_option"]
         trapped = extras["trapped"]
         print(f"{color} team {hold} {door_option} {trapped} the door")
-        cmd_door_options(color, hold, door_option, trapped).execute()
+        execute_actions(lookup_actions("door_options", color, hold, door_option, trapped), team_key(color))
 
 class WedgeIt(CompoundRule):
     """
@@ -424,9 +551,9 @@ class WedgeIt(CompoundRule):
     """
     spec = "<color> [team] <hold> (wedge | block) it [(the | that)] <trapped> [door] [way]"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
-        Optional(Choice("trapped_choice", map_door_trapped), "trapped", "not trapped"),
+        color_extra,
+        hold_extra,
+        trapped_extra,
     ]
     defaults = {
         "color": "current",
@@ -439,7 +566,7 @@ class WedgeIt(CompoundRule):
         hold = extras["hold"]
         trapped = extras["trapped"]
         print(f"{color} team {hold} wedge the {trapped} door")
-        cmd_door_options(color, hold, "wedge", trapped).execute()
+        execute_actions(lookup_actions("door_options", color, hold, "wedge", trapped), team_key(color))
 
 class RemoveTheWedge(CompoundRule):
     """
@@ -447,9 +574,9 @@ class RemoveTheWedge(CompoundRule):
     """
     spec = "<color> [team] <hold> remove [the] (wedge | block) [from] [(the | that)] <trapped> [door] [way]"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
-        Optional(Choice("trapped_choice", map_door_trapped), "trapped", "not trapped"),
+        color_extra,
+        hold_extra,
+        trapped_extra,
     ]
     defaults = {
         "color": "current",
@@ -462,7 +589,7 @@ class RemoveTheWedge(CompoundRule):
         hold = extras["hold"]
         trapped = extras["trapped"]
         print(f"{color} team {hold} remove the wedge from the {trapped} door")
-        cmd_door_options(color, hold, "wedge", trapped).execute()
+        execute_actions(lookup_actions("door_options", color, hold, "wedge", trapped), team_key(color))
 
 class UseTheWand(CompoundRule):
     """
@@ -470,9 +597,9 @@ class UseTheWand(CompoundRule):
     """
     spec = "<color> [team] <hold> use the (mirror | wand) [on] [(the | that)] <trapped> [(door [way] | opening | room)]"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
-        Optional(Choice("trapped_choice", map_door_trapped), "trapped", "not trapped"),
+        color_extra,
+        hold_extra,
+        trapped_extra,
     ]
     defaults = {
         "color": "current",
@@ -485,35 +612,10 @@ class UseTheWand(CompoundRule):
         hold = extras["hold"]
         trapped = extras["trapped"]
         print(f"{color} team {hold} use the wand on the {trapped} door")
-        cmd_door_options(color, hold, "mirror", trapped).execute()
+        execute_actions(lookup_actions("door_options", color, hold, "mirror", trapped), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_stack_up(color, hold, side):
-    """
-    Press & release command keys for team to stack up (on execution)
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    actions += map_ingame_key_bindings["cmd_1"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    # todo! in 1.0 some doors don't have all stack options available, update if/when Void update
-    match side: 
-        case "split":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "left":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "right":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "auto":
-            actions += map_ingame_key_bindings["cmd_4"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class StackUp(CompoundRule):
     """
     Speech recognise team stack up on door
@@ -525,8 +627,8 @@ class StackUp(CompoundRule):
     spec_end = "[(on (the | that) door [way] | there | here)]"
     spec = f"{spec_start} ({spec_1} | {spec_2} | {spec_3}) {spec_end}"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("side", map_door_stack_sides),
     ]
     defaults = {
@@ -543,52 +645,10 @@ class StackUp(CompoundRule):
         hold = extras["hold"]
         side = extras["side"]
         print(f"{color} team {hold} stack up {side}")
-        cmd_stack_up(color, hold, side).execute()
+        execute_actions(lookup_actions("stack_up", color, hold, side), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_breach_and_clear(color, hold, tool, grenade):
-    """
-    Press & release command keys for team to breach & clear (on execution)
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    if tool == "open":
-        actions += map_ingame_key_bindings["cmd_2"]
-    else:
-        actions += map_ingame_key_bindings["cmd_3"]
-        match tool:
-            case "kick":
-                actions += map_ingame_key_bindings["cmd_1"]
-            case "shotgun":
-                actions += map_ingame_key_bindings["cmd_2"]
-            case "c2":
-                actions += map_ingame_key_bindings["cmd_3"]
-            case "ram":
-                actions += map_ingame_key_bindings["cmd_4"]
-            case "leader":
-                actions += map_ingame_key_bindings["cmd_5"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    match grenade:
-        case "none":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "flashbang":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "stinger":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "gas":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "launcher":
-            actions += map_ingame_key_bindings["cmd_5"]
-        case "leader":
-            actions += map_ingame_key_bindings["cmd_6"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class BreachAndClear(CompoundRule):
     """
     Speech recognise team breach and clear
@@ -613,8 +673,8 @@ class BreachAndClear(CompoundRule):
 
     spec = f"{spec_start} {spec_tool} ({spec_grenade} {spec_clear} | {spec_clear} {spec_grenade})"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("tool", map_door_breach_tools),
         Optional(Choice("grenade_choice", map_door_grenades), "grenade", "none"),
     ]
@@ -631,35 +691,18 @@ class BreachAndClear(CompoundRule):
         tool = extras["tool"]
         grenade = extras["grenade"]
         print(f"{color} team {hold} {tool} the door {grenade} breach and clear")
-        cmd_breach_and_clear(color, hold, tool, grenade).execute()
+        execute_actions(lookup_actions("breach_and_clear", color, hold, tool, grenade), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_pick_lock(color, hold):
-    """
-    Press & release command keys for the team to move to location
-    - assumes player is looking at door
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    # todo! check in 1.0
-    actions += map_ingame_key_bindings["cmd_2"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class PickLock(CompoundRule):
     """
     Speech recognise team pick the lock
     """
     spec = "<color> [team] <hold> pick ([the] door | [the] lock | it)"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
     ]
     defaults = {
         "color": "current",
@@ -670,44 +713,18 @@ class PickLock(CompoundRule):
         color = extras["color"]
         hold = extras["hold"]
         print(f"{color} team {hold} pick the lock")
-        cmd_pick_lock(color, hold).execute()
+        execute_actions(lookup_actions("pick_lock", color, hold), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_ground_options(color, hold, ground_option):
-    """
-    Press & release command keys for the team to move, cover, halt (hold), search area
-    - assumes player is not looking at person or door
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    match ground_option:
-        case "move":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "cover":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "halt":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "resume":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "search":
-            actions += map_ingame_key_bindings["cmd_6"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class GroundOptions(CompoundRule):
     """
     Speech recognise team move, cover, halt (hold), search area
     """
     spec = "<color> [team] <hold> <ground_option>"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("ground_option", map_ground_options),
     ]
     defaults = {
@@ -721,45 +738,21 @@ class GroundOptions(CompoundRule):
         hold = extras["hold"]
         ground_option = extras["ground_option"]
         print(f"{color} team {hold} {ground_option}")
-        cmd_ground_options(color, hold, ground_option).execute()
+        execute_actions(lookup_actions("ground_options", color, hold, ground_option), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_fallin(color, hold, formation):
-    """
-    Press & release command keys for team to fall in (on execution) 
-    - assumes player is not looking at person or door
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    actions += map_ingame_key_bindings["cmd_2"]
-    match formation:
-        case "single":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "double":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "diamond":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "wedge":
-            actions += map_ingame_key_bindings["cmd_4"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class FallIn(CompoundRule):
     """
     Speech recognise team fall in
     """
-    spec_1 = "<color> [team] <hold> (fall in | regroup | form up) [on me] [<formation>]"
-    spec_2 = "<color> [team] <hold> on me [<formation>]"
-    spec = f"({spec_1} | {spec_2})"
+    spec_start = "<color> [team] <hold>"
+    spec_1 = "(fall in | regroup | form up) [on me]"
+    spec_2 = "on me"
+    spec = f"{spec_start} ({spec_1} | {spec_2}) [<formation>]"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("formation", map_ground_fallin_formations),
     ]
     defaults = {
@@ -773,45 +766,18 @@ class FallIn(CompoundRule):
         hold = extras["hold"]
         formation = extras["formation"]
         print(f"{color} team {hold} fall in {formation}")
-        cmd_fallin(color, hold, formation).execute()
+        execute_actions(lookup_actions("fallin", color, hold, formation), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_use_deployable(color, hold, deployable):
-    """
-    Press & release command keys for the team to use deployable (on execution) 
-    - assumes player is not looking at person or door
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    actions += map_ingame_key_bindings["cmd_5"]
-    # start hold for command
-    if hold == "hold":
-        actions += action_hold("down")
-    match deployable:
-        case "flashbang":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "stinger":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "gas":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "chemlight":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "shield":
-            actions += map_ingame_key_bindings["cmd_5"]
-    # end hold for command
-    if hold == "hold":
-        actions += action_hold("up")
-    return actions
-
 class UseDeployable(CompoundRule):
     """
     Speech recognise command team to use a deployable at a location
     """
     spec = "<color> [team] <hold> deploy <deployable>"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
-        Optional(Choice("hold_choice", map_hold), "hold", "go"),
+        color_extra,
+        hold_extra,
         Choice("deployable", map_ground_deployables),
     ]
     defaults = {
@@ -825,31 +791,10 @@ class UseDeployable(CompoundRule):
         hold = extras["hold"]
         deployable = extras["deployable"]
         print(f"{color} team {hold} deploy {deployable}")
-        cmd_use_deployable(color, hold, deployable).execute()
+        execute_actions(lookup_actions("use_deployable", color, hold, deployable), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_npc_player_interact(interaction):
-    """
-    Press & release command keys for player to interact with target (on execution) 
-    - assumes player is looking at person
-    """
-    actions = map_ingame_key_bindings["cmd_menu"]
-    match interaction:
-        case "move here":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "move my position":
-            actions += map_ingame_key_bindings["cmd_2"]
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "move stop":
-            actions += map_ingame_key_bindings["cmd_2"]
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "turn around":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "move to exit":
-            actions += map_ingame_key_bindings["cmd_5"]
-    return actions
-
 class NpcPlayerInteract(CompoundRule):
     """
     Speech recognise command an NPC (not team)
@@ -862,20 +807,10 @@ class NpcPlayerInteract(CompoundRule):
     def _process_recognition(self, node, extras):
         interaction = extras["interaction"]
         print(f"player to NPC {interaction}")
-        cmd_npc_player_interact(interaction).execute()
+        execute_actions(lookup_actions("npc_player_interact", interaction))
 
 # ------------------------------------------------------------------
 
-def cmd_npc_team_restrain(color):
-    """
-    Press & release command keys for team to restrain NPC target (on execution) 
-    - assumes player is looking at person
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    actions += map_ingame_key_bindings["cmd_1"]
-    return actions
-
 class NpcTeamRestrain(CompoundRule):
     """
     Speech recognise command team to restrain NPC target
@@ -884,7 +819,7 @@ class NpcTeamRestrain(CompoundRule):
     spec_1 = "<restrain> (em | them | him | her | [the] target)"
     spec = f"{spec_start} {spec_1}"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
+        color_extra,
         Choice("restrain", map_npc_team_restrain),
     ]
     defaults = {
@@ -895,31 +830,10 @@ class NpcTeamRestrain(CompoundRule):
     def _process_recognition(self, node, extras):
         color = extras["color"]
         print(f"{color} team restrain target")
-        cmd_npc_team_restrain(color).execute()
+        execute_actions(lookup_actions("npc_team_restrain", color), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_npc_team_deploy(color, deployable):
-    """
-    Press & release command keys for team to use deployable on NPC target (on execution) 
-    - assumes player is looking at person
-    """
-    actions = cmd_select_team(color)
-    actions += map_ingame_key_bindings["cmd_menu"]
-    actions += map_ingame_key_bindings["cmd_3"]
-    match deployable:
-        case "taser":
-            actions += map_ingame_key_bindings["cmd_1"]
-        case "pepperspray":
-            actions += map_ingame_key_bindings["cmd_2"]
-        case "pepperball":
-            actions += map_ingame_key_bindings["cmd_3"]
-        case "beanbag":
-            actions += map_ingame_key_bindings["cmd_4"]
-        case "melee":
-            actions += map_ingame_key_bindings["cmd_5"]
-    return actions
-
 class NpcTeamDeploy(CompoundRule):
     """
     Speech recognise command team to use deployable on NPC target
@@ -931,7 +845,7 @@ class NpcTeamDeploy(CompoundRule):
     spec_3 = f"make {spec_target} compliant [(use | with)] [<deployable>]"
     spec = f"{spec_start} ({spec_1} | {spec_2} | {spec_3})"
     extras = [
-        Optional(Choice("color_choice", map_colors), "color", "current"),
+        color_extra,
         Choice("deployable", map_npc_team_deployables),
     ]
     defaults = {
@@ -943,16 +857,10 @@ class NpcTeamDeploy(CompoundRule):
         color = extras["color"]
         deployable = extras["deployable"]
         print(f"{color} team {deployable} target")
-        cmd_npc_team_deploy(color, deployable).execute()
+        execute_actions(lookup_actions("npc_team_deploy", color, deployable), team_key(color))
 
 # ------------------------------------------------------------------
 
-def cmd_select_team_member(team_member):
-    """
-    Press & release select team member key (on execution)
-    """
-    return map_ingame_key_bindings[team_member]
-
 class SelectTeamMember(CompoundRule):
     """
     Speech recognise commands to individual team member
@@ -965,55 +873,10 @@ class SelectTeamMember(CompoundRule):
     def _process_recognition(self, node, extras):
         team_member = extras["team_member"]
         print(f"Select {team_member}")
-        cmd_select_team_member(team_member).execute()
+        execute_actions(lookup_actions("select_team_member", team_member))
 
 # ------------------------------------------------------------------
 
-def cmd_team_member_options(team_member, option, additional_option):
-    """
-    Press & release command keys for interacting with individual team member (on execution) 
-    """
-    actions = map_ingame_key_bindings[team_member]
-    actions += map_ingame_key_bindings["cmd_menu"]
-    match option:
-        case "move":
-            actions += map_ingame_key_bindings["cmd_1"]
-            match additional_option:
-                case "here":
-                    actions += map_ingame_key_bindings["cmd_1"]
-                case "here then back":
-                    actions += map_ingame_key_bindings["cmd_2"]
-        case "focus":
-            actions += map_ingame_key_bindings["cmd_2"]
-            match additional_option:
-                case "here":
-                    actions += map_ingame_key_bindings["cmd_1"]
-                case "my position":
-                    actions += map_ingame_key_bindings["cmd_2"]
-                case "door":
-                    actions += map_ingame_key_bindings["cmd_3"]
-                case "target":
-                    actions += map_ingame_key_bindings["cmd_4"]
-                case "unfocus":
-                    actions += map_ingame_key_bindings["cmd_5"]
-        case "unfocus":
-            actions += map_ingame_key_bindings["cmd_2"]
-            actions += map_ingame_key_bindings["cmd_5"]
-        case "swap":
-            actions += map_ingame_key_bindings["cmd_3"]
-            match additional_option:
-                case "alpha":
-                    actions += map_ingame_key_bindings["cmd_1"]
-                case "bravo":
-                    actions += map_ingame_key_bindings["cmd_2"]
-                case "charlie":
-                    actions += map_ingame_key_bindings["cmd_3"]
-                case "delta":
-                    actions += map_ingame_key_bindings["cmd_4"]
-        case "search":
-            actions += map_ingame_key_bindings["cmd_4"]
-    return actions
-
 class TeamMemberOptions(CompoundRule):
     """
     Speech recognise commands to individual team member
@@ -1037,16 +900,10 @@ class TeamMemberOptions(CompoundRule):
             + (focus_option if focus_option is not None else "")
             + (other_team_member if other_team_member is not None else ""))
         print(f"{team_member} {option} {additional_option}")
-        cmd_team_member_options(team_member, option, additional_option).execute()
+        execute_actions(lookup_actions("team_member_options", team_member, option, additional_option), team_member)
 
 # ------------------------------------------------------------------
 
-def cmd_yell():
-    """
-    Press & release yell key (on execution)
-    """
-    return map_ingame_key_bindings["yell"]
-
 class YellFreeze(BasicRule):
     """
     Speech recognise yell at NPC
@@ -1061,7 +918,7 @@ class YellFreeze(BasicRule):
 
     def _process_recognition(self, node, extras):
         print("Freeze!")
-        cmd_yell().execute()
+        execute_actions(lookup_actions("yell"))
 
 # ------------------------------------------------------------------
 
@@ -1091,7 +948,7 @@ class FreezeRecob(RecognitionObserver):
         self.words = words
         if (not self.frozen) and isinstance(rule, KaldiRule) and rule.name == "ReadyOrNot_priority::YellFreeze":
             print("Freeze!")
-            cmd_yell().execute()
+            execute_actions(lookup_actions("yell"))
             self.frozen = True
 
     def on_recognition(self, words, results, rule, node):
@@ -1106,22 +963,75 @@ class FreezeRecob(RecognitionObserver):
         self.words = False
         self.frozen = False
 
+# ---------------------------------------------------------------------------
+# Precompiled actions
+# The actions of every command are built once, here, from key_sequences_spec for every combination of 
+# its options, so recognitions only look them up in action_table, see lookup_actions()
+
+def make_actions(events):
+    """
+    Returns the actions of a compiled key sequence, pressing consecutive keyboard (or mouse) events 
+    with one Key (or Mouse) action, or NULL_ACTION if there are none
+    """
+    groups = []
+    for binding, state in events:
+        key = ingame_key_bindings[binding]
+        device = 'm' if "mouse_" in key else 'kb'
+        key = key.replace("mouse_", "")
+        if DEBUG_NOCMD_PRINT_ONLY:
+            groups.append(Function(debug_print_key, device=device, key=key if state == PRESS else f'{key}:{state}'))
+            continue
+        key_specs = [f'{key}:down/{min_delay}', f'{key}:up'] if state == PRESS else [f'{key}:{state}']
+        if groups and groups[-1][0] == device:
+            groups[-1][1].extend(key_specs)
+        else:
+            groups.append((device, key_specs))
+    actions = NULL_ACTION
+    for i, group in enumerate(groups):
+        if not DEBUG_NOCMD_PRINT_ONLY:
+            device, key_specs = group
+            group = Mouse(", ".join(key_specs)) if device == 'm' else Key(", ".join(key_specs))
+        actions = group if i == 0 else actions + group
+    return actions
+
+key_sequences = compile_key_sequences(key_sequences_spec, ingame_key_bindings)
+action_table = key_sequences.build(make_actions)
+
+def lookup_actions(command, *args):
+    """
+    Returns the actions of command with args (its options, in order) from action_table, 
+    or NULL_ACTION if they're missing
+    """
+    actions = action_table.get((command,) + args)
+    if actions is None:
+        print(f"{command}{args} isn't in the action table")
+        actions = NULL_ACTION
+    return actions
+
+def dump_action_table(path):
+    with open(path, "w") as file:
+        for line in key_sequences.dump_lines():
+            file.write(f"{line}\n")
+
 # ---------------------------------------------------------------------------
 # Add rules to grammar and create RecognitionObserver instances
 
 grammar.add_rule(ExecuteOrCancelHeldOrder())
 grammar.add_rule(SelectTeam())
 grammar.add_rule(SelectColor())
-grammar.add_rule(DoorOptions())
-grammar.add_rule(WedgeIt())
-grammar.add_rule(RemoveTheWedge())
-grammar.add_rule(UseTheWand())
-grammar.add_rule(StackUp())
-grammar.add_rule(BreachAndClear())
-grammar.add_rule(PickLock())
-grammar.add_rule(GroundOptions())
-grammar.add_rule(FallIn())
-grammar.add_rule(UseDeployable())
+# rules starting with "<color> [team] <hold>" are one rule, so the prefix is compiled once, not into each rule
+grammar.add_rule(SharedPrefixRule("TeamOrders", "<color> [team] <hold>", [
+    DoorOptions(),
+    WedgeIt(),
+    RemoveTheWedge(),
+    UseTheWand(),
+    StackUp(),
+    BreachAndClear(),
+    PickLock(),
+    GroundOptions(),
+    FallIn(),
+    UseDeployable(),
+]))
 grammar.add_rule(NpcPlayerInteract())
 grammar.add_rule(NpcTeamRestrain())
 grammar.add_rule(NpcTeamDeploy())
@@ -1134,6 +1044,9 @@ if USE_NOISE_SINK:
 
 freeze_recob = FreezeRecob()
 
+for problem in key_sequences.warnings + key_sequences.check_rules(expand_rules(grammar.rules)):
+    print(f"Key sequences: {problem}")
+
 # ---------------------------------------------------------------------------
 # Load the grammar instance, register RecognitionObservers, and define how
 # to unload them.
@@ -1144,86 +1057,27 @@ freeze_recob.register()
 
 # ---------------------------------------------------------------------------
 if DEBUG_MODE:
-    from lark import Lark, Token
-    import itertools
-    grammar_string = r"""
-?start: alternative
-
-// ? means that the rule will be inlined iff there is a single child
-?alternative: sequence ("|" sequence)*
-?sequence: single*
-         | sequence "{" WORD "}"  -> special
-
-?single: WORD+               -> literal
-      | "<" WORD ">"         -> reference
-      | "[" alternative "]"  -> optional
-      | "(" alternative ")"
-
-// Match anything which is not whitespace or a control character,
-// we will let the engine handle invalid words
-WORD: /[^\s\[\]<>|(){}]+/
-
-%import common.WS_INLINE
-%ignore WS_INLINE
-"""
-
-    def do_on_tree_item(tree_item):
-        elements = []
-        if tree_item.data == "literal":
-            literal_children = []
-            for child in tree_item.children:
-                literal_children.append(child)
-            elements.append(' '.join(literal_children))
-            literal_children = None
-            return elements
-        if tree_item.data == "optional": 
-            elements.append("")
-            for child in tree_item.children:
-                if child is None: 
-                    continue
-                elements.extend(do_on_tree_item(child))
-            return elements
-        if tree_item.data == "alternative": 
-            for child in tree_item.children:
-                if child is None: 
-                    continue
-                elements.extend(do_on_tree_item(child))
-            return elements
-        if tree_item.data == "sequence": 
-            for child in tree_item.children:
-                if child is None: 
-                    continue
-                elements.append(do_on_tree_item(child))
-            product_iter = itertools.product(*elements)
-            product_list = [' '.join((' '.join(i)).split()) for i in product_iter]
-            product_set = set(product_list)
-            product_list = list(product_set)
-            product_set = None
-            return product_list
+    from tacspeak import grammar_expansion
 
     with open(".debug_grammar_readyornot.txt", "w") as file:
         file.write(grammar.get_complexity_string())
         file.write(f"\n{grammar_priority.get_complexity_string()}\n")
 
         for rule in grammar.rules:
-            file.write(f"\n\n---{rule.name}---")
-            file.write(f"\n{rule.element.gstring()}")
-            file.write(f"\n---")
-
             # file.write(f"\n{rule._element.element_tree_string()}")
             # file.write(f"\n---")
 
-            spec_parser = Lark(grammar_string, parser="lalr")
-            tree = spec_parser.parse(rule.element.gstring())
-            # file.write(f"\n{tree.pretty()}")
-            
             if DEBUG_HEAVY_DUMP_GRAMMAR: 
-                # do_on_tree_item() can be expensive on memory, so we don't do this for 
-                # just DEBUG_MODE
-                for tree_item in tree.children:
-                    tree_item_options = do_on_tree_item(tree_item)
-                    file.write(f"\n{tree_item_options}")
-                file.write(f"\n---")
+                # streams every expansion (or a random sample) of the rule to the file, 
+                # so it can be large, but it isn't held in memory
+                grammar_expansion.dump_rule(file, rule.name, rule.element.gstring(), 
+                                            sample=DEBUG_HEAVY_DUMP_GRAMMAR_SAMPLE)
+            else:
+                count = grammar_expansion.count_expansions(grammar_expansion.parse(rule.element.gstring()))
+                file.write(f"\n\n---{rule.name}---")
+                file.write(f"\n{rule.element.gstring()}")
+                file.write(f"\n--- {count} expansions")
+            file.write(f"\n---")
             try:
                 if hasattr(rule, 'spec'):
                     file.write(f"\n{rule.spec}")
@@ -1252,6 +1106,8 @@ WORD: /[^\s\[\]<>|(){}]+/
         for rule in grammar_priority.rules:
             file.write(f"\n\n{rule.element.gstring()}")
 
+    dump_action_table(".debug_actions_readyornot.txt")
+
 # Unload function which will be called at unload time.
 def unload():
     global grammar
@@ -0,0 +1,152 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Prebuilt compiled grammars, shipped with the build so a fresh install doesn't compile them.
+
+Kaldi compiles each rule (and the top graph joining them) into an FST in its tmp dir, named by a
+hash of the graph and of the model files it depends on, and skips compiling any rule whose FST is
+already there. ``build_bundle()`` (``--build_grammar_bundle``, run by setup.py) loads the grammar
+modules against the shipped model, compiling them into an empty tmp dir, then copies the FSTs to
+BUNDLE_DIR with a manifest of:
+
+- the kaldi_active_grammar version and model dependencies hash the FSTs were compiled for
+- each rule's fingerprint (see ``result_cache.fingerprint_rule()``) and FST filename
+
+``install_bundle()`` runs before the engine connects. If the manifest matches the model (its
+file_cache.json), it copies the FSTs missing from the tmp dir, so Kaldi loads them rather than
+compiling them. ``report_bundle()`` prints how many loaded rules were prebuilt, and which changed
+since the build (e.g. by editing a grammar module or user_settings), so were compiled.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from tacspeak.result_cache import fingerprint_rule
+
+BUNDLE_DIR = "./grammar_bundle/"
+MANIFEST_FILENAME = "manifest.json"
+# written by kaldi_active_grammar in the model dir, with the hash of the model files FSTs depend on
+MODEL_CACHE_FILENAME = "file_cache.json"
+
+
+def kaldi_dirs(settings):
+    """
+    Returns (model_dir, tmp_dir) of KALDI_ENGINE_SETTINGS, with the engine's defaults.
+    """
+    model_dir = settings.get("model_dir") or "kaldi_model"
+    tmp_dir = settings.get("tmp_dir") or os.path.join(model_dir, "cache.tmp")
+    return model_dir, tmp_dir
+
+def read_model_cache(model_dir):
+    try:
+        with open(os.path.join(model_dir, MODEL_CACHE_FILENAME), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def rule_fsts(engine):
+    """
+    Returns {"grammar/rule": (rule, FST filename)} of the rules compiled by the Kaldi engine.
+    """
+    return {f"{wrapper.grammar.name}/{rule.name}": (rule, kaldi_rule.filename)
+            for wrapper in engine._grammar_wrappers.values()
+            for rule, kaldi_rule in wrapper.kaldi_rule_by_rule_dict.items()}
+
+# --------------------------------------------------------------------------
+# Build
+
+def build_bundle(model_dir, bundle_dir=BUNDLE_DIR):
+    """
+    Compiles the grammar modules against `model_dir` and writes their FSTs and manifest to `bundle_dir`.
+    """
+    # imported here, as test_model imports this module
+    from tacspeak.test_model import initialize_kaldi, release_kaldi
+
+    start_time = time.perf_counter()
+    tmp_dir = tempfile.mkdtemp(prefix="tacspeak_bundle_")
+    try:
+        engine = initialize_kaldi(model_dir, audio_input_device=False, tmp_dir=tmp_dir)
+        rules = {name: {"fingerprint": fingerprint_rule(rule), "fst": filename}
+                 for name, (rule, filename) in rule_fsts(engine).items()}
+        release_kaldi(engine)
+
+        model_cache = read_model_cache(model_dir)
+        manifest = {
+            "kag_version": model_cache.get("version"),
+            "dependencies_hash": model_cache.get("dependencies_hash"),
+            "rules": rules,
+            # every FST compiled, including the top graph
+            "fsts": sorted(filename for filename in os.listdir(tmp_dir) if filename.endswith(".fst")),
+        }
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+        os.makedirs(bundle_dir)
+        for filename in manifest["fsts"]:
+            shutil.copyfile(os.path.join(tmp_dir, filename), os.path.join(bundle_dir, filename))
+        with open(os.path.join(bundle_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"Built grammar bundle {bundle_dir}: {len(rules)} rules, {len(manifest['fsts'])} FSTs"
+          + f" in {time.perf_counter() - start_time:.1f}s")
+    return manifest
+
+# --------------------------------------------------------------------------
+# Install
+
+def install_bundle(settings, bundle_dir=BUNDLE_DIR):
+    """
+    Copies the bundle's FSTs into the engine's tmp dir, if they were compiled for its model.
+    Returns the manifest, or None if there's no bundle or it doesn't match.
+    """
+    manifest_path = os.path.join(bundle_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as file:
+        manifest = json.load(file)
+    model_dir, tmp_dir = kaldi_dirs(settings)
+    model_cache = read_model_cache(model_dir)
+    if (model_cache.get("version") != manifest["kag_version"]
+            or model_cache.get("dependencies_hash") != manifest["dependencies_hash"]):
+        print(f"Prebuilt grammars in {bundle_dir} weren't built for the model in {model_dir}, they'll be compiled")
+        return None
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    n_copied = 0
+    for filename in manifest["fsts"]:
+        path = os.path.join(tmp_dir, filename)
+        if os.path.isfile(path):
+            continue
+        # copied then renamed, so Kaldi never loads a partly copied FST
+        copy_path = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(os.path.join(bundle_dir, filename), copy_path)
+        os.replace(copy_path, path)
+        n_copied += 1
+    if n_copied:
+        print(f"Installed {n_copied} prebuilt grammar FSTs from {bundle_dir} into {tmp_dir}")
+    return manifest
+
+def report_bundle(manifest, grammars):
+    """
+    Prints how many of the rules in `grammars` were prebuilt, and which changed since the bundle was built.
+    """
+    names = []
+    changed = []
+    for grammar in grammars:
+        # other rules are compiled into the exported rules referencing them
+        for rule in (rule for rule in grammar.rules if rule.exported):
+            name = f"{grammar.name}/{rule.name}"
+            names.append(name)
+            if manifest["rules"].get(name, {}).get("fingerprint") != fingerprint_rule(rule):
+                changed.append(name)
+    if not names:
+        return
+    print(f"{len(names) - len(changed)} of {len(names)} rules were prebuilt")
+    if changed:
+        print(f"  changed since the build, so compiled: {', '.join(changed)}")
@@ -0,0 +1,225 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Grammar introspection of rules' specs, e.g. ``rule.element.gstring()`` of a loaded dragonfly rule.
+
+    count_expansions()      the exact number of expansions (paths through the spec), by dynamic
+                            programming over the parse tree, without enumerating them
+    iter_expansions()       generates every expansion, one at a time
+    sample_expansions()     generates uniformly random expansions, weighted by their counts
+    dump_rule()             streams a rule's count and expansions (or a sample of them) to a file
+
+Specs are parsed by one Lark parser, compiled on first use. Expansions aren't deduplicated, so a
+phrase reachable by two paths (e.g. ``[a] [a]``) is counted and generated twice.
+
+Usage: ``python -m tacspeak.grammar_expansion "<spec>" [--sample 100] [--limit 1000] [--out phrases.txt]``
+"""
+
+import argparse
+import random
+import sys
+
+GRAMMAR_STRING = r"""
+?start: alternative
+
+// ? means that the rule will be inlined iff there is a single child
+?alternative: sequence ("|" sequence)*
+?sequence: single*
+         | sequence "{" WORD "}"  -> special
+
+?single: WORD+               -> literal
+      | "<" WORD ">"         -> reference
+      | "[" alternative "]"  -> optional
+      | "(" alternative ")"
+
+// Match anything which is not whitespace or a control character,
+// we will let the engine handle invalid words
+WORD: /[^\s\[\]<>|(){}]+/
+
+%import common.WS_INLINE
+%ignore WS_INLINE
+"""
+
+_parser = None
+
+def get_parser():
+    """
+    Returns the shared Lark parser of specs, compiling it on first use.
+    """
+    global _parser
+    if _parser is None:
+        from lark import Lark
+        _parser = Lark(GRAMMAR_STRING, parser="lalr")
+    return _parser
+
+def parse(spec):
+    return get_parser().parse(spec)
+
+def is_tree(node):
+    return hasattr(node, "data")
+
+# --------------------------------------------------------------------------
+# Counting
+
+def count_expansions(node, counts=None):
+    """
+    Returns the number of expansions of a parse tree `node`. `counts` (id(node) -> count) memoises
+    subtrees, so it can be shared between calls over the same tree, e.g. by sample_expansions().
+    """
+    if counts is None:
+        counts = {}
+    if not is_tree(node):
+        return 1
+    count = counts.get(id(node))
+    if count is not None:
+        return count
+    children = [child for child in node.children if child is not None]
+    if node.data in ("literal", "reference"):
+        count = 1
+    elif node.data == "optional":
+        count = 1 + sum(count_expansions(child, counts) for child in children)
+    elif node.data in ("alternative", "start"):
+        count = sum(count_expansions(child, counts) for child in children)
+    elif node.data == "sequence":
+        count = 1
+        for child in children:
+            count *= count_expansions(child, counts)
+    elif node.data == "special":
+        count = count_expansions(children[0], counts)
+    else:
+        raise ValueError(f"Unknown spec node {node.data}")
+    counts[id(node)] = count
+    return count
+
+# --------------------------------------------------------------------------
+# Enumerating
+
+def words_of(node):
+    """
+    Returns the words of a literal or reference `node`.
+    """
+    if node.data == "reference":
+        return (f"<{node.children[0]}>",)
+    return tuple(str(child) for child in node.children)
+
+def iter_expansions(node):
+    """
+    Generates every expansion of a parse tree `node`, as a tuple of words, holding only one path in memory.
+    """
+    if not is_tree(node):
+        yield (str(node),)
+        return
+    children = [child for child in node.children if child is not None]
+    if node.data in ("literal", "reference"):
+        yield words_of(node)
+    elif node.data == "optional":
+        yield ()
+        for child in children:
+            yield from iter_expansions(child)
+    elif node.data in ("alternative", "start"):
+        for child in children:
+            yield from iter_expansions(child)
+    elif node.data == "sequence":
+        yield from iter_sequence(children)
+    elif node.data == "special":
+        yield from iter_expansions(children[0])
+    else:
+        raise ValueError(f"Unknown spec node {node.data}")
+
+def iter_sequence(children):
+    if not children:
+        yield ()
+        return
+    for head in iter_expansions(children[0]):
+        for tail in iter_sequence(children[1:]):
+            yield head + tail
+
+def sample_expansions(node, n, rng=None, counts=None):
+    """
+    Generates `n` expansions of a parse tree `node`, each drawn uniformly at random (with replacement)
+    from all of its expansions.
+    """
+    rng = rng or random.Random(0)
+    counts = {} if counts is None else counts
+    count_expansions(node, counts)
+    for _ in range(n):
+        yield sample_one(node, rng, counts)
+
+def sample_one(node, rng, counts):
+    if not is_tree(node):
+        return (str(node),)
+    children = [child for child in node.children if child is not None]
+    if node.data in ("literal", "reference"):
+        return words_of(node)
+    if node.data in ("optional", "alternative", "start"):
+        # choose a child weighted by its number of expansions, so every expansion is equally likely
+        i = rng.randrange(count_expansions(node, counts))
+        if node.data == "optional":
+            if i == 0:
+                return ()
+            i -= 1
+        for child in children:
+            child_count = count_expansions(child, counts)
+            if i < child_count:
+                return sample_one(child, rng, counts)
+            i -= child_count
+    if node.data == "sequence":
+        return tuple(word for child in children for word in sample_one(child, rng, counts))
+    if node.data == "special":
+        return sample_one(children[0], rng, counts)
+    raise ValueError(f"Unknown spec node {node.data}")
+
+# --------------------------------------------------------------------------
+# Dumping
+
+def dump_rule(file, name, spec, sample=None, limit=None, seed=0):
+    """
+    Writes `name`, its `spec`, the count of its expansions and then the expansions (a random `sample`
+    of them if set and there are more, and at most `limit`) to `file`, one per line, returning the count.
+    """
+    tree = parse(spec)
+    counts = {}
+    count = count_expansions(tree, counts)
+    file.write(f"\n\n---{name}---\n{spec}\n--- {count} expansions")
+    if sample and sample < count:
+        file.write(f", random sample of {sample}")
+        expansions = sample_expansions(tree, sample, random.Random(seed), counts)
+    else:
+        expansions = iter_expansions(tree)
+    if limit is not None and limit < min(sample or count, count):
+        file.write(f", first {limit}")
+    file.write("\n")
+    for i, words in enumerate(expansions):
+        if limit is not None and i >= limit:
+            break
+        file.write(" ".join(words) + "\n")
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count and list the expansions of grammar specs.")
+    parser.add_argument('specs', nargs='+', help='specs, e.g. "(open | close) [the] door"')
+    parser.add_argument('--count', action='store_true', help='only print the count of expansions')
+    parser.add_argument('--sample', type=int, default=None, help='list this many random expansions instead of all')
+    parser.add_argument('--limit', type=int, default=None, help='list at most this many expansions')
+    parser.add_argument('--seed', type=int, default=0, help='seed of --sample')
+    parser.add_argument('--out', default=None, help='write to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    file = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    try:
+        for i, spec in enumerate(args.specs):
+            if args.count:
+                file.write(f"{count_expansions(parse(spec))}\t{spec}\n")
+            else:
+                dump_rule(file, f"spec {i}", spec, args.sample, args.limit, args.seed)
+    finally:
+        if args.out:
+            file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Lints the rules of loaded grammar modules, and proposes smaller specs that recognise the same phrases.
+
+For each rule it reports:
+
+    size        the states and arcs of the rule's word graph (G fst), as dragonfly's Kaldi compiler
+                builds it before it's composed into the decoding graph, and its number of expansions
+    redundant   optionals whose contents can already match nothing, e.g. ``[[the] door]``
+    ambiguous   alternatives (or ``Choice`` keys) that match the same phrase, and sequences that
+                match a phrase more than one way, e.g. ``[door] [door way]``
+    proposed    the spec with redundant optionals dropped, duplicate alternatives removed and common
+                prefixes and suffixes of alternatives factored out, e.g. ``(open the door | open
+                the gate)`` -> ``open the (door | gate)``, with its size, if it's smaller. Whether
+                it matches the same phrases is checked by listing them, when there are few enough
+
+Extras (``<name>`` in specs) aren't rewritten, as their values depend on their specs, but their
+``Choice`` keys are linted. Reordering alternatives can change which extras an ambiguous phrase
+gets, so resolve ambiguities before using a proposed spec.
+
+Decode time scales with the arcs active in the graph; measure it on recorded audio with ``--benchmark``.
+"""
+
+import collections
+
+from dragonfly import (Alternative, Choice, Compound, Dictation, Empty, Impossible, ListRef, Literal, Optional,
+                       Repetition, RuleRef, Sequence)
+
+# max expansions listed to check a proposed spec, or to find ambiguities
+MAX_LISTED_EXPANSIONS = 200000
+
+FstSize = collections.namedtuple("FstSize", ["states", "arcs"])
+
+
+# --------------------------------------------------------------------------
+# Spec trees: a rule's element tree, down to its extras
+
+class Node:
+    """
+    A node of a spec tree: "word" (a word), "seq" or "alt" (of children), "opt" (of one child),
+    or "atom" (an extra or other element that isn't rewritten, with its dragonfly element).
+    """
+    __slots__ = ("kind", "children", "label", "element")
+
+    def __init__(self, kind, children=(), label=None, element=None):
+        self.kind = kind
+        self.children = tuple(children)
+        self.label = label
+        self.element = element
+
+    def key(self):
+        """Returns a key equal for structurally equal nodes."""
+        if self.kind in ("word", "atom"):
+            return (self.kind, self.label)
+        return (self.kind,) + tuple(child.key() for child in self.children)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+def word(text):
+    return Node("word", label=text)
+
+def seq(children):
+    return Node("seq", children)
+
+def alt(children):
+    return Node("alt", children)
+
+def opt(child):
+    return Node("opt", (child,))
+
+EMPTY = seq(())
+
+def spec_tree(element, extras):
+    """
+    Returns the spec tree of a dragonfly `element`, where `extras` (name -> element) are atoms.
+    """
+    if element.name and extras.get(element.name) is element:
+        return Node("atom", label=f"<{element.name}>", element=element)
+    if isinstance(element, Repetition):
+        return Node("atom", label=f"<{element!r}>", element=element)
+    if isinstance(element, Optional):
+        return opt(spec_tree(element.children[0], extras))
+    if isinstance(element, Sequence):
+        return seq(spec_tree(child, extras) for child in element.children)
+    if isinstance(element, Compound):
+        return spec_tree(element.children[0], extras)
+    if isinstance(element, Alternative) and not isinstance(element, (Compound, Choice)):
+        return alt(spec_tree(child, extras) for child in element.children)
+    if isinstance(element, Literal):
+        words = [word(text) for text in element.words]
+        return words[0] if len(words) == 1 else seq(words)
+    if isinstance(element, Empty):
+        return EMPTY
+    if isinstance(element, RuleRef):
+        return Node("atom", label=f"<{element.rule.name}>", element=element)
+    if isinstance(element, Dictation):
+        return Node("atom", label="<dictation>", element=element)
+    return Node("atom", label=f"<{element.name or element.__class__.__name__}>", element=element)
+
+def spec_string(node, top=True):
+    """
+    Returns the spec of a spec tree.
+    """
+    if node.kind in ("word", "atom"):
+        return node.label
+    if node.kind == "opt":
+        return f"[{spec_string(node.children[0])}]"
+    if node.kind == "alt":
+        inner = " | ".join(spec_string(child, top=False) for child in node.children)
+        return inner if top else f"({inner})"
+    if not node.children:
+        return "()"
+    return " ".join(spec_string(child, top=False) if child.kind != "alt" else f"({spec_string(child)})"
+                    for child in node.children)
+
+# --------------------------------------------------------------------------
+# Measuring, as dragonfly's Kaldi compiler builds the word graph
+
+def element_fst_size(element):
+    """
+    Returns the FstSize of the states and arcs a dragonfly `element` adds between two states.
+    """
+    if isinstance(element, Repetition) and getattr(element, "optimize", True) and not element_nullable(element.children[0]):
+        child = element_fst_size(element.children[0])
+        return FstSize(child.states + 2, child.arcs + 3)
+    if isinstance(element, Optional):
+        child = element_fst_size(element.children[0])
+        return FstSize(child.states, child.arcs + 1)
+    if isinstance(element, Sequence):
+        if not element.children:
+            return FstSize(0, 1)
+        sizes = [element_fst_size(child) for child in element.children]
+        return FstSize(sum(size.states for size in sizes) + len(sizes) - 1, sum(size.arcs for size in sizes))
+    if isinstance(element, Alternative):
+        sizes = [element_fst_size(child) for child in element.children]
+        return FstSize(sum(size.states for size in sizes), sum(size.arcs for size in sizes))
+    if isinstance(element, Literal):
+        return FstSize(len(element.words) - 1, len(element.words))
+    if isinstance(element, RuleRef):
+        rule = element_fst_size(element.rule.element)
+        return FstSize(rule.states + 3, rule.arcs + 3)
+    if isinstance(element, ListRef):
+        items = [item.split() for item in element.list.get_list_items()]
+        return FstSize(sum(len(item) - 1 for item in items), sum(len(item) for item in items))
+    if isinstance(element, Dictation):
+        return FstSize(1, 2)
+    if isinstance(element, (Empty, Impossible)):
+        return FstSize(0, 1)
+    raise ValueError(f"Can't measure {element!r}")
+
+def element_nullable(element):
+    """
+    Returns whether a dragonfly `element` can match no words.
+    """
+    if isinstance(element, (Optional, Empty)):
+        return True
+    if isinstance(element, Sequence):
+        return all(element_nullable(child) for child in element.children)
+    if isinstance(element, Alternative):
+        return any(element_nullable(child) for child in element.children)
+    if isinstance(element, RuleRef):
+        return element_nullable(element.rule.element)
+    return False
+
+def element_count(element):
+    """
+    Returns the number of expansions of a dragonfly `element`, counting dictation as one.
+    """
+    if isinstance(element, Optional):
+        return 1 + element_count(element.children[0])
+    if isinstance(element, Sequence):
+        count = 1
+        for child in element.children:
+            count *= element_count(child)
+        return count
+    if isinstance(element, Alternative):
+        return sum(element_count(child) for child in element.children)
+    if isinstance(element, RuleRef):
+        return element_count(element.rule.element)
+    if isinstance(element, ListRef):
+        return len(element.list.get_list_items())
+    if isinstance(element, Impossible):
+        return 0
+    return 1
+
+def fst_size(node):
+    """
+    Returns the FstSize of a spec tree, as its element would be compiled.
+    """
+    if node.kind == "word":
+        return FstSize(0, 1)
+    if node.kind == "atom":
+        return element_fst_size(node.element)
+    if node.kind == "opt":
+        child = fst_size(node.children[0])
+        return FstSize(child.states, child.arcs + 1)
+    sizes = [fst_size(child) for child in node.children]
+    states = sum(size.states for size in sizes)
+    arcs = sum(size.arcs for size in sizes)
+    if node.kind == "alt":
+        return FstSize(states, arcs)
+    if not node.children:
+        return FstSize(0, 1)
+    return FstSize(states + len(sizes) - 1, arcs)
+
+def rule_fst_size(node):
+    """
+    Returns the FstSize of an exported rule of spec tree `node`, including its start and end states.
+    """
+    size = fst_size(node)
+    return FstSize(size.states + 3, size.arcs + 1)
+
+def nullable(node):
+    if node.kind == "word":
+        return False
+    if node.kind == "atom":
+        return element_nullable(node.element)
+    if node.kind == "opt":
+        return True
+    if node.kind == "alt":
+        return any(nullable(child) for child in node.children)
+    return all(nullable(child) for child in node.children)
+
+def count(node):
+    """
+    Returns the number of expansions of a spec tree, with atoms counted as one.
+    """
+    if node.kind in ("word", "atom"):
+        return 1
+    if node.kind == "opt":
+        return 1 + count(node.children[0])
+    if node.kind == "alt":
+        return sum(count(child) for child in node.children)
+    result = 1
+    for child in node.children:
+        result *= count(child)
+    return result
+
+def expansions(node):
+    """
+    Generates the expansions of a spec tree, as tuples of words and atom labels.
+    """
+    if node.kind in ("word", "atom"):
+        yield (node.label,)
+    elif node.kind == "opt":
+        yield ()
+        yield from expansions(node.children[0])
+    elif node.kind == "alt":
+        for child in node.children:
+            yield from expansions(child)
+    else:
+        yield from sequence_expansions(node.children)
+
+def sequence_expansions(children):
+    if not children:
+        yield ()
+        return
+    for head in expansions(children[0]):
+        for tail in sequence_expansions(children[1:]):
+            yield head + tail
+
+def phrases(node):
+    """
+    Returns the set of distinct expansions of a spec tree, or None if there are too many to list.
+    """
+    if count(node) > MAX_LISTED_EXPANSIONS:
+        return None
+    return set(expansions(node))
+
+# --------------------------------------------------------------------------
+# Linting
+
+def find_redundant_optionals(node):
+    """
+    Returns the specs of optionals in a spec tree whose contents can already match nothing.
+    """
+    found = []
+    if node.kind == "opt" and nullable(node.children[0]):
+        found.append(spec_string(node))
+    for child in node.children:
+        found += find_redundant_optionals(child)
+    return found
+
+def find_ambiguities(node):
+    """
+    Returns descriptions of alternatives in a spec tree matching the same phrase, and of
+    sequences matching a phrase more than one way.
+    """
+    found = []
+    for child in node.children:
+        found += find_ambiguities(child)
+    if found:
+        # report the innermost ambiguities only
+        return found
+    if node.kind == "alt":
+        child_phrases = [phrases(child) for child in node.children]
+        for i, j in ((i, j) for i in range(len(node.children)) for j in range(i + 1, len(node.children))):
+            if child_phrases[i] is None or child_phrases[j] is None:
+                continue
+            overlap = child_phrases[i] & child_phrases[j]
+            if overlap:
+                example = " ".join(min(overlap, key=len)) or "(nothing)"
+                found.append(f"alternatives {spec_string(node.children[i], False)} and "
+                             + f"{spec_string(node.children[j], False)} both match: {example}")
+    elif node.kind in ("seq", "opt"):
+        distinct = phrases(node)
+        if distinct is not None and len(distinct) < count(node):
+            found.append(f"{spec_string(node, False)} matches {count(node) - len(distinct)} phrases more than one way")
+    return found
+
+def choice_ambiguities(name, element):
+    """
+    Returns descriptions of the keys of a Choice extra (or Optional Choice) matching the same phrase.
+    """
+    choice = element.children[0] if isinstance(element, Optional) else element
+    if not isinstance(choice, Choice):
+        return []
+    keys = list(choice._choices.items())
+    key_phrases = [phrases(spec_tree(child, {})) for child in choice.children]
+    found = []
+    for i, j in ((i, j) for i in range(len(keys)) for j in range(i + 1, len(keys))):
+        if key_phrases[i] is None or key_phrases[j] is None:
+            continue
+        overlap = key_phrases[i] & key_phrases[j]
+        if overlap:
+            example = " ".join(min(overlap, key=len)) or "(nothing)"
+            values = "the same value" if keys[i][1] == keys[j][1] else f"{keys[i][1]!r} and {keys[j][1]!r}"
+            found.append(f"<{name}> keys {keys[i][0]!r} and {keys[j][0]!r} both match ({values}): {example}")
+    return found
+
+# --------------------------------------------------------------------------
+# Optimizing
+
+def optimize(node):
+    """
+    Returns a spec tree matching the same phrases as `node`, rewritten until it stops getting smaller.
+    """
+    while True:
+        rewritten = rewrite(node)
+        if rewritten == node:
+            return node
+        node = rewritten
+
+def items(node):
+    """Returns the children of a sequence, or [node]."""
+    return list(node.children) if node.kind == "seq" else [node]
+
+def rewrite(node):
+    if node.kind in ("word", "atom"):
+        return node
+    children = [rewrite(child) for child in node.children]
+    if node.kind == "opt":
+        child = children[0]
+        # [x] where x can already match nothing
+        return child if nullable(child) else opt(child)
+    if node.kind == "seq":
+        flat = [item for child in children for item in items(child)]
+        return flat[0] if len(flat) == 1 else seq(flat)
+
+    # alternatives: flatten, and drop duplicates
+    flat = []
+    for child in children:
+        for item in (child.children if child.kind == "alt" else (child,)):
+            if item not in flat:
+                flat.append(item)
+    # (a | ()) -> [a]
+    if EMPTY in flat and len(flat) > 1:
+        rest = [item for item in flat if item != EMPTY]
+        return opt(rest[0] if len(rest) == 1 else alt(rest))
+    factored = factor(flat, prefix=True)
+    if factored is None:
+        factored = factor(flat, prefix=False)
+    if factored is not None:
+        return factored
+    return flat[0] if len(flat) == 1 else alt(flat)
+
+def factor(alternatives, prefix):
+    """
+    Returns alternatives with the first group sharing a first (or last) item factored out, e.g.
+    (a b | a c | d) -> (a (b | c) | d), or None if none share one.
+    """
+    groups = {}
+    for i, alternative in enumerate(alternatives):
+        sequence = items(alternative)
+        if sequence:
+            groups.setdefault(sequence[0] if prefix else sequence[-1], []).append(i)
+    for shared, indexes in groups.items():
+        if len(indexes) < 2:
+            continue
+        rests = []
+        for i in indexes:
+            sequence = items(alternatives[i])
+            rest = sequence[1:] if prefix else sequence[:-1]
+            rests.append(rest[0] if len(rest) == 1 else seq(rest))
+        factored = seq([shared, alt(rests)] if prefix else [alt(rests), shared])
+        result = []
+        for i, alternative in enumerate(alternatives):
+            if i == indexes[0]:
+                result.append(factored)
+            elif i not in indexes:
+                result.append(alternative)
+        return result[0] if len(result) == 1 else alt(result)
+    return None
+
+# --------------------------------------------------------------------------
+# Reporting
+
+def rule_spec_tree(rule):
+    return spec_tree(rule.element, getattr(rule, "_extras", {}))
+
+def lint_rule(rule):
+    """
+    Returns a dict of the lint results of a loaded `rule`, see module docstring.
+    """
+    tree = rule_spec_tree(rule)
+    extras = getattr(rule, "_extras", {})
+    size = rule_fst_size(tree)
+    result = {
+        'rule': rule.name,
+        'spec': spec_string(tree),
+        'states': size.states,
+        'arcs': size.arcs,
+        'expansions': element_count(rule.element),
+        'redundant': find_redundant_optionals(tree),
+        'ambiguous': find_ambiguities(tree),
+        'proposed': None,
+    }
+    for name, element in extras.items():
+        result['ambiguous'] += choice_ambiguities(name, element)
+        choice = element.children[0] if isinstance(element, Optional) else element
+        if isinstance(choice, Choice):
+            for child in choice.children:
+                result['redundant'] += [f"<{name}> {spec}" for spec in find_redundant_optionals(spec_tree(child, {}))]
+
+    proposed = optimize(tree)
+    proposed_size = rule_fst_size(proposed)
+    if proposed_size.arcs < size.arcs or proposed_size.states < size.states:
+        before, after = phrases(tree), phrases(proposed)
+        result['proposed'] = {
+            'spec': spec_string(proposed),
+            'states': proposed_size.states,
+            'arcs': proposed_size.arcs,
+            'verified': None if before is None or after is None else before == after,
+        }
+    return result
+
+def format_lint(result):
+    lines = [f"{result['rule']}",
+             f"  spec: {result['spec']}",
+             f"  size: {result['states']} states, {result['arcs']} arcs, {result['expansions']} expansions"]
+    lines += [f"  redundant optional: {spec}" for spec in result['redundant']]
+    lines += [f"  ambiguous: {description}" for description in result['ambiguous']]
+    proposed = result['proposed']
+    if proposed:
+        checked = {True: "matches the same phrases", False: "DOESN'T match the same phrases",
+                   None: "too many phrases to check"}[proposed['verified']]
+        lines.append(f"  proposed spec: {proposed['spec']}")
+        lines.append(f"  proposed size: {proposed['states']} states ({percent(proposed['states'], result['states'])}),"
+                     + f" {proposed['arcs']} arcs ({percent(proposed['arcs'], result['arcs'])}), {checked}")
+    return "\n".join(lines)
+
+def percent(new, old):
+    return f"{(new / max(old, 1)) - 1.0:+.1%}"
+
+def lint_grammars(grammars, out_path=None):
+    """
+    Lints the rules of `grammars` (e.g. engine.grammars), printing (and writing to `out_path`) a
+    report. Returns the list of lint_rule() results.
+    """
+    results = []
+    lines = []
+    total = [0, 0, 0, 0]
+    for grammar in grammars:
+        for rule in grammar.rules:
+            try:
+                result = lint_rule(rule)
+            except Exception as e:
+                lines.append(f"{grammar.name}/{rule.name}\n  can't lint: {e}")
+                continue
+            result['rule'] = f"{grammar.name}/{rule.name}"
+            results.append(result)
+            lines.append(format_lint(result))
+            proposed = result['proposed'] or result
+            total = [total[0] + result['states'], total[1] + result['arcs'],
+                     total[2] + proposed['states'], total[3] + proposed['arcs']]
+    lines.append(f"\nTotal: {total[0]} states, {total[1]} arcs; with proposed specs: {total[2]} states"
+                 + f" ({percent(total[2], total[0])}), {total[3]} arcs ({percent(total[3], total[1])})")
+    report = "\n\n".join(lines)
+    print(report)
+    if out_path:
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+    return results
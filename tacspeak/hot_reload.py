@@ -0,0 +1,223 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Hot reloading of grammar modules and user settings, without restarting the engine (HOT_RELOAD).
+
+``HotReloader`` loads the ``_*.py`` grammar modules itself, as modules named after their files, then
+polls the modification times of them and of user_settings on an engine timer. Between utterances:
+
+- changed (or deleted) grammar modules are unloaded with their ``unload()``, then loaded again (as
+  are new ones)
+- if user_settings changed, it's loaded again, engine settings in LIVE_ENGINE_SETTINGS are applied,
+  settings that need a restart are listed, and every grammar module is reloaded, as they read their
+  settings when they're loaded
+
+Reloading a grammar module rebuilds the graphs of its rules, but Kaldi only compiles those that aren't
+in its cache (in the model's tmp dir, by hash of the graph), i.e. the rules whose spec changed.
+Each reload prints how long it took, and which rules were added, removed or changed.
+"""
+
+import importlib.util
+import os
+import sys
+import time
+import traceback
+
+from dragonfly import Grammar
+
+from tacspeak.result_cache import fingerprint_rule
+
+DEFAULT_INTERVAL_S = 1.0
+
+# engine settings read while recognising, rather than when the engine connects
+LIVE_ENGINE_SETTINGS = ("expected_error_rate_threshold",)
+
+# user settings read when Tacspeak starts, rather than by grammar modules
+STARTUP_SETTINGS = ("DEBUG_MODE", "LATENCY_INSTRUMENTATION", "LATENCY_DUMP_PATH", "LATENCY_DUMP_INTERVAL_S",
+                    "HOT_RELOAD", "HOT_RELOAD_INTERVAL_S", "LAZY_LOAD", "LAZY_UNLOAD_AFTER_S", "LAZY_LOAD_INTERVAL_S")
+
+
+def is_grammar_module(path):
+    filename = os.path.basename(path)
+    return os.path.isfile(path) and filename.startswith("_") and filename.endswith(".py")
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def load_module(name, path):
+    """
+    Returns the module `name` executed from `path` and registered in sys.modules, or None if it raised.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        print(f"Failed to load {path}:\n{traceback.format_exc()}")
+        del sys.modules[name]
+        return None
+    return module
+
+def unload_module(module):
+    """
+    Calls the module's unload(), or if it has none, unloads any grammars it holds.
+    """
+    try:
+        unload = getattr(module, "unload", None)
+        if callable(unload):
+            unload()
+        else:
+            for value in list(vars(module).values()):
+                if isinstance(value, Grammar) and value.loaded:
+                    value.unload()
+    except Exception:
+        print(f"Failed to unload {module.__name__}:\n{traceback.format_exc()}")
+    sys.modules.pop(module.__name__, None)
+
+def same_value(a, b):
+    # functions are new objects each time a module is loaded, so compare their code
+    if callable(a) and callable(b):
+        return getattr(a, "__code__", a) == getattr(b, "__code__", b)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_value(a[key], b[key]) for key in a)
+    return a == b
+
+def changed_settings(old, new):
+    """
+    Returns the names of settings (UPPER_CASE attributes) that differ between two user_settings modules.
+    """
+    names = {name for module in (old, new) if module is not None for name in vars(module) if name.isupper()}
+    missing = object()
+    return sorted(name for name in names
+                  if not same_value(getattr(old, name, missing), getattr(new, name, missing)))
+
+def rule_fingerprints(engine):
+    return {f"{grammar.name}/{rule.name}": fingerprint_rule(rule) for grammar in engine.grammars for rule in grammar.rules}
+
+class HotReloader:
+    """
+    Loads grammar modules from `grammar_path`, and reloads them (and user_settings from
+    `user_settings_path`) when they change, see module docstring.
+    """
+    def __init__(self, engine, grammar_path, user_settings_path, interval_s=DEFAULT_INTERVAL_S):
+        self.engine = engine
+        self.grammar_path = os.path.abspath(grammar_path)
+        self.user_settings_path = os.path.abspath(user_settings_path)
+        self.interval_s = interval_s
+        # path -> (mtime, module or None if it failed to load)
+        self.modules = {}
+        self.user_settings_mtime = get_mtime(self.user_settings_path)
+        self.in_phrase = False
+        self.timer = None
+
+    def grammar_module_paths(self):
+        paths = [os.path.join(self.grammar_path, filename) for filename in sorted(os.listdir(self.grammar_path))]
+        return [path for path in paths if is_grammar_module(path)]
+
+    def load(self):
+        """
+        Loads every grammar module, and starts watching for changes.
+        """
+        for path in self.grammar_module_paths():
+            self.load_grammar_module(path)
+        self.timer = self.engine.create_timer(self.check, self.interval_s)
+        return self
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+
+    def load_grammar_module(self, path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        self.modules[path] = (get_mtime(path), load_module(name, path))
+
+    def unload_grammar_module(self, path):
+        mtime, module = self.modules.pop(path)
+        if module is not None:
+            unload_module(module)
+
+    # ----------------------------------------------------------------------
+    # Engine callbacks, so reloads don't happen mid-utterance
+
+    def on_begin(self):
+        self.in_phrase = True
+
+    def on_end(self):
+        self.in_phrase = False
+
+    # ----------------------------------------------------------------------
+    # Reloading
+
+    def check(self):
+        """
+        Reloads anything that changed since the last check, unless an utterance is being recognised.
+        """
+        if self.in_phrase:
+            return
+        settings_changed = get_mtime(self.user_settings_path) != self.user_settings_mtime
+        paths = self.grammar_module_paths()
+        changed = [path for path in paths if path not in self.modules or get_mtime(path) != self.modules[path][0]]
+        removed = [path for path in self.modules if path not in paths]
+        if settings_changed or changed or removed:
+            self.reload(settings_changed, paths if settings_changed else changed, removed)
+
+    def reload(self, settings_changed, paths, removed=()):
+        start_time = time.perf_counter()
+        before = rule_fingerprints(self.engine)
+        for path in list(removed) + [path for path in paths if path in self.modules]:
+            self.unload_grammar_module(path)
+        if settings_changed:
+            self.reload_user_settings()
+        for path in paths:
+            self.load_grammar_module(path)
+        # the Kaldi engine compiles rules queued by lazy compilation here
+        if hasattr(self.engine, "prepare_for_recognition"):
+            self.engine.prepare_for_recognition()
+        elapsed_s = time.perf_counter() - start_time
+
+        after = rule_fingerprints(self.engine)
+        added = [name for name in after if name not in before]
+        dropped = [name for name in before if name not in after]
+        changed = [name for name in after if name in before and after[name] != before[name]]
+        names = [os.path.basename(path) for path in list(paths) + list(removed)]
+        print(f"Reloaded {', '.join(names) or 'user_settings'} in {elapsed_s:.2f}s: {len(changed)} rules changed,"
+              + f" {len(added)} added, {len(dropped)} removed, {len(after) - len(changed) - len(added)} unchanged")
+        for label, rule_names in (("changed", changed), ("added", added), ("removed", dropped)):
+            if rule_names:
+                print(f"  {label}: {', '.join(rule_names)}")
+
+    def reload_user_settings(self):
+        self.user_settings_mtime = get_mtime(self.user_settings_path)
+        old = sys.modules.get("user_settings")
+        new = load_module("user_settings", self.user_settings_path)
+        if new is None:
+            if old is not None:
+                sys.modules["user_settings"] = old
+            return
+        for name in changed_settings(old, new):
+            if name == "KALDI_ENGINE_SETTINGS":
+                self.apply_engine_settings(getattr(old, name, {}), getattr(new, name, {}))
+            elif name in STARTUP_SETTINGS:
+                print(f"user_settings {name} changed, restart Tacspeak to fully apply it")
+            else:
+                print(f"user_settings {name} changed")
+
+    def apply_engine_settings(self, old, new):
+        options = getattr(self.engine, "_options", {})
+        for key in sorted(set(old) | set(new)):
+            if same_value(old.get(key), new.get(key)):
+                continue
+            if key in LIVE_ENGINE_SETTINGS and key in options:
+                options[key] = new.get(key)
+                print(f"user_settings KALDI_ENGINE_SETTINGS {key} changed to {new.get(key)!r}")
+            else:
+                print(f"user_settings KALDI_ENGINE_SETTINGS {key} changed, restart Tacspeak to apply it")
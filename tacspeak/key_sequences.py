@@ -0,0 +1,201 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Compiles a grammar module's declarative key-sequence spec, once at load, into a flat sequence of
+key events for every combination of each command's options, so recognitions only look them up.
+
+A spec maps each command name to its ``options`` (argument name -> list of values, in argument order)
+and its ``sequence`` of steps, where a step is either:
+
+    "binding"              press and release a key binding, e.g. "cmd_menu"
+    "binding:down"         press (or ":up" release) a key binding, e.g. "cmd_hold:down"
+    {selector: table}      the steps in ``table`` for the value of the ``selector`` option, or for the
+                           values of a tuple of options, where ``"*"`` matches any value. A table value
+                           is a step string, or a tuple of them (``()`` for nothing)
+
+For example::
+
+    hold_down = {"hold": {"hold": "cmd_hold:down", "go": ()}}
+    spec = {
+        "stack_up": {
+            "options": {"color": ["blue", "red", "current"], "hold": ["go", "hold"], "side": ["left", "right"]},
+            "sequence": [{"color": {"blue": "blue", "red": "red", "current": ()}}, "cmd_menu", "cmd_1",
+                         hold_down, {"side": {"left": "cmd_2", "right": "cmd_3"}}, hold_up],
+        },
+    }
+
+The compiler checks that every binding exists, that every combination of options is matched by a
+table entry (an exact value beats ``"*"``), and that no combination is matched by two equally specific
+entries with different steps (a conflict). Entries that never match are reported as unreachable.
+"""
+
+import itertools
+import types
+
+PRESS = "press"
+DOWN = "down"
+UP = "up"
+WILDCARD = "*"
+
+
+class KeySequenceError(ValueError):
+    pass
+
+
+def parse_step(step):
+    """
+    Returns the (binding, state) key event of a step string.
+    """
+    binding, _, state = step.partition(":")
+    return (binding, state or PRESS)
+
+def table_steps(value):
+    return (value,) if isinstance(value, str) else tuple(value)
+
+class KeySequences:
+    """
+    A compiled key-sequence spec, see compile_key_sequences().
+    """
+    def __init__(self, options, sequences, warnings):
+        # command -> {argument: values}
+        self.options = options
+        # (command, *values) -> tuple of (binding, state) events
+        self.sequences = sequences
+        self.warnings = warnings
+
+    def build(self, make_action):
+        """
+        Returns an immutable map of (command, *values) to `make_action(events)`, e.g. a dragonfly action.
+        Sequences with the same events share an action.
+        """
+        actions = {}
+        table = {}
+        for key, events in self.sequences.items():
+            if events not in actions:
+                actions[events] = make_action(events)
+            table[key] = actions[events]
+        return types.MappingProxyType(table)
+
+    def check_rules(self, rules):
+        """
+        Returns a list of the values (and defaults) of `rules`' extras that aren't an option of
+        any command's argument with the same name.
+        """
+        argument_options = {}
+        for options in self.options.values():
+            for argument, values in options.items():
+                argument_options.setdefault(argument, set()).update(values)
+        problems = []
+        for rule in rules:
+            defaults = getattr(rule, "_defaults", {})
+            for name, element in getattr(rule, "_extras", {}).items():
+                if name not in argument_options:
+                    continue
+                choices = getattr(getattr(element, "_child", element), "_choices", None)
+                # dragonfly keeps a list of choices as {choice: None}, and a None value is its spoken words
+                values = ([key if value is None else value for key, value in choices.items()]
+                          if isinstance(choices, dict) else list(choices or []))
+                values += [default for default in (getattr(element, "default", None), defaults.get(name))
+                           if default is not None]
+                problems += [f"{rule.name} {name}={value!r} isn't an option of any command"
+                             for value in dict.fromkeys(values) if value not in argument_options[name]]
+        return problems
+
+    def dump_lines(self):
+        return [f"{key[0]}{key[1:]}: {' '.join(f'{binding}:{state}' for binding, state in events)}"
+                for key, events in self.sequences.items()]
+
+def compile_key_sequences(spec, bindings):
+    """
+    Returns the KeySequences of `spec` (see module docstring), where `bindings` are the valid key binding names.
+    Raises KeySequenceError listing every error.
+    """
+    errors = []
+    warnings = []
+    all_options = {}
+    sequences = {}
+    for command, command_spec in spec.items():
+        options = dict(command_spec.get("options", {}))
+        all_options[command] = options
+        for argument, values in options.items():
+            if len(set(values)) != len(values):
+                errors.append(f"{command}: option {argument} has duplicate values")
+
+        # check steps, and count how often each table entry is used
+        used = {}
+        def check_step(step, where):
+            binding, state = parse_step(step)
+            if binding not in bindings:
+                errors.append(f"{command}: {where} unknown binding {binding!r}")
+            if state not in (PRESS, DOWN, UP):
+                errors.append(f"{command}: {where} unknown key state {state!r} of {binding!r}")
+        for i, step in enumerate(command_spec["sequence"]):
+            if isinstance(step, str):
+                check_step(step, f"step {i}")
+                continue
+            for selector, table in step.items():
+                arguments = selector if isinstance(selector, tuple) else (selector,)
+                for argument in arguments:
+                    if argument not in options:
+                        errors.append(f"{command}: step {i} selects {argument!r}, which isn't an option")
+                for entry, value in table.items():
+                    entry_values = entry if isinstance(selector, tuple) else (entry,)
+                    if len(entry_values) != len(arguments):
+                        errors.append(f"{command}: step {i} entry {entry!r} should have {len(arguments)} values")
+                    for step_string in table_steps(value):
+                        check_step(step_string, f"step {i} entry {entry!r}")
+                    used[(i, selector, entry)] = 0
+        if errors:
+            continue
+
+        arguments = list(options)
+        for values in itertools.product(*options.values()):
+            combination = dict(zip(arguments, values))
+            events = []
+            for i, step in enumerate(command_spec["sequence"]):
+                if isinstance(step, str):
+                    events.append(parse_step(step))
+                    continue
+                for selector, table in step.items():
+                    steps = match_table(command, i, selector, table, combination, used, errors)
+                    events += [parse_step(step_string) for step_string in steps]
+            sequences[(command,) + values] = tuple(events)
+
+        for (i, selector, entry), n in used.items():
+            if n == 0:
+                warnings.append(f"{command}: step {i} entry {selector}={entry!r} is unreachable")
+
+    if errors:
+        raise KeySequenceError("Invalid key sequences:\n" + "\n".join(errors))
+    return KeySequences(all_options, types.MappingProxyType(sequences), warnings)
+
+def match_table(command, i, selector, table, combination, used, errors):
+    """
+    Returns the steps of the most specific entry of `table` matching `combination`.
+    """
+    arguments = selector if isinstance(selector, tuple) else (selector,)
+    values = tuple(combination[argument] for argument in arguments)
+    best = []
+    best_specificity = -1
+    for entry in table:
+        entry_values = entry if isinstance(selector, tuple) else (entry,)
+        if any(entry_value != WILDCARD and entry_value != value for entry_value, value in zip(entry_values, values)):
+            continue
+        specificity = sum(1 for entry_value in entry_values if entry_value != WILDCARD)
+        if specificity > best_specificity:
+            best, best_specificity = [entry], specificity
+        elif specificity == best_specificity:
+            best.append(entry)
+    if not best:
+        errors.append(f"{command}: step {i} has no entry for {selector}={values if len(values) > 1 else values[0]!r}")
+        return ()
+    steps = {table_steps(table[entry]) for entry in best}
+    if len(steps) > 1:
+        errors.append(f"{command}: step {i} entries {best} conflict for {selector}={values!r}")
+    for entry in best:
+        used[(i, selector, entry)] += 1
+    return table_steps(table[best[0]])
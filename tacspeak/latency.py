@@ -0,0 +1,229 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Per-stage latency instrumentation of the live recognition loop, enabled with
+``LATENCY_INSTRUMENTATION = True`` in ``tacspeak/user_settings.py``.
+
+Each utterance is timed through these stages:
+
+    decode   end of speech (VAD or listen key) -> the decoder's final output
+    parse    final output -> the rule is recognised (``on_recognition``)
+    build    recognised -> the first action starts executing, i.e. the rule's ``_process_recognition``
+    execute  the first action starts -> the last action finishes
+    total    end of speech -> the rule has finished processing
+
+Durations are added to log-bucketed histograms per grammar, rule (for a ``SharedPrefixRule``,
+the rule spoken) and stage, which cost a few list operations per utterance, and percentiles are
+written to ``LATENCY_DUMP_PATH`` every ``LATENCY_DUMP_INTERVAL_S`` seconds (checked at the end of
+each utterance) and on exit.
+
+With ``ASYNC_ACTIONS`` actions are executed on the action executor's thread instead, so only
+actions executed on the engine's thread are timed in build and execute, and the executor's
+queue wait and execution times are written after the stages.
+"""
+
+import math
+import threading
+import time
+
+from dragonfly.actions.action_base import ActionBase
+from dragonfly.grammar.recobs_callbacks import (register_beginning_callback, register_recognition_callback,
+                                                register_post_recognition_callback, register_failure_callback,
+                                                register_ending_callback)
+
+from tacspeak.shared_rules import SharedPrefixRule
+
+DEFAULT_DUMP_PATH = "./.tacspeak_latency.txt"
+DEFAULT_DUMP_INTERVAL_S = 60.0
+STAGES = ("decode", "parse", "build", "execute", "total")
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations in ms, in log-spaced buckets from MIN_MS to MAX_MS,
+    so percentiles are accurate to within a bucket (about 6%).
+    """
+    MIN_MS = 0.01
+    MAX_MS = 100000.0
+    BUCKETS_PER_DECADE = 40
+
+    def __init__(self):
+        n_buckets = int(math.log10(self.MAX_MS / self.MIN_MS) * self.BUCKETS_PER_DECADE) + 1
+        self.counts = [0] * n_buckets
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        i = 0
+        if ms > self.MIN_MS:
+            i = min(len(self.counts) - 1, int(math.log10(ms / self.MIN_MS) * self.BUCKETS_PER_DECADE))
+        self.counts[i] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket containing the p-th percentile, in ms.
+        """
+        if not self.count:
+            return 0.0
+        target = math.ceil(self.count * p / 100.0)
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return min(self.max_ms, self.MIN_MS * 10 ** ((i + 1) / self.BUCKETS_PER_DECADE))
+        return self.max_ms
+
+    def mean(self):
+        return self.total_ms / max(1, self.count)
+
+
+class LatencyRecorder:
+    """
+    Times each utterance's stages (see module docstring) from the engine's recognition callbacks,
+    its decoder, and action execution, see install().
+    """
+    def __init__(self, dump_path=DEFAULT_DUMP_PATH, dump_interval_s=DEFAULT_DUMP_INTERVAL_S):
+        self.dump_path = dump_path
+        self.dump_interval_s = dump_interval_s
+        self.histograms = {}
+        self.marks = {}
+        self.rule_key = None
+        self.action_depth = 0
+        self.thread_id = None
+        self.executor = None
+        self.last_dump_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def install(self, engine):
+        """
+        Registers the recognition callbacks, and wraps the engine's decoder and ActionBase.execute().
+        Call after engine.connect().
+        """
+        register_beginning_callback(self.on_begin)
+        register_recognition_callback(self.on_recognition)
+        register_post_recognition_callback(self.on_post_recognition)
+        register_failure_callback(self.on_failure)
+        register_ending_callback(self.on_end)
+        self.wrap_decoder(engine)
+        self.wrap_action_execute()
+        return self
+
+    def wrap_decoder(self, engine):
+        decoder = getattr(engine, "_decoder", None)
+        if decoder is None:
+            print("Latency instrumentation can't time decoding, the engine has no decoder")
+            return
+        decode = decoder.decode
+        recorder = self
+        def timed_decode(frames, finalize, *args, **kwargs):
+            if not finalize:
+                return decode(frames, finalize, *args, **kwargs)
+            # the final decode is called as soon as the end of speech is detected
+            recorder.mark("speech_end")
+            result = decode(frames, finalize, *args, **kwargs)
+            recorder.mark("decoded")
+            return result
+        decoder.decode = timed_decode
+
+    def wrap_action_execute(self):
+        execute = ActionBase.execute
+        recorder = self
+        def timed_execute(action, *args, **kwargs):
+            if threading.get_ident() != recorder.thread_id:
+                # e.g. executed by the action executor, after the utterance
+                return execute(action, *args, **kwargs)
+            # only time the outermost action, not those within a series
+            if recorder.action_depth == 0 and "execute_start" not in recorder.marks:
+                recorder.mark("execute_start")
+            recorder.action_depth += 1
+            try:
+                return execute(action, *args, **kwargs)
+            finally:
+                recorder.action_depth -= 1
+                if recorder.action_depth == 0:
+                    recorder.mark("execute_end")
+        ActionBase.execute = timed_execute
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter()
+
+    def add(self, key, stage, start_mark, end_mark):
+        start = self.marks.get(start_mark)
+        end = self.marks.get(end_mark)
+        if start is None or end is None or end < start:
+            return
+        histogram = self.histograms.get(key + (stage,))
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key + (stage,), LatencyHistogram())
+        histogram.add((end - start) * 1000.0)
+
+    def on_begin(self):
+        self.marks = {}
+        self.rule_key = None
+        self.thread_id = threading.get_ident()
+
+    def on_recognition(self, words, rule, node):
+        self.mark("recognized")
+        if isinstance(rule, SharedPrefixRule):
+            # timed as the rule whose spec was spoken, as if it were in the grammar on its own
+            rule = rule.recognition_extras(node)[0] or rule
+        grammar = getattr(rule, "grammar", None)
+        self.rule_key = (grammar.name if grammar else "", rule.name)
+
+    def on_post_recognition(self, words):
+        self.mark("processed")
+        key = self.rule_key
+        if key is None:
+            return
+        self.add(key, "decode", "speech_end", "decoded")
+        self.add(key, "parse", "decoded", "recognized")
+        self.add(key, "build", "recognized", "execute_start")
+        self.add(key, "execute", "execute_start", "execute_end")
+        self.add(key, "total", "speech_end", "processed")
+
+    def on_failure(self):
+        self.mark("failed")
+        key = ("", "<failure>")
+        self.add(key, "decode", "speech_end", "decoded")
+        self.add(key, "total", "speech_end", "failed")
+
+    def on_end(self):
+        if time.perf_counter() - self.last_dump_time >= self.dump_interval_s:
+            self.dump()
+
+    def summary_lines(self):
+        header = f"{'grammar':<20} {'rule':<28} {'stage':<8} {'count':>7} {'mean':>9}"
+        header += "".join(f" {'p' + str(p):>9}" for p in PERCENTILES) + f" {'max':>9}"
+        lines = [header]
+        with self.lock:
+            items = sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1], STAGES.index(item[0][2])))
+        for (grammar, rule, stage), histogram in items:
+            line = f"{grammar:<20} {rule:<28} {stage:<8} {histogram.count:>7} {histogram.mean():>9.2f}"
+            line += "".join(f" {histogram.percentile(p):>9.2f}" for p in PERCENTILES) + f" {histogram.max_ms:>9.2f}"
+            lines.append(line)
+        return lines
+
+    def dump(self):
+        """
+        Writes the current percentiles (in ms) of every grammar, rule and stage to dump_path.
+        """
+        self.last_dump_time = time.perf_counter()
+        try:
+            with open(self.dump_path, 'w', encoding='utf-8') as f:
+                f.write(f"# Tacspeak latency (ms) at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+                f.write("\n".join(self.summary_lines()) + "\n")
+                if self.executor is not None:
+                    f.write("\n# Action executor (ms)\n")
+                    f.write("\n".join(self.executor.summary_lines()) + "\n")
+        except OSError as e:
+            print(f"Failed to write latency to {self.dump_path}: {e}")
@@ -0,0 +1,167 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Lazy loading of grammar modules, when the game they're for is in the foreground (LAZY_LOAD).
+
+A grammar module declares the executable(s) its grammars are for as a literal, e.g.
+``EXECUTABLE = "ReadyOrNot"``, read from its source without importing it (``read_executables()``).
+Modules that don't declare one are loaded at start-up, as before.
+
+``LazyLoader`` checks the foreground window's executable on an engine timer, between utterances.
+The first time it matches a module's executable (as AppContext matches it, a case insensitive
+substring), the module is imported and its rules compiled and loaded. If `unload_after_s` is set,
+a loaded module whose executable hasn't been in the foreground for that long is unloaded.
+Each load and unload prints how long it took.
+
+Loading happens on the engine's thread rather than in the background, as Kaldi allocates each
+rule's place in the decoder when its grammar is loaded, and every allocated rule must be in the
+decoder when an utterance starts. Kaldi compiles the rules across threads, and caches them (in
+the model's tmp dir, by hash of the graph), so loading a module again is much quicker.
+"""
+
+import ast
+import os
+import time
+
+from dragonfly import Window
+
+from tacspeak.hot_reload import is_grammar_module, load_module, unload_module
+
+DEFAULT_INTERVAL_S = 1.0
+
+
+def read_executables(path):
+    """
+    Returns the lower case executable names a grammar module declares with ``EXECUTABLE = ...``,
+    without importing it, or None if it doesn't declare any.
+    """
+    with open(path, encoding="utf-8") as file:
+        tree = ast.parse(file.read(), path)
+    for statement in tree.body:
+        if not isinstance(statement, ast.Assign):
+            continue
+        if not any(isinstance(target, ast.Name) and target.id == "EXECUTABLE" for target in statement.targets):
+            continue
+        try:
+            value = ast.literal_eval(statement.value)
+        except ValueError:
+            value = None
+        executables = [value] if isinstance(value, str) else value
+        if not isinstance(executables, (list, tuple)) or not all(isinstance(e, str) for e in executables):
+            print(f"{os.path.basename(path)}: EXECUTABLE isn't a string or list of strings, loading it at start-up")
+            return None
+        return [executable.lower() for executable in executables]
+    return None
+
+def get_foreground_executable():
+    try:
+        return (Window.get_foreground().executable or "").lower()
+    except Exception:
+        return ""
+
+class LazyModule:
+    """
+    A grammar module loaded when one of its `executables` is in the foreground.
+    """
+    def __init__(self, path, executables):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.executables = executables
+        self.module = None
+        self.failed = False
+        self.last_active_time = None
+
+    def matches(self, executable):
+        return any(match in executable for match in self.executables)
+
+class LazyLoader:
+    """
+    Loads grammar modules from `grammar_path` when their executable is in the foreground, and
+    unloads them after `unload_after_s` (if not None) without it, see module docstring.
+    """
+    def __init__(self, engine, grammar_path, unload_after_s=None, interval_s=DEFAULT_INTERVAL_S):
+        self.engine = engine
+        self.grammar_path = os.path.abspath(grammar_path)
+        self.unload_after_s = unload_after_s
+        self.interval_s = interval_s
+        self.lazy_modules = []
+        # modules without an EXECUTABLE, loaded at start-up
+        self.modules = []
+        self.in_phrase = False
+        self.timer = None
+
+    def load(self):
+        """
+        Loads grammar modules without an EXECUTABLE, and starts watching the foreground window.
+        """
+        paths = [os.path.join(self.grammar_path, filename) for filename in sorted(os.listdir(self.grammar_path))]
+        for path in filter(is_grammar_module, paths):
+            executables = read_executables(path)
+            if executables is None:
+                self.modules.append(load_module(os.path.splitext(os.path.basename(path))[0], path))
+            else:
+                self.lazy_modules.append(LazyModule(path, executables))
+                print(f"{os.path.basename(path)} will be loaded when {' or '.join(executables)} is in the foreground")
+        self.timer = self.engine.create_timer(self.check, self.interval_s)
+        return self
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+
+    # ----------------------------------------------------------------------
+    # Engine callbacks, so loading doesn't happen mid-utterance
+
+    def on_begin(self):
+        self.in_phrase = True
+
+    def on_end(self):
+        self.in_phrase = False
+
+    # ----------------------------------------------------------------------
+    # Loading and unloading
+
+    def check(self):
+        """
+        Loads modules for the foreground executable, and unloads inactive ones, unless an utterance
+        is being recognised.
+        """
+        if self.in_phrase:
+            return
+        executable = get_foreground_executable()
+        now = time.perf_counter()
+        for lazy_module in self.lazy_modules:
+            if executable and lazy_module.matches(executable):
+                lazy_module.last_active_time = now
+                if lazy_module.module is None and not lazy_module.failed:
+                    self.load_module(lazy_module, executable)
+            elif (lazy_module.module is not None and self.unload_after_s is not None
+                  and now - lazy_module.last_active_time > self.unload_after_s):
+                self.unload_module(lazy_module)
+
+    def load_module(self, lazy_module, executable):
+        start_time = time.perf_counter()
+        lazy_module.module = load_module(lazy_module.name, lazy_module.path)
+        if lazy_module.module is None:
+            # don't retry every check, it'll fail the same way until Tacspeak is restarted
+            lazy_module.failed = True
+            return
+        import_time = time.perf_counter()
+        # with lazy_compilation, Kaldi compiles and loads the rules here
+        if hasattr(self.engine, "prepare_for_recognition"):
+            self.engine.prepare_for_recognition()
+        end_time = time.perf_counter()
+        print(f"Loaded {os.path.basename(lazy_module.path)} for {os.path.basename(executable)} in {end_time - start_time:.2f}s"
+              + f" (import {import_time - start_time:.2f}s, compile {end_time - import_time:.2f}s)")
+
+    def unload_module(self, lazy_module):
+        start_time = time.perf_counter()
+        unload_module(lazy_module.module)
+        lazy_module.module = None
+        print(f"Unloaded {os.path.basename(lazy_module.path)} after {self.unload_after_s}s inactive,"
+              + f" in {time.perf_counter() - start_time:.2f}s")
@@ -0,0 +1,201 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Streaming transcription of long recordings (e.g. a whole session) with the plain dictation graph.
+
+The wav file is read incrementally in 10 ms blocks and split into utterances with webrtcvad,
+using the same settings as the engine (``vad_aggressiveness``, ``vad_padding_start_ms`` and
+``vad_complex_padding_end_ms`` from ``KALDI_ENGINE_SETTINGS``). Segments are decoded across
+a pool of workers and written in order, with their start and end times, as they complete.
+Memory is bounded by ``max_pending`` segments of at most ``max_segment_s`` each.
+"""
+
+import collections
+import itertools
+import json
+import os
+import sys
+import time
+import wave
+
+import webrtcvad
+from dragonfly.loader import CommandModule
+
+import tacspeak.test_model as tm
+from tacspeak.corpus import audio_duration_s
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+BLOCK_DURATION_MS = 10
+BLOCK_SIZE_SAMPLES = SAMPLE_RATE * BLOCK_DURATION_MS // 1000
+
+# the engine's defaults, used where user_settings doesn't set them
+DEFAULT_VAD_SETTINGS = {
+    "vad_aggressiveness": 3,
+    "vad_padding_start_ms": 150,
+    "vad_padding_end_ms": 200,
+    "vad_complex_padding_end_ms": 600,
+}
+# webrtcvad's ratio of voiced blocks within the start/end windows, as in VADAudio.vad_collector()
+VAD_RATIO = 0.8
+VAD_START_PADDING_MS = 100
+MAX_SEGMENT_S = 30.0
+
+# --------------------------------------------------------------------------
+# Segmenting
+
+def load_vad_settings():
+    """
+    Returns the VAD settings in ``tacspeak/user_settings.py`` KALDI_ENGINE_SETTINGS, with engine defaults.
+    """
+    settings = dict(DEFAULT_VAD_SETTINGS)
+    if "user_settings" not in sys.modules:
+        user_settings_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/user_settings.py"))
+        CommandModule(user_settings_path).load()
+    try:
+        engine_settings = (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` KALDI_ENGINE_SETTINGS. Using default VAD settings as fallback.")
+        engine_settings = {}
+    for key in settings:
+        if key in engine_settings:
+            settings[key] = int(engine_settings[key])
+    return settings
+
+def read_wav_blocks(wav_path):
+    """
+    Yields 10 ms blocks of raw audio from a 16 kHz mono 16-bit wav file, reading it incrementally.
+    """
+    with wave.open(wav_path, 'rb') as wav_file:
+        if (wav_file.getframerate() != SAMPLE_RATE or wav_file.getsampwidth() != SAMPLE_WIDTH
+                or wav_file.getnchannels() != 1):
+            raise ValueError(f"{wav_path} should be {SAMPLE_RATE} Hz, {SAMPLE_WIDTH * 8}-bit, mono")
+        while True:
+            block = wav_file.readframes(BLOCK_SIZE_SAMPLES)
+            if len(block) < BLOCK_SIZE_SAMPLES * SAMPLE_WIDTH:
+                # webrtcvad only accepts whole blocks, and a partial last block is < 10 ms
+                break
+            yield block
+
+def vad_segments(blocks, vad_aggressiveness=3, vad_padding_start_ms=150, vad_complex_padding_end_ms=600,
+                 max_segment_s=MAX_SEGMENT_S, **kwargs):
+    """
+    Yields (start_s, end_s, pcm) of each voiced segment in `blocks`, in the same way as the engine's
+    VADAudio.vad_collector() segments phrases. Dictation is a complex phrase, so it ends after
+    `vad_complex_padding_end_ms` of silence. Segments longer than `max_segment_s` are split.
+    """
+    vad = webrtcvad.Vad(vad_aggressiveness)
+    num_start_window_blocks = max(1, vad_padding_start_ms // BLOCK_DURATION_MS)
+    num_start_padding_blocks = VAD_START_PADDING_MS // BLOCK_DURATION_MS
+    num_end_window_blocks = max(1, vad_complex_padding_end_ms // BLOCK_DURATION_MS)
+    max_segment_blocks = int(max_segment_s * 1000 // BLOCK_DURATION_MS)
+    ring_buffer = collections.deque(maxlen=max(num_start_window_blocks + num_start_padding_blocks, num_end_window_blocks))
+    recent = lambda num_blocks: itertools.islice(ring_buffer, max(0, len(ring_buffer) - num_blocks), None)
+
+    triggered = False
+    segment = []
+    segment_start = 0
+    for i, block in enumerate(blocks):
+        is_speech = vad.is_speech(block, SAMPLE_RATE)
+        ring_buffer.append((block, is_speech))
+        if not triggered:
+            num_voiced = len([1 for _, speech in recent(num_start_window_blocks) if speech])
+            if num_voiced >= num_start_window_blocks * VAD_RATIO:
+                triggered = True
+                segment = [b for b, _ in recent(num_start_padding_blocks + num_start_window_blocks)]
+                segment_start = i + 1 - len(segment)
+                ring_buffer.clear()
+        else:
+            segment.append(block)
+            num_unvoiced = len([1 for _, speech in recent(num_end_window_blocks) if not speech])
+            if num_unvoiced >= num_end_window_blocks * VAD_RATIO or len(segment) >= max_segment_blocks:
+                yield segment_times(segment_start, len(segment)) + (b"".join(segment),)
+                triggered = False
+                segment = []
+                ring_buffer.clear()
+    if segment:
+        yield segment_times(segment_start, len(segment)) + (b"".join(segment),)
+
+def segment_times(start_block, num_blocks):
+    return (start_block * BLOCK_DURATION_MS / 1000.0, (start_block + num_blocks) * BLOCK_DURATION_MS / 1000.0)
+
+# --------------------------------------------------------------------------
+# Transcribing
+
+def decode_segment(segment):
+    """
+    Decodes a (start_s, end_s, pcm) segment with the recognizer from initialize_kaldi_dictation().
+    """
+    start_s, end_s, pcm = segment
+    output_str = tm.call_recognizer(pcm)
+    return {'start_s': start_s, 'end_s': end_s, 'text': output_str}
+
+def format_time(seconds):
+    minutes, seconds = divmod(seconds, 60.0)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:06.3f}"
+
+def transcribe_long(wav_path, out_path=None, model_dir=None, num_threads=1, max_pending=None,
+                    max_segment_s=MAX_SEGMENT_S, warm_pool=False):
+    """
+    Transcribes a long wav file, see module docstring. Each segment's transcript is printed and, if
+    `out_path` is given, streamed to it as JSON lines if it ends with .jsonl, otherwise as tab separated
+    start, end and text. Returns the number of segments.
+    """
+    if model_dir is None:
+        model_dir = "./kaldi_model/"
+    if max_pending is None:
+        max_pending = num_threads * 4
+    vad_settings = load_vad_settings()
+    warm_pool = tm.check_warm_pool(warm_pool)
+    print(f"Transcribing {wav_path} with VAD settings {vad_settings}")
+
+    # initialize first, pre-compiling the model for the workers
+    tm.initialize_kaldi_dictation(model_dir)
+    out_file = open(out_path, 'w', encoding='utf-8') if out_path else None
+    segments = vad_segments(read_wav_blocks(wav_path), max_segment_s=max_segment_s, **vad_settings)
+    n_segments = 0
+    start_time = time.perf_counter()
+
+    def write_record(record):
+        if not record['text']:
+            return
+        print(f"[{format_time(record['start_s'])} - {format_time(record['end_s'])}] {record['text']}")
+        if out_file:
+            if out_path.lower().endswith(".jsonl"):
+                out_file.write(json.dumps(record) + "\n")
+            else:
+                out_file.write(f"{record['start_s']:.2f}\t{record['end_s']:.2f}\t{record['text']}\n")
+            out_file.flush()
+
+    with tm.start_pool(num_threads, tm.initialize_kaldi_dictation, (model_dir,), warm_pool) as pool:
+        # segments are submitted from this thread, waiting on the oldest once `max_pending` are in
+        # flight, so nothing blocks inside the pool's own threads and terminate() always returns
+        pending = collections.deque()
+        try:
+            for segment in segments:
+                if len(pending) >= max_pending:
+                    write_record(pending.popleft().get())
+                    n_segments += 1
+                pending.append(pool.apply_async(decode_segment, (segment,)))
+            while pending:
+                write_record(pending.popleft().get())
+                n_segments += 1
+        except KeyboardInterrupt as e:
+            print(f"Closing pool: {e}")
+            pool.terminate()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            if out_file:
+                out_file.close()
+    wall_s = time.perf_counter() - start_time
+    audio_s = audio_duration_s(wav_path)
+    print(f"Transcribed {n_segments} segments ({audio_s:.1f}s of audio) in {wall_s:.1f}s, "
+          + f"real-time factor {wall_s / max(audio_s, 1e-9):.3f}")
+    return n_segments
@@ -0,0 +1,277 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Classifies transcripts into the (rule, extras) they'd be recognised as, without an engine.
+
+``PhraseIndex(rules)`` compiles the element trees of loaded dragonfly rules (their specs and
+``Choice`` maps) into one word-level state machine, a trie of each rule's words where specs branch
+or repeat. ``classify(text)`` runs it over the transcript's words, tracking every possible position
+at once (a Pike VM), so each word costs a dict lookup per live position rather than a parse per rule.
+
+The first parse found is the one dragonfly's decoding would find: alternatives are tried in order
+and optionals greedily. Extras are valued as in ``CompoundRule.process_recognition``, starting with
+the rule's defaults. Rules with elements whose value can't be known from the words alone (e.g.
+``IntegerRef``, ``Modifier``, ``value_func``) are left out, and listed in ``PhraseIndex.unsupported``.
+"""
+
+import collections
+
+from dragonfly import (Alternative, Compound, Dictation, DictListRef, Empty, Impossible, ListRef, Literal,
+                       Modifier, Optional, RuleRef, Sequence)
+
+from tacspeak.shared_rules import expand_rules
+
+MAX_RULE_REF_DEPTH = 20
+
+EmptyNode = collections.namedtuple("EmptyNode", ["children"])
+
+
+class UnsupportedElement(Exception):
+    pass
+
+
+def unspoken_value(element):
+    """
+    Returns the value of an Optional `element` that wasn't spoken, as given by dragonfly.
+    """
+    try:
+        return element.value(EmptyNode([]))
+    except Exception:
+        return element.default
+
+class PhraseIndex:
+    """
+    A word-level state machine of `rules`, see module docstring.
+    """
+    def __init__(self, rules):
+        # per state: {word: [next states]}, [(next state, dictation extra or None)], [(next state, events)]
+        self.word_edges = []
+        self.any_edges = []
+        self.epsilon_edges = []
+        # accepting state -> rule
+        self.accepting = {}
+        self.rules = []
+        self.unsupported = {}
+        self.start = self.new_state()
+        for rule in rules:
+            try:
+                self.add_rule(rule)
+            except UnsupportedElement as e:
+                self.unsupported[rule.name] = str(e)
+        self.closures = [self.closure(state) for state in range(len(self.word_edges))]
+
+    @classmethod
+    def from_grammars(cls, grammars):
+        """
+        Returns the PhraseIndex of the exported rules of `grammars`, e.g. engine.grammars, with
+        SharedPrefixRules' rules indexed separately, so phrases are classified by the rule processing them.
+        """
+        return cls(expand_rules([rule for grammar in grammars for rule in grammar.rules if rule.exported]))
+
+    def new_state(self):
+        self.word_edges.append({})
+        self.any_edges.append([])
+        self.epsilon_edges.append([])
+        return len(self.word_edges) - 1
+
+    def add_rule(self, rule):
+        extras = getattr(rule, "_extras", {})
+        # compile into new states first, so an unsupported rule leaves nothing reachable behind
+        rule_start = self.new_state()
+        end = self.compile(rule.element, rule_start, extras, None, 0)
+        self.epsilon_edges[self.start].append((rule_start, ()))
+        self.accepting[end] = rule
+        self.rules.append(rule)
+
+    # ----------------------------------------------------------------------
+    # Compiling
+
+    def compile(self, element, start, extras, extra, depth):
+        """
+        Adds the states of `element` from `start`, returning its end state. `extra` is the name of the
+        extra being valued by an enclosing element, "" once its value is known, or None outside extras.
+        """
+        events = ()
+        if extra is None and element.name in extras:
+            extra = element.name
+        elif extra is None and element.name:
+            # extras are found shallowly, i.e. not inside other named elements
+            extra = ""
+        if extra:
+            value = self.known_value(element)
+            if value is not None:
+                events = (("set", extra, value[0]),)
+                extra = ""
+            elif isinstance(element, (Sequence, Modifier)) or not isinstance(
+                    element, (Alternative, Optional, Literal, Dictation, RuleRef, ListRef, Empty)):
+                raise UnsupportedElement(f"can't value extra {extra} of {element!r}")
+        if events:
+            state = self.new_state()
+            self.epsilon_edges[start].append((state, events))
+            start = state
+
+        if isinstance(element, Optional):
+            child = self.new_state()
+            end = self.new_state()
+            # greedy, so the child is tried first
+            self.epsilon_edges[start].append((child, ()))
+            skip_events = (("set", extra, unspoken_value(element)),) if extra else ()
+            self.epsilon_edges[start].append((end, skip_events))
+            self.epsilon_edges[self.compile(element.children[0], child, extras, extra, depth)].append((end, ()))
+            return end
+        if isinstance(element, Sequence):
+            for child in element.children:
+                start = self.compile(child, start, extras, extra, depth)
+            return start
+        if isinstance(element, Alternative):
+            end = self.new_state()
+            for child in element.children:
+                child_start = self.new_state()
+                self.epsilon_edges[start].append((child_start, ()))
+                self.epsilon_edges[self.compile(child, child_start, extras, extra, depth)].append((end, ()))
+            return end
+        if isinstance(element, Literal):
+            for word in element.words:
+                state = self.new_state()
+                self.word_edges[start].setdefault(word.lower(), []).append(state)
+                start = state
+            return start
+        if isinstance(element, Dictation):
+            # one or more of any words, as few as possible, as dragonfly guesses which words are dictated
+            word = self.new_state()
+            end = self.new_state()
+            self.epsilon_edges[start].append((word, ()))
+            state = self.new_state()
+            self.any_edges[word].append((state, extra or None))
+            self.epsilon_edges[state].append((end, ()))
+            self.epsilon_edges[state].append((word, ()))
+            return end
+        if isinstance(element, RuleRef):
+            if depth >= MAX_RULE_REF_DEPTH:
+                raise UnsupportedElement(f"{element!r} nests deeper than {MAX_RULE_REF_DEPTH} rules")
+            return self.compile(element.rule.element, start, extras, extra, depth + 1)
+        if isinstance(element, ListRef):
+            end = self.new_state()
+            for item in list(element.list.keys() if isinstance(element, DictListRef) else element.list):
+                state = start
+                for word in item.split():
+                    next_state = self.new_state()
+                    self.word_edges[state].setdefault(word.lower(), []).append(next_state)
+                    state = next_state
+                item_events = (("set", extra, element.list[item] if isinstance(element, DictListRef) else item),) if extra else ()
+                self.epsilon_edges[state].append((end, item_events))
+            return end
+        if isinstance(element, Empty):
+            return start
+        if isinstance(element, Impossible):
+            # no edges reach its end
+            return self.new_state()
+        raise UnsupportedElement(f"unsupported element {element!r}")
+
+    @staticmethod
+    def known_value(element):
+        """
+        Returns (value,) if `element`'s value doesn't depend on which words are spoken, else None.
+        """
+        if isinstance(element, Compound):
+            if getattr(element, "_value_func", None) is not None:
+                raise UnsupportedElement(f"can't value {element!r} with a value_func")
+            if element._value is not None:
+                return (element._value,)
+            return None
+        if isinstance(element, Literal):
+            return (element._value if element._value is not None else " ".join(element.words),)
+        if isinstance(element, Empty):
+            return (element._value,)
+        return None
+
+    def closure(self, state):
+        """
+        Returns the states with word edges (or accepting) reachable from `state` by epsilon edges, in
+        priority order, each with the events along the way.
+        """
+        result = []
+        visited = set()
+        def visit(state, events):
+            if state in visited:
+                return
+            visited.add(state)
+            if self.word_edges[state] or self.any_edges[state] or state in self.accepting:
+                result.append((state, events))
+            for next_state, next_events in self.epsilon_edges[state]:
+                visit(next_state, events + next_events)
+        visit(state, ())
+        return result
+
+    # ----------------------------------------------------------------------
+    # Classifying
+
+    def matches(self, words):
+        """
+        Returns [(rule, events)] of every rule matching `words`, in rule order.
+        """
+        threads = self.closures[self.start]
+        for word in words:
+            word = word.lower()
+            next_threads = []
+            seen = set()
+            for state, events in threads:
+                for next_state in self.word_edges[state].get(word, ()):
+                    for closure_state, closure_events in self.closures[next_state]:
+                        if closure_state not in seen:
+                            seen.add(closure_state)
+                            next_threads.append((closure_state, events + closure_events))
+                for next_state, extra in self.any_edges[state]:
+                    word_events = (("word", extra, word),) if extra else ()
+                    for closure_state, closure_events in self.closures[next_state]:
+                        if closure_state not in seen:
+                            seen.add(closure_state)
+                            next_threads.append((closure_state, events + word_events + closure_events))
+            threads = next_threads
+            if not threads:
+                return []
+        matches = [(self.accepting[state], events) for state, events in threads if state in self.accepting]
+        order = {id(rule): i for i, rule in enumerate(self.rules)}
+        return sorted(matches, key=lambda match: order[id(match[0])])
+
+    @staticmethod
+    def options(rule, events):
+        """
+        Returns the extras (without "_grammar", "_rule" and "_node") of `rule` parsed with `events`.
+        """
+        options = dict(getattr(rule, "_defaults", {}))
+        values = {}
+        dictated = {}
+        for event in events:
+            if event[0] == "set":
+                values.setdefault(event[1], event[2])
+            else:
+                dictated.setdefault(event[1], []).append(event[2])
+        for name, element in getattr(rule, "_extras", {}).items():
+            if name in values:
+                options[name] = values[name]
+            elif name in dictated:
+                options[name] = " ".join(dictated[name])
+            elif element.has_default():
+                options[name] = element.default
+        return options
+
+    def classify(self, text):
+        """
+        Returns (rule, options) that `text` would be recognised as, or (None, None).
+        """
+        matches = self.matches(text.split())
+        if not matches:
+            return None, None
+        rule, events = matches[0]
+        return rule, self.options(rule, events)
+
+    def classify_all(self, text):
+        """
+        Returns [(rule, options)] of every rule `text` matches, in rule order.
+        """
+        return [(rule, self.options(rule, events)) for rule, events in self.matches(text.split())]
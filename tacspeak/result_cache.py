@@ -0,0 +1,238 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Persistent on-disk cache of recognition results for test_model.
+
+Results are grouped by a context fingerprint of everything, other than the 
+audio, which can change a result: the model directory, the loaded grammar 
+rules, and the relevant ``KALDI_ENGINE_SETTINGS``. Each context is stored in 
+its own JSON lines file ``results_<context>.jsonl`` within ``cache_dir``, 
+and entries within it are keyed by a content hash of the wav file (plus the 
+reference text). 
+
+Size is bounded by ``max_bytes`` across all context files; the least recently
+used context files (which are stale once a model or grammar changes) are 
+evicted first. A context file's modification time is updated whenever it's
+used, including by a run that only reads from it. Within a context file, entries
+are kept in order of last use across runs (a run with hits rewrites the file in
+that order), so if the current context alone exceeds ``max_bytes`` the least
+recently used entries are dropped.
+"""
+
+import hashlib
+import json
+import os
+
+from tacspeak.corpus import hash_audio
+
+DEFAULT_CACHE_DIR = "./.tacspeak_cache/"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# settings which don't change recognition results
+IGNORED_ENGINE_SETTINGS = (
+    "retain_dir", "retain_audio", "retain_metadata", "retain_approval_func",
+    "audio_input_device", "input_device_index", "audio_self_threaded", 
+    "audio_auto_reconnect", "audio_reconnect_callback", "tmp_dir", "model_dir",
+)
+
+# --------------------------------------------------------------------------
+# Fingerprints
+
+def hash_file(path, chunk_size=1024 * 1024):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def hash_strings(strings):
+    hasher = hashlib.sha1()
+    for item in strings:
+        hasher.update(str(item).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+def fingerprint_model_dir(model_dir, exclude_dirs=("cache.tmp",)):
+    """
+    Fingerprint of the files in model_dir by relative path, size and modification time.
+    Hashing the contents of a ~2GB model would take longer than most test runs.
+    The compiled-grammar tmp dir is excluded, as it changes whenever grammars are compiled.
+    """
+    items = []
+    for root, dirs, files in os.walk(model_dir):
+        dirs[:] = sorted(d for d in dirs if d not in exclude_dirs)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            items.append(f"{os.path.relpath(path, model_dir)}|{stat.st_size}|{stat.st_mtime_ns}")
+    return hash_strings(items)
+
+def fingerprint_rule(rule):
+    """
+    Fingerprint of a rule's spec (its element's gstring), defaults and extras' choices.
+    gstring() alone doesn't include the values Choice elements map to.
+    """
+    items = [rule.name, rule.element.gstring(), repr(getattr(rule, '_defaults', None))]
+    for name, element in sorted(getattr(rule, '_extras', {}).items()):
+        # vars() rather than getattr(), as Dictation.__getattr__() returns a new function for any name
+        choices = vars(element).get('_choices')
+        if choices is None:
+            choices = vars(vars(element).get('_child', object)).get('_choices')
+        items.append(f"{name}={choices!r}|{getattr(element, 'default', None)!r}")
+    # the rules of a SharedPrefixRule, with their own defaults
+    items.extend(fingerprint_rule(sub_rule) for sub_rule in getattr(rule, 'rules', ()))
+    return hash_strings(items)
+
+def fingerprint_grammars(grammars):
+    items = []
+    for grammar in sorted(grammars, key=lambda g: g.name):
+        items.append(grammar.name)
+        items.extend(sorted(fingerprint_rule(rule) for rule in grammar.rules))
+    return hash_strings(items)
+
+def fingerprint_settings(settings):
+    items = [f"{k}={v!r}" for k, v in sorted(settings.items())
+             if k not in IGNORED_ENGINE_SETTINGS and not callable(v)]
+    return hash_strings(items)
+
+def fingerprint_context(mode, model_dir, grammars=None, settings=None):
+    """
+    Returns the cache context for results of `mode` (e.g. "recognize" or "dictation").
+    """
+    items = [mode, fingerprint_model_dir(model_dir)]
+    if grammars is not None:
+        items.append(fingerprint_grammars(grammars))
+    if settings is not None:
+        items.append(fingerprint_settings(settings))
+    return hash_strings(items)[:16]
+
+# --------------------------------------------------------------------------
+# Cache
+
+class ResultCache:
+    """
+    Cache of JSON-serializable results for one context, see module docstring.
+    Only a single process should write to a context file at a time, e.g. the 
+    parent process of a test run's pool.
+    """
+    def __init__(self, context, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.context = context
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.path = os.path.join(cache_dir, f"results_{context}.jsonl")
+        self.entries = {}
+        self.file_hashes = {}
+        self.file = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # the last line may be partially written if a run crashed
+                        continue
+                    self.entries.pop(key, None)
+                    self.entries[key] = value
+        self.file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            if self.hits:
+                # so later runs read entries in order of last use, including this run's hits
+                self._write(json.dumps([key, value], default=str) + "\n" for key, value in self.entries.items())
+            # marks the context as used, even if there were only hits
+            os.utime(self.path)
+        self.file = None
+        self.evict()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def key(self, wav_path, *parts):
+        file_hash = self.file_hashes.get(wav_path)
+        if file_hash is None:
+            # corpus clips store a hash of their audio
+            file_hash = hash_audio(wav_path) or hash_file(wav_path)
+            self.file_hashes[wav_path] = file_hash
+        return hash_strings((file_hash,) + parts)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # entries are kept in order of use, for _truncate()
+            self.entries[key] = self.entries.pop(key)
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.file.write(json.dumps([key, value], default=str) + "\n")
+        self.file.flush()
+
+    def stats_string(self):
+        return f"Result cache {self.path} -> hits={self.hits} misses={self.misses} entries={len(self.entries)}"
+
+    def evict(self):
+        """
+        Deletes the least recently used context files until the cache is within max_bytes. 
+        If the current context alone exceeds max_bytes, it's rewritten keeping its most recently used entries.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.startswith("results_") and entry.name.endswith(".jsonl"):
+                stat = entry.stat()
+                files.append((os.path.abspath(entry.path) == os.path.abspath(self.path), stat.st_mtime, stat.st_size, entry.path))
+        # current context first, then most recently used
+        files.sort(reverse=True)
+        total_bytes = 0
+        for is_current, _, size, path in files:
+            total_bytes += size
+            if total_bytes <= self.max_bytes:
+                continue
+            if is_current:
+                self._truncate(size - (total_bytes - self.max_bytes))
+                total_bytes = self.max_bytes
+            else:
+                os.remove(path)
+                total_bytes -= size
+
+    def _truncate(self, max_bytes):
+        lines = [json.dumps([key, value], default=str) + "\n" for key, value in self.entries.items()]
+        kept = []
+        size = 0
+        for line in reversed(lines):
+            size += len(line.encode('utf-8'))
+            if size > max_bytes:
+                break
+            kept.append(line)
+        kept.reverse()
+        self._write(kept)
+
+    def _write(self, lines):
+        # written then renamed, so a crash part way through doesn't lose the context
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,109 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Rules sharing a spec prefix, compiled once.
+
+Dragonfly compiles each exported rule into its own graph, inlining any rules it references, so a
+prefix like ``<color> [team] <hold>`` at the start of many rules is compiled (and decoded) once per
+rule. ``SharedPrefixRule(name, prefix, rules)`` is one exported rule of the prefix followed by the
+rest of any of `rules`' specs, e.g.::
+
+    grammar.add_rule(SharedPrefixRule("TeamOrders", "<color> [team] <hold>", [DoorOptions(), StackUp()]))
+
+`rules` are CompoundRules as they'd be defined on their own, each spec starting with the prefix.
+They aren't added to the grammar, but a recognition is processed by (and its extras extracted as
+for) the rule whose spec was spoken, so their ``_process_recognition()`` are unchanged.
+"""
+
+from dragonfly import Alternative, Compound, Rule, Sequence
+from dragonfly.grammar.rule_compound import CompoundRule
+
+
+def normalize_spec(spec):
+    return " ".join(spec.split())
+
+class SharedPrefixRule(Rule):
+    """
+    One exported rule of `prefix` followed by the rest of any of `rules`' specs, see module docstring.
+    Raises ValueError if a rule's spec doesn't start with `prefix`, or rules' extras of the same
+    name aren't the same element.
+    """
+    def __init__(self, name, prefix, rules, exported=True):
+        self.rules = list(rules)
+        self.prefix = normalize_spec(prefix)
+        # every rule's extras, by name
+        self._extras = {}
+        for rule in self.rules:
+            if not isinstance(rule, CompoundRule):
+                raise ValueError(f"{name}: {rule.name} isn't a CompoundRule")
+            for extra_name, element in rule._extras.items():
+                if self._extras.setdefault(extra_name, element) is not element:
+                    raise ValueError(f"{name}: {rule.name} extra {extra_name} isn't the element other rules use,"
+                                     + " define it once and use it in each rule's extras")
+
+        prefix_extras = [element for extra_name, element in self._extras.items() if f"<{extra_name}>" in self.prefix]
+        self.prefix_element = Compound(self.prefix, extras=prefix_extras)
+        # id of the command element spoken after the prefix -> its rule
+        self.command_rules = {}
+        commands = []
+        for rule in self.rules:
+            spec = normalize_spec(rule.spec)
+            if not spec.startswith(self.prefix + " "):
+                raise ValueError(f"{name}: {rule.name} spec {spec!r} doesn't start with {self.prefix!r}")
+            command = Compound(spec[len(self.prefix) + 1:], extras=rule._extras)
+            self.command_rules[id(command)] = rule
+            commands.append(command)
+        Rule.__init__(self, name=name, element=Sequence([self.prefix_element, Alternative(commands)]), exported=exported)
+
+    def _get_grammar(self):
+        return self._grammar
+    def _set_grammar(self, grammar):
+        self._grammar = grammar
+        # so the rules are named as if they were in the grammar, e.g. by test_model.rule_name()
+        for rule in self.rules:
+            rule.grammar = grammar
+    grammar = property(_get_grammar, _set_grammar)
+
+    def recognition_extras(self, node):
+        """
+        Returns (rule, extras) of the rule whose spec was spoken in a recognition's `node`, with
+        extras as CompoundRule.process_recognition() would pass to it, or (None, None).
+        """
+        rule = None
+        nodes = list(node.children)
+        while nodes and rule is None:
+            child = nodes.pop()
+            rule = self.command_rules.get(id(child.actor))
+            nodes += child.children
+        if rule is None:
+            return None, None
+        extras = {
+            "_grammar":  self.grammar,
+            "_rule":     rule,
+            "_node":     node,
+        }
+        extras.update(rule._defaults)
+        for name, element in rule._extras.items():
+            extra_node = node.get_child_by_name(name, shallow=True)
+            if extra_node:
+                extras[name] = extra_node.value()
+            elif element.has_default():
+                extras[name] = element.default
+        return rule, extras
+
+    def process_recognition(self, node):
+        rule, extras = self.recognition_extras(node)
+        if rule is None:
+            print(f"{self.name}: no rule recognised in {node.words()}")
+            return
+        rule._process_recognition(node, extras)
+
+def expand_rules(rules):
+    """
+    Returns `rules` with each SharedPrefixRule replaced by its rules, e.g. to classify phrases by rule.
+    """
+    return [sub_rule for rule in rules for sub_rule in (rule.rules if isinstance(rule, SharedPrefixRule) else [rule])]
@@ -8,11 +8,11 @@ from __future__ import print_function
 
 import logging
 import os.path
+import json
 import sys
-import time
-import math
 import multiprocessing
-import wave
+import threading
+import time
 
 from dragonfly import get_engine
 from dragonfly.loader import CommandModuleDirectory, CommandModule
@@ -20,179 +20,47 @@ from dragonfly.log import default_levels
 from dragonfly.engines.backend_kaldi.audio import WavAudio
 
 from dragonfly.grammar.rule_compound import CompoundRule
+from dragonfly.grammar.recobs_callbacks import (register_beginning_callback, register_recognition_callback,
+                                                register_ending_callback)
 
 from kaldi_active_grammar import disable_donation_message, PlainDictationRecognizer
 
+from tacspeak.calculator import ArrayCalculator
+from tacspeak.phrase_index import PhraseIndex
+from tacspeak.shared_rules import SharedPrefixRule
+from tacspeak.result_cache import ResultCache, fingerprint_context, DEFAULT_CACHE_DIR
+from tacspeak.grammar_bundle import install_bundle, kaldi_dirs, rule_fsts
+from tacspeak.compile_cache import CompileCache
+from tacspeak.hot_reload import is_grammar_module
+from tacspeak.corpus import (is_corpus_file, get_archive, split_audio_path, read_blocks, read_pcm, list_audio_paths,
+                             expand_audio_inputs, audio_duration_s)
+
 
 # --------------------------------------------------------------------------
 # Functions
 
-# Adapted from daanzu/kaldi_ag_training, licensed under the AGPL-3.0
-# From wenet-e2e/wenet, licensed under the Apache License 2.0
-class Calculator:
-    def __init__(self) :
-        self.data = {}
-        self.space = []
-        self.cost = {}
-        self.cost['cor'] = 0
-        self.cost['sub'] = 1
-        self.cost['del'] = 1
-        self.cost['ins'] = 1
-    def calculate(self, lab, rec) :
-        # Initialization
-        lab.insert(0, '')
-        rec.insert(0, '')
-        while len(self.space) < len(lab) :
-            self.space.append([])
-        for row in self.space :
-            for element in row :
-                element['dist'] = 0
-                element['error'] = 'non'
-            while len(row) < len(rec) :
-                row.append({'dist' : 0, 'error' : 'non'})
-        for i in range(len(lab)) :
-            self.space[i][0]['dist'] = i
-            self.space[i][0]['error'] = 'del'
-        for j in range(len(rec)) :
-            self.space[0][j]['dist'] = j
-            self.space[0][j]['error'] = 'ins'
-        self.space[0][0]['error'] = 'non'
-        for token in lab :
-            if token not in self.data and len(token) > 0 :
-                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
-        for token in rec :
-            if token not in self.data and len(token) > 0 :
-                self.data[token] = {'all' : 0, 'cor' : 0, 'sub' : 0, 'ins' : 0, 'del' : 0}
-        # Computing edit distance
-        for i, lab_token in enumerate(lab) :
-            for j, rec_token in enumerate(rec) :
-                if i == 0 or j == 0 :
-                    continue
-                min_dist = sys.maxsize
-                min_error = 'none'
-                dist = self.space[i-1][j]['dist'] + self.cost['del']
-                error = 'del'
-                if dist < min_dist :
-                    min_dist = dist
-                    min_error = error
-                dist = self.space[i][j-1]['dist'] + self.cost['ins']
-                error = 'ins'
-                if dist < min_dist :
-                    min_dist = dist
-                    min_error = error
-                if lab_token == rec_token :
-                    dist = self.space[i-1][j-1]['dist'] + self.cost['cor']
-                    error = 'cor'
-                else :
-                    dist = self.space[i-1][j-1]['dist'] + self.cost['sub']
-                    error = 'sub'
-                if dist < min_dist :
-                    min_dist = dist
-                    min_error = error
-                self.space[i][j]['dist'] = min_dist
-                self.space[i][j]['error'] = min_error
-        # Tracing back
-        result = {'lab':[], 'rec':[], 'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
-        i = len(lab) - 1
-        j = len(rec) - 1
-        while True :
-            if self.space[i][j]['error'] == 'cor' : # correct
-                if len(lab[i]) > 0 :
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['cor'] = self.data[lab[i]]['cor'] + 1
-                    result['all'] = result['all'] + 1
-                    result['cor'] = result['cor'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, rec[j])
-                i = i - 1
-                j = j - 1
-            elif self.space[i][j]['error'] == 'sub' : # substitution
-                if len(lab[i]) > 0 :
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['sub'] = self.data[lab[i]]['sub'] + 1
-                    result['all'] = result['all'] + 1
-                    result['sub'] = result['sub'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, rec[j])
-                i = i - 1
-                j = j - 1
-            elif self.space[i][j]['error'] == 'del' : # deletion
-                if len(lab[i]) > 0 :
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['del'] = self.data[lab[i]]['del'] + 1
-                    result['all'] = result['all'] + 1
-                    result['del'] = result['del'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, "")
-                i = i - 1
-            elif self.space[i][j]['error'] == 'ins' : # insertion
-                if len(rec[j]) > 0 :
-                    self.data[rec[j]]['ins'] = self.data[rec[j]]['ins'] + 1
-                    result['ins'] = result['ins'] + 1
-                result['lab'].insert(0, "")
-                result['rec'].insert(0, rec[j])
-                j = j - 1
-            elif self.space[i][j]['error'] == 'non' : # starting point
-                break
-            else : # shouldn't reach here
-                print('this should not happen , i = {i} , j = {j} , error = {error}'.format(i = i, j = j, error = self.space[i][j]['error']))
-        return result
-    def overall(self) :
-        result = {'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
-        for token in self.data :
-            result['all'] = result['all'] + self.data[token]['all']
-            result['cor'] = result['cor'] + self.data[token]['cor']
-            result['sub'] = result['sub'] + self.data[token]['sub']
-            result['ins'] = result['ins'] + self.data[token]['ins']
-            result['del'] = result['del'] + self.data[token]['del']
-        return result
-    def overall_string(self):
-        out_string = ''
-        result = self.overall()
-        if result['all'] != 0 :
-            wer = float(result['ins'] + result['sub'] + result['del']) * 100.0 / result['all']
-        else :
-            wer = 0.0
-        out_string += str('Overall -> %4.2f %%' % wer)
-        out_string += str('+/- %4.2f %%' % er_margin_of_error(wer, n=result['all']))
-        out_string += str('N=%d C=%d S=%d D=%d I=%d' % (result['all'], result['cor'], result['sub'], result['del'], result['ins']))
-        return out_string
-
-    def cluster(self, data) :
-        result = {'all':0, 'cor':0, 'sub':0, 'ins':0, 'del':0}
-        for token in data :
-            if token in self.data :
-                result['all'] = result['all'] + self.data[token]['all']
-                result['cor'] = result['cor'] + self.data[token]['cor']
-                result['sub'] = result['sub'] + self.data[token]['sub']
-                result['ins'] = result['ins'] + self.data[token]['ins']
-                result['del'] = result['del'] + self.data[token]['del']
-        return result
-    def keys(self) :
-        return list(self.data.keys())
-    def ranked_worst_to_best_list(self) :
-        ranked_worst_tokens = []
-        for key, value in self.data.items():
-            token = key
-            n_errors = value['sub'] + value['del'] + value['ins']
-            n_correct = value['cor']
-            n_all = value['all']
-            rate_errors = float(n_errors) / float(max(1, n_all))
-            entry = {'token':token, 'rate_errors':rate_errors, 'n_errors':n_errors, 
-                     'n_correct':n_correct, 'n_all':n_all}
-            ranked_worst_tokens.append(entry)
-        ranked_worst_tokens.sort(key=lambda x: x['rate_errors'], reverse=True)
-        return ranked_worst_tokens
-
-
-def er_margin_of_error(error, n, z=1.96):
-    error = max(0, min(error, 100))
-    if n == 0: return float('nan')
-    error = float(error * 0.01)
-    moe = z * math.sqrt(error * (1 - error) / n)
-    return moe * 100
-
-def initialize_kaldi(model_dir):
+# max seconds to wait for each recognition (and mimic) of an utterance to complete
+RECOGNITION_TIMEOUT_S = 3.0
+
+# the engine (and dictation recognizer) initialized by this process, which a long-running 
+# process (see tacspeak.daemon) keeps connected and re-uses between test runs
+_kaldi_model_dir = None
+_grammar_directory = None
+_dictation_model_dir = None
+call_recognizer = None
+keep_engine_connected = False
+
+def initialize_kaldi(model_dir, audio_input_device=None, tmp_dir=None):
+    """
+    Connects the Kaldi engine to `model_dir` and loads the grammar modules. Rules are compiled
+    into `tmp_dir`, or if it's None, the tmp dir in KALDI_ENGINE_SETTINGS with any prebuilt rules
+    installed (see tacspeak/grammar_bundle.py).
+    """
+    global _kaldi_model_dir, _grammar_directory
+    if _kaldi_model_dir is not None and _kaldi_model_dir == os.path.abspath(model_dir):
+        engine = get_engine('kaldi')
+        engine.prepare_for_recognition()
+        return engine
     disable_donation_message()
     user_settings_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/user_settings.py"))
     user_settings = CommandModule(user_settings_path)
@@ -209,6 +77,11 @@ def initialize_kaldi(model_dir):
     except Exception:
         print("Failed to load `tacspeak/user_settings.py` DEBUG_HEAVY_DUMP_GRAMMAR. Using default settings as fallback.")
         DEBUG_HEAVY_DUMP_GRAMMAR = False
+    try:
+        # execute (print) actions within the recognition, so they're timed and printed in order
+        (sys.modules["user_settings"]).ASYNC_ACTIONS = False
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` ASYNC_ACTIONS. Using default settings as fallback.")
     try:
         (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["model_dir"] = model_dir
         (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["listen_key"] = None
@@ -219,6 +92,8 @@ def initialize_kaldi(model_dir):
         (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["listen_key_padding_end_ms_min"] = 0
         (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["listen_key_padding_end_ms_max"] = 0
         (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["listen_key_padding_end_always_max"] = False
+        if audio_input_device is not None:
+            (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS["audio_input_device"] = audio_input_device
         KALDI_ENGINE_SETTINGS = (sys.modules["user_settings"]).KALDI_ENGINE_SETTINGS
     except Exception:
         print("Failed to load `tacspeak/user_settings.py` KALDI_ENGINE_SETTINGS. Using default settings as fallback.")
@@ -229,6 +104,10 @@ def initialize_kaldi(model_dir):
             "auto_add_to_user_lexicon":False, # this requires g2p_en (which isn't installed by default)
             "allow_online_pronunciations":False,
         }
+    if tmp_dir is not None:
+        KALDI_ENGINE_SETTINGS["tmp_dir"] = tmp_dir
+    else:
+        install_bundle(KALDI_ENGINE_SETTINGS)
     
 
     def log_handlers():
@@ -258,17 +137,28 @@ def initialize_kaldi(model_dir):
     
     setup_loggers()
 
-    # Set any configuration options here as keyword arguments.
-    # See Kaldi engine documentation for all available options and more info.
-    engine = get_engine('kaldi',**KALDI_ENGINE_SETTINGS)
+    grammar_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/grammar/"))
+    grammar_module_paths = [os.path.join(grammar_path, filename) for filename in os.listdir(grammar_path)]
+    input_paths = [user_settings_path] + [path for path in grammar_module_paths if is_grammar_module(path)]
+
+    # one process at a time compiles into the tmp dir, see tacspeak/compile_cache.py
+    with CompileCache("grammar", *kaldi_dirs(KALDI_ENGINE_SETTINGS), input_paths) as compile_cache:
+        # Set any configuration options here as keyword arguments.
+        # See Kaldi engine documentation for all available options and more info.
+        engine = get_engine('kaldi',**KALDI_ENGINE_SETTINGS)
 
-    # Call connect() now that the engine configuration is set.
-    engine.connect()
+        # Call connect() now that the engine configuration is set.
+        engine.connect()
 
-    # Load grammars.
-    grammar_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/grammar/"))
-    directory = CommandModuleDirectory(grammar_path)
-    directory.load()
+        # Load grammars.
+        directory = CommandModuleDirectory(grammar_path)
+        directory.load()
+        _grammar_directory = directory
+
+        # Compile the grammars now, rather than when recognition starts
+        engine.prepare_for_recognition()
+        compile_cache.finish([filename for rule, filename in rule_fsts(engine).values()])
+    print(compile_cache.stats_string())
 
     handlers = log_handlers()
     log_recognition = logging.getLogger('on_recognition')
@@ -276,112 +166,207 @@ def initialize_kaldi(model_dir):
     log_recognition.addHandler(handlers[1])
     log_recognition.setLevel(20)
 
-    # Start the engine's main recognition loop
-    engine.prepare_for_recognition()
+    _kaldi_model_dir = os.path.abspath(model_dir)
     return engine
 
-def recognize(wav_path, text):
+def release_kaldi(engine):
+    """
+    Disconnects the engine from initialize_kaldi(), unless keep_engine_connected is set.
+    """
+    global _kaldi_model_dir
+    if keep_engine_connected:
+        return
+    engine.disconnect()
+    _kaldi_model_dir = None
+
+def reload_grammars():
+    """
+    Unloads all grammars from the engine initialized by initialize_kaldi(), then loads the 
+    grammar modules again, recompiling any that changed.
+    """
+    global _grammar_directory
     engine = get_engine('kaldi')
+    for grammar in list(engine.grammars):
+        grammar.unload()
+    if _grammar_directory is not None:
+        _grammar_directory.unload()
+    grammar_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/grammar/"))
+    _grammar_directory = CommandModuleDirectory(grammar_path)
+    _grammar_directory.load()
+    engine.prepare_for_recognition()
+    return engine
 
-    testmodel_recog_buffer = None
-    testmodel_busy = False
-
-    # Define recognition callback functions.
-    def on_begin():
-        nonlocal testmodel_recog_buffer
-        nonlocal testmodel_busy
-        testmodel_recog_buffer = None
-        testmodel_busy = True
-
-    def on_recognition(words, results, rule, node):
-        nonlocal testmodel_recog_buffer
-        # message = f"{results.kaldi_rule} | {' '.join(words)}"
-        # log_recognition = logging.getLogger('on_recognition')
-        # log_recognition.log(20, message)
-        testmodel_recog_buffer = (' '.join(words), results, rule, node)
-
-    def on_failure():
-        pass
-
-    def on_end():
-        nonlocal testmodel_busy
-        testmodel_busy = False
-
-    engine.do_recognition(on_begin, on_recognition, on_failure, on_end, audio_iter=WavAudio.read_file(wav_path, realtime=False))
-    
-    n_sleeps = 0
-    while testmodel_recog_buffer is None and n_sleeps < 30:
-        n_sleeps += 1
-        time.sleep(0.1)
-    output_str = ""
-    output_extras = None
-    output_options = None
-    output_rule = None
-    if testmodel_recog_buffer:
-        output_str = testmodel_recog_buffer[0]
-        rule = testmodel_recog_buffer[2]
-        node = testmodel_recog_buffer[3]
-        if not "NoiseSink" in rule.name:
-            output_rule = rule
-        if isinstance(output_rule, CompoundRule):
-            extras = {
-                "_grammar":  rule.grammar,
-                "_rule":     rule,
-                "_node":     node,
-            }
-            extras.update(rule._defaults)
-            for name, element in rule._extras.items():
-                extra_node = node.get_child_by_name(name, shallow=True)
-                if extra_node:
-                    extras[name] = extra_node.value()
-                elif element.has_default():
-                    extras[name] = element.default
-            output_extras = extras
-            output_options = {k:v for k,v in output_extras.items() if k not in ['_grammar','_rule','_node']}
+class RecognitionWaiter:
+    """
+    Receives the result of each recognition (or mimic) from the engine's 
+    recognition callbacks, and signals its completion with a threading.Event 
+    set from ``on_end``, which the engine calls after both success and failure.
+    The callbacks are registered once per process, see ``get_recognition_waiter()``.
+    """
+    def __init__(self):
+        self.recog_buffer = None
+        self.done = threading.Event()
+
+    def register(self):
+        register_beginning_callback(self.on_begin)
+        register_recognition_callback(self.on_recognition)
+        register_ending_callback(self.on_end)
+
+    def reset(self):
+        self.recog_buffer = None
+        self.done.clear()
+
+    def wait(self, timeout):
+        """
+        Returns True if the recognition completed within `timeout` seconds.
+        """
+        return self.done.wait(timeout)
+
+    def on_begin(self):
+        self.recog_buffer = None
+
+    def on_recognition(self, words, results, rule, node):
+        self.recog_buffer = (' '.join(words), results, rule, node)
+
+    def on_end(self):
+        self.done.set()
+
+_recognition_waiter = None
+
+def get_recognition_waiter():
+    global _recognition_waiter
+    if _recognition_waiter is None:
+        _recognition_waiter = RecognitionWaiter()
+        _recognition_waiter.register()
+    return _recognition_waiter
+
+def extract_recognition(recog_buffer):
+    """
+    Returns (words, rule, extras, options) from a RecognitionWaiter.recog_buffer, 
+    where rule is None for NoiseSink (or no recognition), and extras/options are 
+    None unless rule is a CompoundRule. For a SharedPrefixRule, it's the rule whose spec was spoken.
+    """
+    if not recog_buffer:
+        return "", None, None, None
+    words = recog_buffer[0]
+    rule = recog_buffer[2]
+    node = recog_buffer[3]
+    if "NoiseSink" in rule.name:
+        return words, None, None, None
+    if isinstance(rule, SharedPrefixRule):
+        rule, extras = rule.recognition_extras(node)
+        if rule is None:
+            return words, None, None, None
+    elif not isinstance(rule, CompoundRule):
+        return words, rule, None, None
     else:
-        output_str = ""
-
-    testmodel_recog_buffer = None
-    testmodel_busy = False
+        extras = {
+            "_grammar":  rule.grammar,
+            "_rule":     rule,
+            "_node":     node,
+        }
+        extras.update(rule._defaults)
+        for name, element in rule._extras.items():
+            extra_node = node.get_child_by_name(name, shallow=True)
+            if extra_node:
+                extras[name] = extra_node.value()
+            elif element.has_default():
+                extras[name] = element.default
+    options = {k:v for k,v in extras.items() if k not in ['_grammar','_rule','_node']}
+    return words, rule, extras, options
+
+def read_audio_blocks(wav_path, realtime=False):
+    """
+    Returns an audio block iterator for engine.do_recognition(), from a wav file or a corpus clip.
+    """
+    if split_audio_path(wav_path) is not None:
+        return read_blocks(wav_path, realtime=realtime)
+    return WavAudio.read_file(wav_path, realtime=realtime)
+
+def start_pool(num_threads, initializer, initargs, warm_pool=False):
+    """
+    Returns a multiprocessing.Pool of `num_threads` workers, each running `initializer(*initargs)`.
+    If `warm_pool`, workers are instead forked from this (already initialized) process, 
+    sharing its loaded model and grammars copy-on-write. This needs the fork start method (Linux).
+    """
+    if warm_pool:
+        return multiprocessing.get_context("fork").Pool(processes=num_threads, initializer=initialize_forked_worker)
+    return multiprocessing.Pool(processes=num_threads, initializer=initializer, initargs=initargs)
+
+def check_warm_pool(warm_pool):
+    if warm_pool and "fork" not in multiprocessing.get_all_start_methods():
+        print("warm_pool requires the fork start method (Linux), initializing each worker instead")
+        return False
+    return warm_pool
+
+def initialize_forked_worker():
+    if _recognition_waiter is not None:
+        _recognition_waiter.reset()
+
+def rule_name(rule):
+    """
+    Returns a name identifying `rule` across processes, or None.
+    """
+    if rule is None:
+        return None
+    return f"{rule.grammar.name}/{rule.name}" if rule.grammar else rule.name
+
+def jsonable(value):
+    """
+    Returns `value` as it would be read back from a journal or cache, so that 
+    options from different sources compare equal.
+    """
+    return json.loads(json.dumps(value, default=str))
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+def mimic_reference(text, timeout=RECOGNITION_TIMEOUT_S):
+    """
+    Returns the reference parse of `text` using engine.mimic(), as a dict of 
+    'rule' (see rule_name()), 'options' (the rule's extras), and 'timed_out'.
+    """
+    engine = get_engine('kaldi')
+    waiter = get_recognition_waiter()
+    timed_out = False
 
-    # becaused we called do_recognition with on_recognition callbacks, 
-    # it should still be registered in engine and we don't have to do anything for mimic
+    # the callbacks are registered with the engine, so they also receive the mimic result
+    waiter.reset()
     try:
         engine.mimic(text)
     except Exception:
+        # a failed mimic either never began (nothing to wait for), or has already ended
         pass
-    
-    n_sleeps = 0
-    while testmodel_recog_buffer is None and n_sleeps < 30:
-        n_sleeps += 1
-        time.sleep(0.1)
-    input_str = ""
-    input_extras = None
-    input_options = None
-    input_rule = None
-    if testmodel_recog_buffer:
-        input_str = testmodel_recog_buffer[0]
-        rule = testmodel_recog_buffer[2]
-        node = testmodel_recog_buffer[3]
-        if not "NoiseSink" in rule.name:
-            input_rule = rule
-        if isinstance(input_rule, CompoundRule):
-            extras = {
-                "_grammar":  rule.grammar,
-                "_rule":     rule,
-                "_node":     node,
-            }
-            extras.update(rule._defaults)
-            for name, element in rule._extras.items():
-                extra_node = node.get_child_by_name(name, shallow=True)
-                if extra_node:
-                    extras[name] = extra_node.value()
-                elif element.has_default():
-                    extras[name] = element.default
-            input_extras = extras
-            input_options = {k:v for k,v in input_extras.items() if k not in ['_grammar','_rule','_node']}
     else:
-        input_str = ""
+        if not waiter.wait(timeout):
+            print(f"Timed out after {timeout}s waiting for mimic of {text}")
+            timed_out = True
+    input_str, input_rule, input_extras, input_options = extract_recognition(waiter.recog_buffer)
+    return {'rule': rule_name(input_rule), 'options': jsonable(input_options), 'timed_out': timed_out}
+
+def recognize(wav_path, text, timeout=RECOGNITION_TIMEOUT_S, reference=None):
+    """
+    Recognizes `wav_path`, comparing the result to the `reference` parse of `text`.
+    If `reference` is None it's parsed with mimic_reference().
+    """
+    engine = get_engine('kaldi')
+    waiter = get_recognition_waiter()
+    timed_out = False
+
+    waiter.reset()
+    engine.do_recognition(audio_iter=read_audio_blocks(wav_path))
+    if not waiter.wait(timeout):
+        print(f"Timed out after {timeout}s waiting for recognition of {wav_path}")
+        timed_out = True
+    output_str, output_rule, output_extras, output_options = extract_recognition(waiter.recog_buffer)
+    output_rule = rule_name(output_rule)
+    output_options = jsonable(output_options)
+
+    if reference is None:
+        reference = mimic_reference(text, timeout)
+    input_rule = reference['rule']
+    input_options = reference['options']
+    timed_out = timed_out or reference['timed_out']
 
     correct_rule = 0
     if output_rule is not None and output_rule == input_rule:
@@ -391,23 +376,19 @@ def recognize(wav_path, text):
 
     print(f"Ref: {text}")
     print(f"Hyp: {output_str}")
-    print(f"input_extras: {input_extras}")
-    print(f"output_extras: {output_extras}")
+    print(f"input_options: {input_options}")
+    print(f"output_options: {output_options}")
 
-    return output_str, text, output_options, input_options, correct_rule, wav_path
+    return output_str, text, output_options, input_options, correct_rule, wav_path, timed_out
 
 # --------------------------------------------------------------------------
-# Main event driving loop.
-
-def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1):
-    # from tacspeak.test_model import test_model
-    # test_model("./testaudio/recorder.tsv", "./kaldi_model/")
-    # python -c 'from tacspeak.test_model import test_model; test_model("./testaudio/recorder.tsv", "./kaldi_model/")'
-
-    print("Start test_model")
-
-    calculator = Calculator()
+# Test run helpers: submissions, journal, progress, scoring
 
+def read_test_submissions(tsv_file, lexicon_file=None):
+    """
+    Returns a list of (wav_path, text) from a retain.tsv formatted file, 
+    skipping wav files that don't exist and text that is out of vocabulary.
+    """
     lexicon = set()
     if lexicon_file:
         with open(lexicon_file, 'r', encoding='utf-8') as f:
@@ -415,6 +396,15 @@ def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1):
                 word = line.strip().split(None, 1)[0]
                 lexicon.add(word)
 
+    if is_corpus_file(tsv_file):
+        print(f"opening corpus {tsv_file}")
+        submissions = []
+        for wav_path, text in get_archive(tsv_file).clips():
+            if lexicon_file and any(word not in lexicon for word in text.split()):
+                continue
+            submissions.append((wav_path, text))
+        return submissions
+
     print(f"opening {tsv_file}")
     with open(tsv_file, 'r', encoding='utf-8') as f:
         submissions = []
@@ -430,97 +420,399 @@ def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1):
                 continue
             submissions.append((wav_path, text,))
         print(f"read lines: {len(submissions)}")
+    return submissions
+
+class TestJournal:
+    """
+    Append-only checkpoint of a test run, one JSON record per recognized utterance.
+    The first line is a header identifying the run (mode, tsv_file, model_dir); 
+    a journal with a different header is not resumed, it is started over.
+    Each record is flushed as it's written, so it survives a Ctrl-C or crash.
+    """
+    def __init__(self, journal_path, mode, tsv_file, model_dir):
+        self.journal_path = journal_path
+        self.header = {'journal':mode, 'tsv_file':tsv_file, 'model_dir':model_dir}
+        self.file = None
+
+    def load(self):
+        """
+        Returns the list of records from a previous matching run, or [] if none.
+        """
+        if not os.path.isfile(self.journal_path):
+            return []
+        records = []
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # the last line may be partially written if the run crashed
+                    continue
+                if i == 0:
+                    if item != self.header:
+                        print(f"{self.journal_path} is from a different run {item}, starting over")
+                        return []
+                    continue
+                records.append(item)
+        return records
+
+    def open(self, records):
+        """
+        Opens the journal for appending, rewriting it with `records` (e.g. from load()).
+        """
+        self.file = open(self.journal_path, 'w', encoding='utf-8')
+        self.file.write(json.dumps(self.header) + "\n")
+        for record in records:
+            self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+
+class TestProgress:
+    """
+    Prints live progress of a test run: count, rate, and estimated time remaining.
+    """
+    def __init__(self, n_total, n_resumed=0, interval_s=1.0):
+        self.n_total = n_total
+        self.n_resumed = n_resumed
+        self.n_done = 0
+        self.interval_s = interval_s
+        self.start_time = time.perf_counter()
+        self.last_print_time = 0.0
+
+    def update(self, n=1):
+        self.n_done += n
+        now = time.perf_counter()
+        if self.n_done < self.n_total and now - self.last_print_time < self.interval_s:
+            return
+        self.last_print_time = now
+        elapsed = now - self.start_time
+        rate = self.n_done / max(elapsed, 1e-9)
+        eta = (self.n_total - self.n_done) / max(rate, 1e-9)
+        print(f"Progress: {self.n_resumed + self.n_done}/{self.n_resumed + self.n_total}"
+              + f" ({rate:.2f} utt/s, elapsed {elapsed:.0f}s, eta {eta:.0f}s)")
+
+def new_cmd_overall_stats():
+    return {'cmd_not_correct_output':0, 
+            'cmd_not_correct_rule':0,
+            'cmd_not_correct_options':0,
+            'cmd_not_recog_output':0,
+            'cmd_not_recog_input':0,
+            'cmds':0,
+            'timed_out':0,
+            }
 
+def score_utterance(calculator, cmd_overall_stats, record):
+    """
+    Scores a recognize() record into calculator (and cmd_overall_stats), returning the utterance entry.
+    """
+    text = record['ref']
+    output_str = record['hyp']
+    wav_path = record['wav_path']
+    output_options = record['output_options']
+    input_options = record['input_options']
+    correct_rule = record['correct_rule']
+    timed_out = record['timed_out']
+
+    result = calculator.calculate(text.strip().split(), output_str.strip().split())
+    n_errors = result['sub'] + result['del'] + result['ins']
+    n_correct = result['cor']
+    n_all = result['all']
+    rate_errors = float(n_errors) / float(max(1, n_all))
+
+    cmd_recog_input = 1 if input_options is not None else -1
+    cmd_recog_output = 1 if output_options is not None else -1
+
+    cmd_correct_rule = correct_rule
+    cmd_correct_options = 0
+    cmd_correct_output = 0
+
+    if cmd_recog_input == 1 and cmd_recog_output == 1:
+        if cmd_correct_rule == 1:
+            cmd_correct_options = 1
+            for key, value in input_options.items():
+                if output_options[key] != value:
+                    cmd_correct_options = -1
     
-    # initialize first in-case model needs to be recompiled
-    engine = initialize_kaldi(model_dir)
-    engine.disconnect()
+    if correct_rule == 1:
+        cmd_recog_input = 1
+        cmd_recog_output = 1
+
+    if cmd_correct_rule == -1 or cmd_correct_options == -1:
+        cmd_correct_output = -1
+    elif cmd_correct_rule == 1 and cmd_correct_options == 1:
+        cmd_correct_output = 1
+
+    cmd_overall_stats['cmd_not_correct_output'] += 1 if cmd_correct_output == -1 else 0
+    cmd_overall_stats['cmd_not_correct_rule'] += 1 if cmd_correct_rule == -1 else 0
+    cmd_overall_stats['cmd_not_correct_options'] += 1 if cmd_correct_options == -1 else 0
+    cmd_overall_stats['cmd_not_recog_output'] += 1 if cmd_recog_output == -1 else 0
+    cmd_overall_stats['cmd_not_recog_input'] += 1 if cmd_recog_input == -1 else 0
+    cmd_overall_stats['cmds'] += 1
+    cmd_overall_stats['timed_out'] += 1 if timed_out else 0
+
+    entry = {'ref':text, 'hyp':output_str, 'wav_path':wav_path,
+             'cmd_correct_output':cmd_correct_output, 
+             'cmd_correct_rule':cmd_correct_rule,
+             'cmd_correct_options':cmd_correct_options,
+             'cmd_recog_output':cmd_recog_output,
+             'cmd_recog_input':cmd_recog_input,
+             'output_options':output_options,
+             'input_options':input_options,
+             'timed_out':timed_out,
+             'n_errors':n_errors, 'n_correct':n_correct, 'n_all':n_all, 'rate_errors':rate_errors
+             }
+    return entry
 
+def score_utterance_dictation(calculator, record):
+    """
+    Scores a recognize_dictation() record into calculator, returning the utterance entry.
+    """
+    text = record['ref']
+    output_str = record['hyp']
+    result = calculator.calculate(text.strip().split(), output_str.strip().split())
+    n_errors = result['sub'] + result['del'] + result['ins']
+    n_correct = result['cor']
+    n_all = result['all']
+    rate_errors = float(n_errors) / float(max(1, n_all))
+
+    entry = {'ref':text, 'hyp':output_str, 'wav_path':record['wav_path'],
+             'n_errors':n_errors, 'n_correct':n_correct, 'n_all':n_all, 'rate_errors':rate_errors
+             }
+    return entry
+
+def recognize_submission(submission):
+    """
+    recognize() a (wav_path, text, timeout, reference) submission, returning a journal record
+    """
+    output_str, text, output_options, input_options, correct_rule, wav_path, timed_out = recognize(*submission)
+    return {'ref':text, 'hyp':output_str, 'wav_path':wav_path,
+            'output_options':output_options, 'input_options':input_options,
+            'correct_rule':correct_rule, 'timed_out':timed_out}
+
+def recognize_submission_dictation(submission):
+    """
+    recognize_dictation() a (wav_path, text) submission, returning a journal record
+    """
+    output_str, text, wav_path = recognize_dictation(*submission)
+    return {'ref':text, 'hyp':output_str, 'wav_path':wav_path}
+
+def resume_from_journal(journal, submissions):
+    """
+    Returns (records, remaining submissions), where records are loaded from `journal` 
+    (if any) and remaining submissions exclude the wav paths already recorded.
+    """
+    if journal is None:
+        return [], submissions
+    records = journal.load()
+    journal.open(records)
+    if not records:
+        return records, submissions
+    done_wav_paths = set(record['wav_path'] for record in records)
+    remaining = [item for item in submissions if item[0] not in done_wav_paths]
+    print(f"resuming from {journal.journal_path}: {len(records)} done, {len(remaining)} remaining")
+    return records, remaining
+
+def open_result_cache(mode, model_dir, grammars=None, settings=None, cache_dir=DEFAULT_CACHE_DIR):
+    context = fingerprint_context(mode, model_dir, grammars, settings)
+    cache = ResultCache(context, cache_dir).open()
+    print(f"Result cache {cache.path}: {len(cache.entries)} entries")
+    return cache
+
+def split_cached_submissions(cache, submissions):
+    """
+    Returns (records, remaining submissions), where records are cached results for submissions,
+    and remaining submissions are those not in the cache.
+    """
+    records = []
+    remaining = []
+    for submission in submissions:
+        wav_path, text = submission[0], submission[1]
+        record = cache.get(cache.key(wav_path, text))
+        if record is None:
+            remaining.append(submission)
+        else:
+            records.append(dict(record, ref=text, wav_path=wav_path))
+    return records, remaining
+
+def cache_record(cache, record):
+    if cache is None or record.get('timed_out'):
+        return
+    cache.put(cache.key(record['wav_path'], record['ref']), record)
+
+def index_reference(phrase_index, text):
+    """
+    Returns the reference parse of `text` using a PhraseIndex, like mimic_reference() but without the engine.
+    """
+    rule, options = phrase_index.classify(text)
+    if rule is not None and "NoiseSink" in rule.name:
+        rule, options = None, None
+    elif rule is not None and not isinstance(rule, CompoundRule):
+        options = None
+    return {'rule': rule_name(rule), 'options': jsonable(options), 'timed_out': False}
+
+def get_reference_parses(submissions, parse_cache=None, timeout=RECOGNITION_TIMEOUT_S, phrase_index=None):
+    """
+    Returns {normalized text: mimic_reference()} for each unique text in submissions,
+    using (and updating) `parse_cache` if given. Must be called with the engine initialized.
+    The retain corpus repeats the same commands many times over, so this is far fewer 
+    mimics than one per utterance.
+    If `phrase_index` is given, texts are parsed with index_reference() instead, only 
+    mimicking those it can't parse if it left out any (unsupported) rules.
+    """
+    references = {}
+    for submission in submissions:
+        text = normalize_text(submission[1])
+        if text in references:
+            continue
+        reference = parse_cache.get(text) if parse_cache else None
+        if reference is None and phrase_index is not None:
+            reference = index_reference(phrase_index, text)
+            if reference['rule'] is None and phrase_index.unsupported:
+                reference = None
+        if reference is None:
+            reference = mimic_reference(text, timeout)
+            if parse_cache and not reference['timed_out']:
+                parse_cache.put(text, reference)
+        references[text] = reference
+    return references
+
+def new_phrase_index(grammars):
+    """
+    Returns the PhraseIndex of the rules of `grammars`, printing any it left out.
+    """
+    phrase_index = PhraseIndex.from_grammars(grammars)
+    for name, reason in phrase_index.unsupported.items():
+        print(f"Phrase index: left out {name}, {reason}")
+    return phrase_index
+
+def load_text_engine_grammars():
+    """
+    Loads user settings and the grammar modules with dragonfly's text engine, 
+    i.e. without loading a Kaldi model, returning the engine's grammars.
+    """
+    engine = get_engine('text')
+    user_settings_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/user_settings.py"))
+    CommandModule(user_settings_path).load()
+    try:
+        (sys.modules["user_settings"]).ASYNC_ACTIONS = False
+    except Exception:
+        print("Failed to load `tacspeak/user_settings.py` ASYNC_ACTIONS. Using default settings as fallback.")
+    grammar_path = os.path.join(os.getcwd(), os.path.relpath("tacspeak/grammar/"))
+    CommandModuleDirectory(grammar_path).load()
+    return engine.grammars
+
+def classify_transcripts(tsv_file, out_path):
+    """
+    Writes the rule and options each transcript in `tsv_file` would be recognised as to `out_path`
+    (tab separated wav_path, text, rule, options json), parsed with a PhraseIndex of the grammar 
+    modules, without loading a Kaldi model. Returns {rule: number of transcripts}.
+    """
+    phrase_index = new_phrase_index(load_text_engine_grammars())
+    submissions = read_test_submissions(tsv_file)
+    start_time = time.perf_counter()
+    rule_counts = {}
+    references = {}
+    with open(out_path, 'w', encoding='utf-8') as outfile:
+        for wav_path, text in submissions:
+            text = normalize_text(text)
+            reference = references.get(text)
+            if reference is None:
+                reference = references[text] = index_reference(phrase_index, text)
+            rule_counts[reference['rule']] = rule_counts.get(reference['rule'], 0) + 1
+            outfile.write(f"{wav_path}\t{text}\t{reference['rule']}\t{json.dumps(reference['options'])}\n")
+    elapsed_s = time.perf_counter() - start_time
+    print(f"Classified {len(submissions)} transcripts in {elapsed_s:.2f}s, written to {out_path}")
+    for rule, count in sorted(rule_counts.items(), key=lambda item: -item[1]):
+        print(f"{count:>8} {rule}")
+    return rule_counts
+
+# --------------------------------------------------------------------------
+# Main event driving loop.
+
+def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1, timeout=RECOGNITION_TIMEOUT_S, journal_path=None,
+               use_cache=True, cache_dir=DEFAULT_CACHE_DIR, warm_pool=False, use_phrase_index=False):
+    # from tacspeak.test_model import test_model
+    # test_model("./testaudio/recorder.tsv", "./kaldi_model/")
+    # python -c 'from tacspeak.test_model import test_model; test_model("./testaudio/recorder.tsv", "./kaldi_model/")'
+
+    print("Start test_model")
+
+    calculator = ArrayCalculator()
+    cmd_overall_stats = new_cmd_overall_stats()
     utterances_list = []
-    cmd_all_threads_overall_stats = []
-    
-    with multiprocessing.Pool(processes=num_threads, initializer=initialize_kaldi, initargs=(model_dir,)) as pool:
-        try:
-            cmd_thread_overall_stats = {'cmd_not_correct_output':0, 
-                                        'cmd_not_correct_rule':0,
-                                        'cmd_not_correct_options':0,
-                                        'cmd_not_recog_output':0,
-                                        'cmd_not_recog_input':0,
-                                        'cmds':0,
-                                        }
-            for output_str, text, output_options, input_options, correct_rule, wav_path in pool.starmap(recognize, submissions, chunksize=1):
-                result = calculator.calculate(text.strip().split(), output_str.strip().split())
-                n_errors = result['sub'] + result['del'] + result['ins']
-                n_correct = result['cor']
-                n_all = result['all']
-                rate_errors = float(n_errors) / float(max(1, n_all))
-
-                cmd_recog_input = 1 if input_options is not None else -1
-                cmd_recog_output = 1 if output_options is not None else -1
-
-                cmd_correct_rule = correct_rule
-                cmd_correct_options = 0
-                cmd_correct_output = 0
-
-                if cmd_recog_input == 1 and cmd_recog_output == 1:
-                    if cmd_correct_rule == 1:
-                        cmd_correct_options = 1
-                        for key, value in input_options.items():
-                            if output_options[key] != value:
-                                cmd_correct_options = -1
-                
-                if correct_rule == 1:
-                    cmd_recog_input = 1
-                    cmd_recog_output = 1
-
-                if cmd_correct_rule == -1 or cmd_correct_options == -1:
-                    cmd_correct_output = -1
-                elif cmd_correct_rule == 1 and cmd_correct_options == 1:
-                    cmd_correct_output = 1
-
-                cmd_thread_overall_stats['cmd_not_correct_output'] += 1 if cmd_correct_output == -1 else 0
-                cmd_thread_overall_stats['cmd_not_correct_rule'] += 1 if cmd_correct_rule == -1 else 0
-                cmd_thread_overall_stats['cmd_not_correct_options'] += 1 if cmd_correct_options == -1 else 0
-                cmd_thread_overall_stats['cmd_not_recog_output'] += 1 if cmd_recog_output == -1 else 0
-                cmd_thread_overall_stats['cmd_not_recog_input'] += 1 if cmd_recog_input == -1 else 0
-                cmd_thread_overall_stats['cmds'] += 1
-
-                entry = {'ref':text, 'hyp':output_str, 'wav_path':wav_path,
-                         'cmd_correct_output':cmd_correct_output, 
-                         'cmd_correct_rule':cmd_correct_rule,
-                         'cmd_correct_options':cmd_correct_options,
-                         'cmd_recog_output':cmd_recog_output,
-                         'cmd_recog_input':cmd_recog_input,
-                         'output_options':output_options,
-                         'input_options':input_options,
-                         'n_errors':n_errors, 'n_correct':n_correct, 'n_all':n_all, 'rate_errors':rate_errors
-                         }
-                utterances_list.append(entry)
-
-            cmd_all_threads_overall_stats.append(cmd_thread_overall_stats)
-        except KeyboardInterrupt as e:
-            print(f"Closing pool: {e}")
-            pool.close()
-            return None
+
+    submissions = read_test_submissions(tsv_file, lexicon_file)
+    journal = TestJournal(journal_path, "test_model", tsv_file, model_dir) if journal_path else None
+    records, submissions = resume_from_journal(journal, submissions)
+    for record in records:
+        utterances_list.append(score_utterance(calculator, cmd_overall_stats, record))
+
+    warm_pool = check_warm_pool(warm_pool)
+    engine = None
+    cache = None
+    references = {}
+    if submissions:
+        # initialize first, pre-compiling the model and grammars for the workers.
+        # a warm pool forks from this engine, so it mustn't open a microphone stream
+        engine = initialize_kaldi(model_dir, audio_input_device=False if warm_pool else None)
+        if use_cache:
+            settings = getattr(sys.modules.get("user_settings"), "KALDI_ENGINE_SETTINGS", {})
+            cache = open_result_cache("recognize", model_dir, engine.grammars, settings, cache_dir)
+            cached_records, submissions = split_cached_submissions(cache, submissions)
+            for record in cached_records:
+                if journal:
+                    journal.append(record)
+                utterances_list.append(score_utterance(calculator, cmd_overall_stats, record))
+            records += cached_records
+        # parse each unique transcript once here, so workers only decode audio
+        phrase_index = new_phrase_index(engine.grammars) if use_phrase_index else None
+        parse_cache = open_result_cache("mimic", model_dir, engine.grammars, cache_dir=cache_dir) if use_cache and not phrase_index else None
+        references = get_reference_parses(submissions, parse_cache, timeout, phrase_index)
+        if parse_cache:
+            print(parse_cache.stats_string())
+            parse_cache.close()
+        if not (warm_pool and submissions):
+            release_kaldi(engine)
+            engine = None
+
+    if submissions:
+        progress = TestProgress(len(submissions), n_resumed=len(records))
+        with start_pool(num_threads, initialize_kaldi, (model_dir,), warm_pool) as pool:
+            try:
+                submissions = [(wav_path, text, timeout, references[normalize_text(text)]) for wav_path, text in submissions]
+                for record in pool.imap_unordered(recognize_submission, submissions, chunksize=1):
+                    if journal:
+                        journal.append(record)
+                    cache_record(cache, record)
+                    utterances_list.append(score_utterance(calculator, cmd_overall_stats, record))
+                    progress.update()
+            except KeyboardInterrupt as e:
+                print(f"Closing pool: {e}")
+                pool.terminate()
+                if cache:
+                    cache.close()
+                if journal:
+                    journal.close()
+                    print(f"{progress.n_resumed + progress.n_done} utterances saved to {journal.journal_path}, re-run to resume")
+                return None
+    if engine:
+        release_kaldi(engine)
+    if cache:
+        print(cache.stats_string())
+        cache.close()
+    if journal:
+        journal.close()
 
     utterances_list.sort(key=lambda x: (x['cmd_correct_output'] * 100.0) + (x['cmd_correct_rule'] * 3.0) + (x['cmd_correct_options'] * 3.0) + (x['cmd_recog_output'] * 2.0) + x['cmd_recog_input'] - x['rate_errors'], reverse=False)
     
-    cmd_overall_stats = {}
-    cmd_overall_stats['cmd_not_correct_output'] = 0
-    cmd_overall_stats['cmd_not_correct_rule'] = 0
-    cmd_overall_stats['cmd_not_correct_options'] = 0
-    cmd_overall_stats['cmd_not_recog_output'] = 0
-    cmd_overall_stats['cmd_not_recog_input'] = 0
-    cmd_overall_stats['cmds'] = 0
-
-    for thread_item in cmd_all_threads_overall_stats:
-        cmd_overall_stats['cmd_not_correct_output'] += thread_item['cmd_not_correct_output']
-        cmd_overall_stats['cmd_not_correct_rule'] += thread_item['cmd_not_correct_rule']
-        cmd_overall_stats['cmd_not_correct_options'] += thread_item['cmd_not_correct_options']
-        cmd_overall_stats['cmd_not_recog_output'] += thread_item['cmd_not_recog_output']
-        cmd_overall_stats['cmd_not_recog_input'] += thread_item['cmd_not_recog_input']
-        cmd_overall_stats['cmds'] += thread_item['cmds']
-    
     with open('./test_model_output_utterances.txt', 'w', encoding='utf-8') as outfile:
         outfile.write(f"{cmd_overall_stats}\n\n")
         for item in utterances_list:
@@ -534,6 +826,7 @@ def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1):
                             + f"\n ref: {item['ref']}"
                             + f"\n hyp: {item['hyp']}"
                             + f"\n wav_path: {item['wav_path']}"
+                            + (f"\n timed_out: {item['timed_out']}" if item['timed_out'] else "")
                             + f"\n input_options: {item['input_options']}"
                             + f"\n output_options: {item['output_options']}"
                             + "\n"
@@ -544,101 +837,138 @@ def test_model(tsv_file, model_dir, lexicon_file=None, num_threads=1):
     
     return calculator, cmd_overall_stats
 
-def transcribe_wav(wav_path, out_txt_path=None, model_dir=None):
-    call_recognizer = None
-    if model_dir is None:
-        model_dir = "./kaldi_model/"
-    initialize_kaldi(model_dir)
-    output_str, text, output_options, input_options, correct_rule, wav_path = recognize(wav_path, "")
-    entry = (model_dir, wav_path, output_str)
+def write_transcribe_entries(entries, out_txt_path):
     if out_txt_path is None:
-        return entry
+        return
     if os.path.isfile(out_txt_path):
         with open(out_txt_path, 'a') as f:
-            f.write(f"{entry}\n")
+            for entry in entries:
+                f.write(f"{entry}\n")
     else:
         with open(out_txt_path, 'w') as f:
-            f.write(f"{entry}\n")
+            for entry in entries:
+                f.write(f"{entry}\n")
+
+def write_test_model_output(calculator, cmd_overall_stats, tsv_file, model_dir, dictation=False):
+    """
+    Writes the token output of a test_model() (or test_model_dictation()) run, and appends its overall 
+    results to test_model_output_overall.txt. Returns (overall_string, cmd_overall_stats).
+    """
+    outfile_path = 'test_model_output_dictation_tokens.txt' if dictation else 'test_model_output_tokens.txt'
+    with open(outfile_path, 'w', encoding='utf-8') as outfile:
+        outfile.write(f"\n{calculator.overall_string()}\n")
+        for item in calculator.data.items():
+            outfile.write(f"\n{str(item)}")
+        outfile.write("\n")
+        for entry in calculator.ranked_worst_to_best_list():
+            outfile.write(f"\n{str(entry)}")
     
-    return entry
+    overall_entry_1 = (model_dir, tsv_file, "Dictation" if dictation else "Command", "WER", calculator.overall_string())
+    overall_entry_2 = (model_dir, tsv_file, "Dictation" if dictation else "Command", "CMDERR", cmd_overall_stats)
+    with open('test_model_output_overall.txt', 'a', encoding='utf-8') as outfile:
+        outfile.write(f"{overall_entry_1}\n")
+        if not dictation:
+            outfile.write(f"{overall_entry_2}\n")
+
+    return calculator.overall_string(), cmd_overall_stats
+
+def transcribe_wav(wav_path, out_txt_path=None, model_dir=None, timeout=RECOGNITION_TIMEOUT_S):
+    """
+    Transcribes a wav file or corpus clip, returning (model_dir, wav_path, output_str).
+    If `wav_path` is a corpus file, every clip in it is transcribed and a list of entries is returned.
+    """
+    call_recognizer = None
+    if model_dir is None:
+        model_dir = "./kaldi_model/"
+    initialize_kaldi(model_dir)
+    entries = []
+    for audio_path in list_audio_paths(wav_path):
+        output_str, text, output_options, input_options, correct_rule, audio_path, timed_out = recognize(audio_path, "", timeout)
+        entries.append((model_dir, audio_path, output_str))
+    write_transcribe_entries(entries, out_txt_path)
+    return entries if is_corpus_file(wav_path) else entries[0]
 
 
 # ---------------------------------------------------------------------------------------------
 # Dictation test_model
 
 def initialize_kaldi_dictation(model_dir):
-    global call_recognizer
+    global call_recognizer, _dictation_model_dir
+    if call_recognizer is not None and _dictation_model_dir == os.path.abspath(model_dir):
+        return
     disable_donation_message()
-    recognizer = PlainDictationRecognizer(model_dir=model_dir)
+    with CompileCache("dictation", model_dir, os.path.join(model_dir, "cache.tmp")) as compile_cache:
+        recognizer = PlainDictationRecognizer(model_dir=model_dir)
+        compile_cache.finish([])
+    print(compile_cache.stats_string())
     def decode(data):
         output_str, info = recognizer.decode_utterance(data)
         return output_str
     call_recognizer = decode
+    _dictation_model_dir = os.path.abspath(model_dir)
 
 def recognize_dictation(wav_path, text):
     global call_recognizer
-    with wave.open(wav_path, 'rb') as wav_file:
-        data = wav_file.readframes(wav_file.getnframes())
+    data = read_pcm(wav_path)
     output_str = call_recognizer(data)
     print(f"Ref: {text}")
     print(f"Hyp: {output_str}")
     return output_str, text, wav_path
 
-def test_model_dictation(tsv_file, model_dir, lexicon_file=None, num_threads=1):
+def test_model_dictation(tsv_file, model_dir, lexicon_file=None, num_threads=1, journal_path=None,
+                         use_cache=True, cache_dir=DEFAULT_CACHE_DIR, warm_pool=False):
 
     print("Start test_model_dictation")
 
     call_recognizer = None
 
-    calculator = Calculator()
-
-    lexicon = set()
-    if lexicon_file:
-        with open(lexicon_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                word = line.strip().split(None, 1)[0]
-                lexicon.add(word)
-
-    print(f"opening {tsv_file}")
-    with open(tsv_file, 'r', encoding='utf-8') as f:
-        submissions = []
-        for line in f:
-            fields = line.rstrip('\n').split('\t')
-            text = fields[4]
-            wav_path = fields[0]
-            if not os.path.exists(wav_path):
-                print(f"{wav_path} does not exist")
-                continue
-            if lexicon_file and any(word not in lexicon for word in text.split()):
-                print(f"{wav_path} is out of vocabulary: {text}")
-                continue
-            submissions.append((wav_path, text,))
-        print(f"read lines: {len(submissions)}")
-
-    
-    # initialize first in-case model needs to be recompiled
-    initialize_kaldi_dictation(model_dir)
-
+    calculator = ArrayCalculator()
     utterances_list = []
-    
-    with multiprocessing.Pool(processes=num_threads, initializer=initialize_kaldi_dictation, initargs=(model_dir,)) as pool:
-        try:
-            for output_str, text, wav_path in pool.starmap(recognize_dictation, submissions, chunksize=1):
-                result = calculator.calculate(text.strip().split(), output_str.strip().split())
-                n_errors = result['sub'] + result['del'] + result['ins']
-                n_correct = result['cor']
-                n_all = result['all']
-                rate_errors = float(n_errors) / float(max(1, n_all))
-
-                entry = {'ref':text, 'hyp':output_str, 'wav_path':wav_path,
-                         'n_errors':n_errors, 'n_correct':n_correct, 'n_all':n_all, 'rate_errors':rate_errors
-                         }
-                utterances_list.append(entry)
 
-        except KeyboardInterrupt as e:
-            print(f"Closing pool: {e}")
-            pool.close()
-            return None
+    submissions = read_test_submissions(tsv_file, lexicon_file)
+    journal = TestJournal(journal_path, "test_model_dictation", tsv_file, model_dir) if journal_path else None
+    records, submissions = resume_from_journal(journal, submissions)
+    for record in records:
+        utterances_list.append(score_utterance_dictation(calculator, record))
+
+    warm_pool = check_warm_pool(warm_pool)
+    # plain dictation results only depend on the model, not grammar modules
+    cache = open_result_cache("dictation", model_dir, cache_dir=cache_dir) if (use_cache and submissions) else None
+    if cache:
+        cached_records, submissions = split_cached_submissions(cache, submissions)
+        for record in cached_records:
+            if journal:
+                journal.append(record)
+            utterances_list.append(score_utterance_dictation(calculator, record))
+        records += cached_records
+
+    if submissions:
+        # initialize first, pre-compiling the model for the workers
+        initialize_kaldi_dictation(model_dir)
+
+        progress = TestProgress(len(submissions), n_resumed=len(records))
+        with start_pool(num_threads, initialize_kaldi_dictation, (model_dir,), warm_pool) as pool:
+            try:
+                for record in pool.imap_unordered(recognize_submission_dictation, submissions, chunksize=1):
+                    if journal:
+                        journal.append(record)
+                    cache_record(cache, record)
+                    utterances_list.append(score_utterance_dictation(calculator, record))
+                    progress.update()
+            except KeyboardInterrupt as e:
+                print(f"Closing pool: {e}")
+                pool.terminate()
+                if cache:
+                    cache.close()
+                if journal:
+                    journal.close()
+                    print(f"{progress.n_resumed + progress.n_done} utterances saved to {journal.journal_path}, re-run to resume")
+                return None
+    if cache:
+        print(cache.stats_string())
+        cache.close()
+    if journal:
+        journal.close()
 
     utterances_list.sort(key=lambda x: x['n_errors'], reverse=True)
     with open('./test_model_output_dictation.txt', 'w', encoding='utf-8') as outfile:
@@ -660,15 +990,121 @@ def transcribe_wav_dictation(wav_path, out_txt_path=None, model_dir=None):
     if model_dir is None:
         model_dir = "./kaldi_model/"
     initialize_kaldi_dictation(model_dir)
-    output_str, _, wav_path = recognize_dictation(wav_path, "")
-    entry = (model_dir, wav_path, output_str)
-    if out_txt_path is None:
-        return entry
-    if os.path.isfile(out_txt_path):
-        with open(out_txt_path, 'a') as f:
-            f.write(f"{entry}\n")
+    entries = []
+    for audio_path in list_audio_paths(wav_path):
+        output_str, _, audio_path = recognize_dictation(audio_path, "")
+        entries.append((model_dir, audio_path, output_str))
+    write_transcribe_entries(entries, out_txt_path)
+    return entries if is_corpus_file(wav_path) else entries[0]
+
+# ---------------------------------------------------------------------------------------------
+# Batch transcription
+
+# reference for recognize() when there's no transcript, which skips the mimic
+NO_REFERENCE = {'rule': None, 'options': None, 'timed_out': False}
+
+class TranscribeOutput:
+    """
+    Streams transcription records to `out_path` as they complete, as JSON lines if it ends 
+    with .jsonl, otherwise as tab separated wav_path and transcript.
+    """
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.jsonl = out_path.lower().endswith(".jsonl")
+        self.file = open(out_path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        if self.jsonl:
+            line = json.dumps(record)
+        else:
+            line = f"{record['wav_path']}\t{record['hyp']}"
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def transcribe_submission(submission):
+    """
+    recognize() an (audio_path, timeout) submission without a transcript, returning an output record
+    """
+    audio_path, timeout = submission
+    start_time = time.perf_counter()
+    output_str, _, _, _, _, _, timed_out = recognize(audio_path, "", timeout, reference=NO_REFERENCE)
+    decode_s = time.perf_counter() - start_time
+    return {'wav_path': audio_path, 'hyp': output_str, 'duration_s': audio_duration_s(audio_path),
+            'decode_s': decode_s, 'timed_out': timed_out}
+
+def transcribe_submission_dictation(audio_path):
+    """
+    recognize_dictation() an audio_path, returning an output record
+    """
+    start_time = time.perf_counter()
+    output_str, _, _ = recognize_dictation(audio_path, "")
+    decode_s = time.perf_counter() - start_time
+    return {'wav_path': audio_path, 'hyp': output_str, 'duration_s': audio_duration_s(audio_path),
+            'decode_s': decode_s}
+
+def transcribe_batch(input_path, out_path, model_dir=None, num_threads=1, dictation=False, 
+                     timeout=RECOGNITION_TIMEOUT_S, warm_pool=False):
+    """
+    Transcribes every audio file referred to by `input_path` (a directory, glob, list file or corpus file,
+    see corpus.expand_audio_inputs()) with a pool of `num_threads` workers, each initialized once. 
+    Results are streamed to `out_path` (see TranscribeOutput) in order of completion.
+    Returns a dict of throughput stats.
+    """
+    if model_dir is None:
+        model_dir = "./kaldi_model/"
+    audio_paths = expand_audio_inputs(input_path)
+    print(f"Transcribing {len(audio_paths)} files from {input_path}")
+    warm_pool = check_warm_pool(warm_pool)
+
+    # initialize first, pre-compiling the model and grammars for the workers
+    engine = None
+    if dictation:
+        initializer, worker, submissions = initialize_kaldi_dictation, transcribe_submission_dictation, audio_paths
+        initialize_kaldi_dictation(model_dir)
     else:
-        with open(out_txt_path, 'w') as f:
-            f.write(f"{entry}\n")
-    
-    return entry
+        initializer, worker, submissions = initialize_kaldi, transcribe_submission, [(audio_path, timeout) for audio_path in audio_paths]
+        engine = initialize_kaldi(model_dir, audio_input_device=False if warm_pool else None)
+        if not warm_pool:
+            release_kaldi(engine)
+            engine = None
+
+    # clips are short, so hand them out a few at a time, but not so many that workers finish unevenly
+    chunksize = max(1, min(16, len(submissions) // (num_threads * 8)))
+    output = TranscribeOutput(out_path)
+    progress = TestProgress(len(submissions))
+    n_files = 0
+    audio_s = 0.0
+    decode_s = 0.0
+    start_time = time.perf_counter()
+    with start_pool(num_threads, initializer, (model_dir,), warm_pool) as pool:
+        try:
+            for record in pool.imap_unordered(worker, submissions, chunksize=chunksize):
+                output.write(record)
+                n_files += 1
+                audio_s += record['duration_s']
+                decode_s += record['decode_s']
+                progress.update()
+        except KeyboardInterrupt as e:
+            print(f"Closing pool: {e}")
+            pool.terminate()
+        finally:
+            output.close()
+    wall_s = time.perf_counter() - start_time
+    if engine:
+        release_kaldi(engine)
+
+    stats = {
+        'files': n_files,
+        'audio_s': audio_s,
+        'wall_s': wall_s,
+        'files_per_s': n_files / max(wall_s, 1e-9),
+        # wall time per second of audio for the whole pool, and decode time per second of audio for a worker
+        'rtf': wall_s / max(audio_s, 1e-9),
+        'worker_rtf': decode_s / max(audio_s, 1e-9),
+    }
+    print(f"Transcribed {n_files} files ({audio_s:.1f}s of audio) in {wall_s:.1f}s to {out_path}: "
+          + f"{stats['files_per_s']:.2f} files/s, real-time factor {stats['rtf']:.3f} (per worker {stats['worker_rtf']:.3f})")
+    return stats
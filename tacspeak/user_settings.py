@@ -1,11 +1,27 @@
 DEBUG_MODE = False                              # enables additional logging, and if properly setup in the grammar module:
                                                 # - enables module without needing the app in focus, i.e. AppContext()
                                                 # - actions only print to console, they don't press virtual keys
-DEBUG_HEAVY_DUMP_GRAMMAR = False                # expensive on memory, don't set this to True unless you're sure
+DEBUG_HEAVY_DUMP_GRAMMAR = False                # writes a very large file, don't set this to True unless you're sure
                                                 # if properly setup in the grammar module:
-                                                # - generates a .debug_grammar_*.txt that describes the spec of the active commands
+                                                # - lists every phrase of the active commands in the .debug_grammar_*.txt (DEBUG_MODE describes their specs)
+DEBUG_HEAVY_DUMP_GRAMMAR_SAMPLE = None          # set to an int to only list that many random phrases of each command, e.g. 1000
 USE_NOISE_SINK = True                           # load NoiseSink rule(s), if it's setup in the grammar module.
                                                 # - it should partially capture other noises and words outside of commands, and do nothing.
+ASYNC_ACTIONS = False                           # set to True to execute actions (key presses) on their own thread, so they don't block recognising the next command.
+                                                # - a newer order to the same team replaces an older one that hasn't started yet.
+                                                # - actions that wait longer than ASYNC_ACTIONS_MAX_WAIT_S to start are dropped.
+ASYNC_ACTIONS_MAX_WAIT_S = 2.0                  # actions that wait longer than this to start are dropped, as they're stale.
+LATENCY_INSTRUMENTATION = False                 # times each stage from end of speech to action execution, per grammar and rule.
+                                                # - writes p50/p95/p99 (ms) to LATENCY_DUMP_PATH every LATENCY_DUMP_INTERVAL_S seconds, and on exit.
+LATENCY_DUMP_PATH = "./.tacspeak_latency.txt"
+LATENCY_DUMP_INTERVAL_S = 60
+HOT_RELOAD = False                              # reloads grammar modules and this file when they're saved, without restarting Tacspeak.
+                                                # - only commands whose spec changed are recompiled. most KALDI_ENGINE_SETTINGS still need a restart.
+HOT_RELOAD_INTERVAL_S = 1.0                     # how often to check for changes.
+LAZY_LOAD = False                               # loads a grammar module when its game is in the foreground, rather than at start-up.
+                                                # - only for modules that declare their game's EXECUTABLE. ignored with DEBUG_MODE or HOT_RELOAD.
+LAZY_UNLOAD_AFTER_S = None                      # set to a number of seconds to unload a module when its game hasn't been in the foreground that long.
+LAZY_LOAD_INTERVAL_S = 1.0                      # how often to check the foreground window.
 
 def my_retain_func(audio_store):
     """Used in retain_approval_func"""
@@ -0,0 +1,38 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import os
+import sys
+
+import pytest
+
+# so tests import the tacspeak package from this checkout, however pytest is run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tacspeak.benchmark import stubs
+
+
+STUBBED_PACKAGES = ("dragonfly", "kaldi_active_grammar", "tacspeak")
+
+
+def is_stubbed(module_name):
+    # tacspeak modules are imported afresh with the stubs, as they import from dragonfly
+    return module_name.split(".")[0] in STUBBED_PACKAGES
+
+@pytest.fixture
+def stubbed_modules():
+    """
+    Replaces dragonfly and kaldi_active_grammar with ``tacspeak.benchmark.stubs`` for the test,
+    and any imported tacspeak modules, restoring the modules imported before it afterwards.
+    """
+    saved = {name: module for name, module in sys.modules.items() if is_stubbed(name)}
+    for name in saved:
+        del sys.modules[name]
+    stubs.install()
+    yield
+    for name in [name for name in sys.modules if is_stubbed(name)]:
+        del sys.modules[name]
+    sys.modules.update(saved)
@@ -0,0 +1,114 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import time
+import types
+
+import pytest
+
+
+@pytest.fixture
+def new_executor(stubbed_modules):
+    """
+    Returns a function making an ActionExecutor, which isn't started until the test starts it.
+    """
+    from tacspeak.action_executor import ActionExecutor
+    executors = []
+    def make(max_wait_s=None):
+        executors.append(ActionExecutor(max_wait_s))
+        return executors[-1]
+    yield make
+    for executor in executors:
+        executor.stop(timeout=5)
+
+def recorded(name, executed):
+    """
+    Returns an action appending `name` (and the data it's executed with) to `executed`.
+    """
+    return types.SimpleNamespace(execute=lambda data=None: executed.append((name, data)))
+
+def run(executor):
+    executor.start()
+    assert executor.wait_idle(timeout=5)
+
+def test_fifo_across_keys(new_executor):
+    executed = []
+    executor = new_executor()
+    for name, key in (("a", "blue"), ("b", "red"), ("c", None), ("d", "gold"), ("e", None)):
+        executor.submit(recorded(name, executed), key=key, data={"name": name})
+    run(executor)
+    assert executed == [(name, {"name": name}) for name in "abcde"]
+    assert executor.n_executed == 5
+    assert executor.n_coalesced == 0
+
+def test_same_key_replaces_queued(new_executor):
+    executed = []
+    executor = new_executor()
+    executor.submit(recorded("blue stack up", executed), key="blue")
+    executor.submit(recorded("red stack up", executed), key="red")
+    executor.submit(recorded("blue breach", executed), key="blue")
+    run(executor)
+    # the newer chain is queued last, not in the place of the one it replaced
+    assert [name for name, _ in executed] == ["red stack up", "blue breach"]
+    assert executor.n_coalesced == 1
+
+def test_no_key_doesnt_coalesce(new_executor):
+    executed = []
+    executor = new_executor()
+    executor.submit(recorded("a", executed))
+    executor.submit(recorded("b", executed))
+    run(executor)
+    assert [name for name, _ in executed] == ["a", "b"]
+    assert executor.n_coalesced == 0
+
+def test_preempt_empties_queue(new_executor):
+    executed = []
+    executor = new_executor()
+    executor.submit(recorded("a", executed), key="blue")
+    executor.submit(recorded("b", executed))
+    executor.submit(recorded("c", executed), preempt=True)
+    executor.submit(recorded("d", executed))
+    run(executor)
+    assert [name for name, _ in executed] == ["c", "d"]
+    assert executor.n_preempted == 2
+
+def test_expired_chain_dropped(new_executor):
+    executed = []
+    executor = new_executor(max_wait_s=0.05)
+    executor.submit(recorded("stale", executed))
+    time.sleep(0.1)
+    executor.submit(recorded("fresh", executed))
+    run(executor)
+    assert [name for name, _ in executed] == ["fresh"]
+    assert executor.n_expired == 1
+    assert executor.n_executed == 1
+
+def test_failed_chain_doesnt_stop_executor(new_executor):
+    executed = []
+    def fail(data=None):
+        raise RuntimeError("no window")
+    executor = new_executor()
+    executor.submit(types.SimpleNamespace(execute=fail))
+    executor.submit(types.SimpleNamespace(execute=lambda data=None: False))
+    executor.submit(recorded("a", executed))
+    run(executor)
+    assert [name for name, _ in executed] == ["a"]
+    assert executor.n_failed == 2
+
+def test_submit_after_stop_raises(new_executor):
+    executor = new_executor().start()
+    executor.stop(timeout=5)
+    with pytest.raises(RuntimeError):
+        executor.submit(recorded("a", []))
+
+def test_wait_and_execute_timed_per_key(new_executor):
+    executor = new_executor()
+    executor.submit(recorded("a", []), key="blue")
+    executor.submit(recorded("b", []))
+    run(executor)
+    assert {key for key, _ in executor.histograms} == {"blue", "(no key)"}
+    assert executor.histograms[("blue", "wait")].count == 1
+    assert executor.histograms[("blue", "execute")].count == 1
@@ -0,0 +1,102 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import hashlib
+import os
+import random
+import wave
+
+import pytest
+
+from tacspeak import corpus
+from tacspeak.corpus import (pack_corpus, get_archive, read_blocks, read_pcm, audio_duration_s, hash_audio,
+                             list_audio_paths, expand_audio_inputs, split_audio_path, is_corpus_file,
+                             BLOCK_SIZE_SAMPLES, SAMPLE_RATE, SAMPLE_WIDTH)
+
+# samples, including clips that aren't a whole number of blocks, and an empty clip
+CLIP_SAMPLES = [SAMPLE_RATE, BLOCK_SIZE_SAMPLES * 7 + 13, 1, 0, SAMPLE_RATE * 2 + 3]
+
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(SAMPLE_WIDTH)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+
+def write_tsv(path, rows):
+    # retain.tsv columns: wav path, duration, grammar, rule, text
+    with open(path, 'w', encoding='utf-8') as f:
+        for wav_path, text in rows:
+            f.write(f"{wav_path}\t1.0\tReadyOrNot\tStackUp\t{text}\n")
+
+@pytest.fixture
+def wavs(tmp_path):
+    """
+    Returns [(wav_path, text, pcm)] of generated wav files.
+    """
+    rng = random.Random(0)
+    clips = []
+    for i, n_samples in enumerate(CLIP_SAMPLES):
+        pcm = bytes(rng.getrandbits(8) for _ in range(n_samples * SAMPLE_WIDTH))
+        wav_path = str(tmp_path / f"retain_{i}.wav")
+        write_wav(wav_path, pcm)
+        clips.append((wav_path, f"blue team stack up {i} ✓", pcm))
+    return clips
+
+@pytest.fixture
+def packed(tmp_path, wavs):
+    """
+    Returns (corpus path, wavs) of the wavs packed with a duplicate and a missing wav listed too.
+    """
+    tsv_path = str(tmp_path / "retain.tsv")
+    rows = [(wav_path, text) for wav_path, text, _ in wavs]
+    rows.insert(2, rows[0])
+    rows.insert(4, (str(tmp_path / "missing.wav"), "red team breach"))
+    write_tsv(tsv_path, rows)
+    corpus_path = str(tmp_path / "retain.corpus")
+    assert pack_corpus(tsv_path, corpus_path) == len(wavs)
+    yield corpus_path, wavs
+    archive = corpus._archives.pop(corpus_path, None)
+    if archive is not None:
+        archive.close()
+
+def test_round_trip(packed):
+    corpus_path, wavs = packed
+    assert is_corpus_file(corpus_path)
+    archive = get_archive(corpus_path)
+    assert len(archive) == len(wavs)
+    clips = list(archive.clips())
+    assert [text for _, text in clips] == [text for _, text, _ in wavs]
+    for (audio_path, _), (wav_path, _, pcm) in zip(clips, wavs):
+        assert audio_path == f"{corpus_path}::{wav_path}"
+        assert bytes(read_pcm(audio_path)) == pcm == read_pcm(wav_path)
+        blocks = list(read_blocks(audio_path))
+        assert blocks[-1] is None
+        assert all(len(block) == BLOCK_SIZE_SAMPLES * SAMPLE_WIDTH for block in blocks[:-2])
+        assert b"".join(bytes(block) for block in blocks[:-1]) == pcm
+        assert audio_duration_s(audio_path) == audio_duration_s(wav_path) == len(pcm) / (SAMPLE_RATE * SAMPLE_WIDTH)
+        assert hash_audio(audio_path) == hashlib.sha1(pcm).hexdigest()
+        assert hash_audio(wav_path) is None
+
+def test_duplicate_and_missing_wavs_skipped(packed, tmp_path):
+    corpus_path, wavs = packed
+    names = [os.path.basename(audio_path.split("::", 1)[1]) for audio_path in list_audio_paths(corpus_path)]
+    assert names == [f"retain_{i}.wav" for i in range(len(wavs))]
+    with pytest.raises(KeyError):
+        split_audio_path(f"{corpus_path}::{tmp_path / 'missing.wav'}")
+
+def test_expand_corpus(packed):
+    corpus_path, wavs = packed
+    assert expand_audio_inputs(corpus_path) == [f"{corpus_path}::{wav_path}" for wav_path, _, _ in wavs]
+
+def test_wrong_format_raises(tmp_path):
+    wav_path = str(tmp_path / "retain_44k.wav")
+    write_wav(wav_path, b"\0\0" * 441, sample_rate=44100)
+    tsv_path = str(tmp_path / "retain.tsv")
+    write_tsv(tsv_path, [(wav_path, "stack up")])
+    with pytest.raises(ValueError, match="should be 16000 Hz"):
+        pack_corpus(tsv_path, str(tmp_path / "retain.corpus"))
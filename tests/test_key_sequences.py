@@ -0,0 +1,146 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import math
+
+import pytest
+
+from tacspeak.key_sequences import compile_key_sequences, KeySequenceError, PRESS, DOWN, UP
+
+BINDINGS = {"blue": "f6", "red": "f7", "cmd_menu": "mouse_middle", "cmd_hold": "shift",
+            "cmd_1": "1", "cmd_2": "2", "cmd_3": "3"}
+
+
+@pytest.fixture
+def readyornot(stubbed_modules):
+    from tacspeak.benchmark.hotpaths import load_readyornot
+    return load_readyornot()
+
+# --------------------------------------------------------------------------
+# _readyornot's spec
+
+def test_readyornot_compiles_without_warnings(readyornot):
+    key_sequences = compile_key_sequences(readyornot.key_sequences_spec, readyornot.ingame_key_bindings)
+    assert key_sequences.warnings == []
+    assert key_sequences.check_rules(readyornot.expand_rules(readyornot.grammar.rules)) == []
+
+def test_readyornot_every_combination(readyornot):
+    key_sequences = compile_key_sequences(readyornot.key_sequences_spec, readyornot.ingame_key_bindings)
+    n_combinations = sum(math.prod(len(values) for values in options.values())
+                         for options in key_sequences.options.values())
+    assert len(key_sequences.sequences) == n_combinations
+    assert set(readyornot.action_table) == set(key_sequences.sequences)
+
+@pytest.mark.parametrize("key, events", [
+    (("select_team", "gold"), (("gold", PRESS),)),
+    (("execute_or_cancel_held_order", "current", "cancel"), (("cmd_menu", PRESS), ("cmd_2", PRESS))),
+    (("stack_up", "blue", "hold", "left"),
+     (("blue", PRESS), ("cmd_menu", PRESS), ("cmd_1", PRESS), ("cmd_hold", DOWN), ("cmd_2", PRESS), ("cmd_hold", UP))),
+    (("stack_up", "current", "go", "auto"), (("cmd_menu", PRESS), ("cmd_1", PRESS), ("cmd_4", PRESS))),
+    # ("slide", "*") matches whether or not the door is trapped
+    (("door_options", "red", "hold", "slide", "not trapped"),
+     (("red", PRESS), ("cmd_menu", PRESS), ("cmd_hold", DOWN), ("cmd_4", PRESS), ("cmd_1", PRESS), ("cmd_hold", UP))),
+    (("door_options", "red", "hold", "slide", "trapped"),
+     (("red", PRESS), ("cmd_menu", PRESS), ("cmd_hold", DOWN), ("cmd_4", PRESS), ("cmd_1", PRESS), ("cmd_hold", UP))),
+    (("door_options", "current", "go", "wedge", "not trapped"), (("cmd_menu", PRESS), ("cmd_6", PRESS))),
+    (("door_options", "current", "go", "wedge", "trapped"), (("cmd_menu", PRESS), ("cmd_7", PRESS))),
+])
+def test_readyornot_sequences(readyornot, key, events):
+    key_sequences = compile_key_sequences(readyornot.key_sequences_spec, readyornot.ingame_key_bindings)
+    assert key_sequences.sequences[key] == events
+
+# --------------------------------------------------------------------------
+# Tables
+
+def test_wildcard_expands_to_every_value():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"], "hold": ["go", "hold"]},
+        "sequence": [{("color", "hold"): {("*", "go"): "cmd_1", ("*", "hold"): ("cmd_hold:down", "cmd_2", "cmd_hold:up")}}],
+    }}
+    key_sequences = compile_key_sequences(spec, BINDINGS)
+    assert dict(key_sequences.sequences) == {
+        ("order", "blue", "go"): (("cmd_1", PRESS),),
+        ("order", "red", "go"): (("cmd_1", PRESS),),
+        ("order", "blue", "hold"): (("cmd_hold", DOWN), ("cmd_2", PRESS), ("cmd_hold", UP)),
+        ("order", "red", "hold"): (("cmd_hold", DOWN), ("cmd_2", PRESS), ("cmd_hold", UP)),
+    }
+    assert key_sequences.warnings == []
+
+def test_exact_value_beats_wildcard():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"]},
+        "sequence": [{"color": {"*": "cmd_1", "red": ()}}, "cmd_menu"],
+    }}
+    sequences = compile_key_sequences(spec, BINDINGS).sequences
+    assert sequences[("order", "blue")] == (("cmd_1", PRESS), ("cmd_menu", PRESS))
+    assert sequences[("order", "red")] == (("cmd_menu", PRESS),)
+
+def test_unreachable_entry_warns():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"]},
+        "sequence": [{"color": {"blue": "blue", "red": "red", "gold": "cmd_1"}}],
+    }}
+    key_sequences = compile_key_sequences(spec, BINDINGS)
+    assert key_sequences.warnings == ["order: step 0 entry color='gold' is unreachable"]
+
+def test_shadowed_wildcard_warns():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"]},
+        "sequence": [{"color": {"blue": "blue", "red": "red", "*": "cmd_1"}}],
+    }}
+    key_sequences = compile_key_sequences(spec, BINDINGS)
+    assert key_sequences.warnings == ["order: step 0 entry color='*' is unreachable"]
+
+def test_conflicting_entries_raise():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"], "hold": ["go", "hold"]},
+        "sequence": [{("color", "hold"): {("blue", "*"): "cmd_1", ("*", "hold"): "cmd_2", ("*", "go"): "cmd_3",
+                                          ("red", "*"): "cmd_3"}}],
+    }}
+    with pytest.raises(KeySequenceError) as e:
+        compile_key_sequences(spec, BINDINGS)
+    # blue/go is matched by ("blue", "*") -> cmd_1 and ("*", "go") -> cmd_3, blue/hold and red/hold likewise
+    assert "entries [('blue', '*'), ('*', 'go')] conflict for ('color', 'hold')=('blue', 'go')" in str(e.value)
+    assert "('blue', 'hold')" in str(e.value)
+    assert "('red', 'hold')" in str(e.value)
+    # red/go is matched by two entries with the same steps, which isn't a conflict
+    assert "('red', 'go')" not in str(e.value)
+
+def test_missing_entry_raises():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"]},
+        "sequence": [{"color": {"blue": "blue"}}],
+    }}
+    with pytest.raises(KeySequenceError, match="order: step 0 has no entry for color='red'"):
+        compile_key_sequences(spec, BINDINGS)
+
+def test_unknown_binding_and_state_raise():
+    spec = {"order": {
+        "options": {},
+        "sequence": ["cmd_9", "cmd_hold:held"],
+    }}
+    with pytest.raises(KeySequenceError) as e:
+        compile_key_sequences(spec, BINDINGS)
+    assert "order: step 0 unknown binding 'cmd_9'" in str(e.value)
+    assert "order: step 1 unknown key state 'held' of 'cmd_hold'" in str(e.value)
+
+def test_build_shares_actions():
+    spec = {"order": {
+        "options": {"color": ["blue", "red"]},
+        "sequence": [{"color": {"*": "cmd_1"}}],
+    }}
+    table = compile_key_sequences(spec, BINDINGS).build(lambda events: list(events))
+    assert table[("order", "blue")] is table[("order", "red")]
+    with pytest.raises(TypeError):
+        table[("order", "gold")] = []
+
+def test_check_rules_list_choice(stubbed_modules):
+    from dragonfly import Choice, CompoundRule
+    spec = {"select_team": {"options": {"color": ["blue", "red"]}, "sequence": [{"color": {"blue": "blue", "red": "red"}}]}}
+    key_sequences = compile_key_sequences(spec, BINDINGS)
+    # a list of choices is valued by the words spoken
+    rule = CompoundRule("SelectColor", "<color>", extras=[Choice("color", ["blue", "red", "gold"])])
+    assert key_sequences.check_rules([rule]) == ["SelectColor color='gold' isn't an option of any command"]
@@ -0,0 +1,138 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import pytest
+
+# parsed against dragonfly's text engine, so these need the real modules
+pytest.importorskip("dragonfly")
+pytest.importorskip("kaldi_active_grammar")
+
+from dragonfly import Alternative, Choice, Compound, Dictation, Grammar, IntegerRef, Optional, get_engine
+from dragonfly.grammar.rule_compound import CompoundRule
+
+import tacspeak.test_model as tm
+from tacspeak.phrase_index import PhraseIndex
+from tacspeak.shared_rules import SharedPrefixRule
+
+color = Choice("color", {"blue": "blue", "red": "red", "gold": "gold"})
+hold = Optional(Compound("on my (mark | order)", value="hold"), name="hold", default="go")
+side = Alternative([Compound("left", value="left"), Compound("right", value="right"),
+                    Compound("(split | both sides)", value="split")], name="side")
+tool = Choice("tool", {"kick": "kick", "shotgun": "shotgun", "(c2 | explosive)": "c2"})
+
+
+class StackUp(CompoundRule):
+    spec = "<color> [team] <hold> stack up [<side>]"
+    extras = [color, hold, side]
+    defaults = {"color": "current", "side": "auto"}
+
+class Breach(CompoundRule):
+    spec = "<color> [team] <hold> breach [with <tool>]"
+    extras = [color, hold, tool]
+    defaults = {"color": "current", "tool": "open"}
+
+class Say(CompoundRule):
+    # the optional is greedy, so "quickly" isn't dictated
+    spec = "say [<fast>] <text>"
+    extras = [Dictation("text"), Optional(Compound("quickly", value=True), name="fast", default=False)]
+
+class Fallback(CompoundRule):
+    # alternatives are tried in order, so "fall back" is always 1
+    spec = "fall back <distance>"
+    extras = [Alternative([Compound("(back | fall back)", value=1), Compound("back", value=2)], name="distance")]
+
+class Yell(CompoundRule):
+    spec = "yell <text>"
+    extras = [Dictation("text")]
+
+class EveryoneHalt(CompoundRule):
+    spec = "everyone (halt | freeze)"
+
+class EveryoneFreeze(CompoundRule):
+    # after EveryoneHalt in the grammar, so never recognised
+    spec = "everyone freeze"
+
+class Wait(CompoundRule):
+    # IntegerRef's value for numbers of more than one word can't be known from the words alone,
+    # so it's left out of the index
+    spec = "wait <n> seconds"
+
+
+@pytest.fixture(scope="module")
+def grammar():
+    engine = get_engine("text")
+    tm.get_recognition_waiter()
+    grammar = Grammar("PhraseIndexTest", engine=engine)
+    grammar.add_rule(SharedPrefixRule("TeamOrders", "<color> [team] <hold>", [StackUp(), Breach()]))
+    # IntegerRef needs an engine for its language
+    for rule in (Say(), Fallback(), Yell(), EveryoneHalt(), EveryoneFreeze(), Wait(extras=[IntegerRef("n", 1, 100)])):
+        grammar.add_rule(rule)
+    grammar.load()
+    yield grammar
+    grammar.unload()
+
+@pytest.fixture(scope="module")
+def phrase_index(grammar):
+    return PhraseIndex.from_grammars([grammar])
+
+def mimic(text):
+    """
+    Returns (rule, options) of `text` mimicked with the text engine, as extract_recognition() gives them.
+    """
+    waiter = tm.get_recognition_waiter()
+    waiter.reset()
+    try:
+        get_engine("text").mimic(text)
+    except Exception:
+        # nothing matched
+        pass
+    _, rule, _, options = tm.extract_recognition(waiter.recog_buffer)
+    return rule, tm.jsonable(options)
+
+@pytest.mark.parametrize("text", [
+    "blue stack up",
+    "red team on my mark stack up left",
+    "gold on my order stack up both sides",
+    "blue team breach with explosive",
+    "red on my mark breach",
+    "say quickly run away",
+    "say hello",
+    "fall back back",
+    "yell drop your weapon",
+    "everyone freeze",
+    "blue team",
+    "stack up",
+])
+def test_classify_matches_extract_recognition(phrase_index, text):
+    rule, options = phrase_index.classify(text)
+    assert (rule, tm.jsonable(options)) == mimic(text)
+
+def test_shared_prefix_rules_indexed_separately(phrase_index):
+    assert [rule.name for rule in phrase_index.rules] == [
+        "StackUp", "Breach", "Say", "Fallback", "Yell", "EveryoneHalt", "EveryoneFreeze"]
+    rule, options = phrase_index.classify("red team on my mark stack up left")
+    assert isinstance(rule, StackUp)
+    assert options == {"color": "red", "hold": "hold", "side": "left"}
+
+def test_defaults(phrase_index):
+    assert phrase_index.classify("blue breach")[1] == {"color": "blue", "hold": None, "tool": "open"}
+
+def test_first_parse_wins(phrase_index):
+    # optionals are greedy
+    assert phrase_index.classify("say quickly run")[1] == {"text": "run", "fast": True}
+    # alternatives in order
+    assert phrase_index.classify("fall back back")[1] == {"distance": 1}
+    # rules in grammar order
+    assert [type(rule) for rule, _ in phrase_index.classify_all("everyone freeze")] == [EveryoneHalt, EveryoneFreeze]
+    assert isinstance(phrase_index.classify("everyone freeze")[0], EveryoneHalt)
+
+def test_unsupported_rule_left_out(phrase_index):
+    assert list(phrase_index.unsupported) == ["Wait"]
+    assert "can't value extra n" in phrase_index.unsupported["Wait"]
+    assert phrase_index.classify("wait five seconds") == (None, None)
+    # so test_model mimics phrases the index can't classify
+    assert isinstance(mimic("wait five seconds")[0], Wait)
+    assert tm.index_reference(phrase_index, "wait five seconds")["rule"] is None
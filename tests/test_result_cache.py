@@ -0,0 +1,47 @@
+#
+# This file is part of Tacspeak.
+# (c) Copyright 2024 by Joshua Webb
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+import json
+import os
+
+from tacspeak.result_cache import ResultCache
+
+
+def read_keys(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)[0] for line in f]
+
+def test_hits_kept_in_order_of_use_across_runs(tmp_path):
+    cache_dir = str(tmp_path)
+    with ResultCache("context", cache_dir) as cache:
+        for i in range(5):
+            cache.put(f"k{i}", "x" * 100)
+    with ResultCache("context", cache_dir) as cache:
+        assert cache.get("k0") is not None
+        assert cache.get("missing") is None
+    assert read_keys(cache.path) == ["k1", "k2", "k3", "k4", "k0"]
+
+    # a later run over max_bytes keeps the most recently used entries, including the earlier run's hit
+    entry_bytes = len(json.dumps(["k0", "x" * 100]) + "\n")
+    with ResultCache("context", cache_dir, max_bytes=entry_bytes * 2) as cache:
+        pass
+    assert read_keys(cache.path) == ["k4", "k0"]
+
+def test_read_only_context_isnt_evicted_first(tmp_path):
+    cache_dir = str(tmp_path)
+    with ResultCache("read", cache_dir) as cache:
+        cache.put("k", "x" * 100)
+    with ResultCache("written", cache_dir) as cache:
+        cache.put("k", "x" * 100)
+    os.utime(os.path.join(cache_dir, "results_read.jsonl"), (1, 1))
+    os.utime(os.path.join(cache_dir, "results_written.jsonl"), (2, 2))
+    with ResultCache("read", cache_dir) as cache:
+        assert cache.get("k") is not None
+    entry_bytes = os.path.getsize(os.path.join(cache_dir, "results_read.jsonl"))
+    # opened with a different context, so both others are candidates for eviction
+    with ResultCache("other", cache_dir, max_bytes=entry_bytes + 1):
+        pass
+    assert sorted(os.listdir(cache_dir)) == ["results_other.jsonl", "results_read.jsonl"]